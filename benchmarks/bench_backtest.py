@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the alert rule backtest - NumPy sliding windows vs a per-sample Python loop
+
+Writes --series synthetic indicator series of --days of 1 minute samples to an NPZ file, loads it back and backtests
+--rules rules with random thresholds, bad_minutes and total_minutes against them. The first --baseline-rules rules
+are also evaluated with a plain Python loop over every minute, and their firing intervals checked against the
+vectorized ones.
+
+Sample usage
+
+python benchmarks/bench_backtest.py
+python benchmarks/bench_backtest.py --days 90 --series 200 --rules 500
+"""
+
+import os
+import sys
+import time
+import argparse
+import logging
+import tempfile
+from collections import deque
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+# pylint: disable=wrong-import-position
+from last9_backtest import STEP_SEC, backtest_rule, load_series
+
+
+def load_args():
+    """Parse cli"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, help="Days of 1 minute samples per series", default=30)
+    parser.add_argument("--series", type=int, help="Number of series", default=100)
+    parser.add_argument("--rules", type=int, help="Number of rules", default=300)
+    parser.add_argument("--baseline-rules", type=int, help="Rules also evaluated with the Python loop", default=5)
+    parser.add_argument("--seed", type=int, help="Random seed", default=9)
+    return vars(parser.parse_args(sys.argv[1:]))
+
+
+def write_series(path, series_count, minutes, rng):
+    """NPZ file of series_count random walks with gaps - returns the series names"""
+    names = [f"indicator_{index:04d}" for index in range(series_count)]
+    columns = {"timestamp": 1700000000 + STEP_SEC * np.arange(minutes, dtype=np.int64)}
+    for name in names:
+        values = 50 + np.cumsum(rng.normal(0, 1, minutes))
+        values[rng.random(minutes) < 0.01] = np.nan
+        columns[name] = values
+    np.savez(path, **columns)
+    return names
+
+
+def random_rules(names, count, rng):
+    """(series name, rule) pairs with random thresholds and windows"""
+    rules = []
+    for _ in range(count):
+        total_minutes = int(rng.integers(1, 61))
+        rule = {
+            "name": "rule",
+            "bad_minutes": int(rng.integers(1, total_minutes + 1)),
+            "total_minutes": total_minutes,
+            ("greater_than" if rng.random() < 0.5 else "less_than"): float(rng.normal(50, 20)),
+        }
+        rules.append((names[int(rng.integers(len(names)))], rule))
+    return rules
+
+
+def loop_intervals(series, rule):
+    """Firing intervals of a rule computed minute by minute - the baseline"""
+    operator = "greater_than" if "greater_than" in rule else "less_than"
+    threshold = rule[operator]
+    window = deque()
+    bad_count = 0
+    intervals = []
+    firing_since = None
+    for index, value in enumerate(series.values.tolist()):
+        is_bad = value == value and (value > threshold if operator == "greater_than" else value < threshold)
+        window.append(is_bad)
+        bad_count += is_bad
+        if len(window) > rule["total_minutes"]:
+            bad_count -= window.popleft()
+        firing = bad_count >= rule["bad_minutes"]
+        if firing and firing_since is None:
+            firing_since = index
+        elif not firing and firing_since is not None:
+            intervals.append((series.start + firing_since * STEP_SEC, series.start + index * STEP_SEC))
+            firing_since = None
+    if firing_since is not None:
+        intervals.append((series.start + firing_since * STEP_SEC, series.start + len(series.values) * STEP_SEC))
+    return intervals
+
+
+def main():
+    """Main function"""
+    args = load_args()
+    logging.basicConfig(level=logging.ERROR)
+    rng = np.random.default_rng(args["seed"])
+    minutes = args["days"] * 24 * 60
+
+    with tempfile.TemporaryDirectory(prefix="bench-backtest-") as work_dir:
+        path = os.path.join(work_dir, "series.npz")
+        names = write_series(path, args["series"], minutes, rng)
+        start = time.perf_counter()
+        series = load_series([path])
+        load_sec = time.perf_counter() - start
+
+    rules = random_rules(names, args["rules"], rng)
+    start = time.perf_counter()
+    results = [backtest_rule(series[name], rule) for name, rule in rules]
+    vectorized_sec = time.perf_counter() - start
+
+    baseline = rules[: args["baseline_rules"]]
+    start = time.perf_counter()
+    loop_results = [loop_intervals(series[name], rule) for name, rule in baseline]
+    loop_sec = time.perf_counter() - start
+    mismatches = sum(result.intervals != intervals for result, intervals in zip(results, loop_results))
+
+    samples = len(rules) * minutes
+    print(f"{args['series']} series x {minutes} minutes ({args['days']} days), {len(rules)} rules")
+    print(f"load NPZ          {load_sec:8.3f} s")
+    print(f"backtest (numpy)  {vectorized_sec:8.3f} s  {samples / vectorized_sec / 1e6:8.1f} M rule-minutes/s")
+    if baseline:
+        loop_rate = len(baseline) * minutes / loop_sec
+        print(
+            f"backtest (loop)   {loop_sec * len(rules) / len(baseline):8.3f} s  {loop_rate / 1e6:8.1f} M rule-minutes/s"
+            f"  (extrapolated from {len(baseline)} rules)"
+        )
+        print(f"speedup           {samples / vectorized_sec / loop_rate:8.0f}x")
+    print(f"firing intervals  {sum(len(result.intervals) for result in results)}")
+    if mismatches:
+        print(f"ERROR: {mismatches} of {len(baseline)} baseline rules fired differently")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    sys.exit(exit_status)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+Benchmark catalog queries - re-parsing the YAML vs a cold and a warm catalog index
+
+For every query three timings are reported:
+
+    reparse  parse every catalog file and filter in Python (what grepping / ad hoc scripts do)
+    cold     build the index from scratch, then query it
+    warm     refresh an up to date index (stats the files only), then query it
+
+Queries run against a copy of the catalog in a temporary directory. --copies N copies each catalog file N times to
+measure a larger catalog.
+
+Sample usage
+
+python benchmarks/bench_catalog_index.py
+python benchmarks/bench_catalog_index.py --copies 20 --repeat 50
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import logging
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+# pylint: disable=wrong-import-position
+from last9_catalog import DEFAULT_CATALOG_DIR, THRESHOLD_KEYS, CatalogIndex, extract_metrics, referenced_indicators
+from last9_yaml import load_yaml_file
+
+QUERIES = {
+    "rules on metric": {"metric": "kafka_consumergroup_lag"},
+    "breach rules, bad_minutes >= 8": {"severity": "breach", "min_bad_minutes": 8},
+    "entities by type": {"entity_type": "infra-alerts"},
+}
+
+
+def load_args():
+    """Parse cli"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--catalog-dir", help="Alert catalog directory", default=DEFAULT_CATALOG_DIR)
+    parser.add_argument("--copies", type=int, help="Copies of each catalog file to benchmark against", default=1)
+    parser.add_argument("--repeat", type=int, help="Runs per query and mode", default=20)
+    return vars(parser.parse_args(sys.argv[1:]))
+
+
+def reparse_query(catalog_dir, metric=None, severity=None, min_bad_minutes=None, entity_type=None):
+    """Answer a query by parsing every catalog file - the baseline without an index"""
+    results = []
+    for file_name in sorted(os.listdir(catalog_dir)):
+        if not file_name.endswith(".yaml"):
+            continue
+        try:
+            catalog_ds = load_yaml_file(os.path.join(catalog_dir, file_name))
+        except Exception:  # pylint: disable=broad-except
+            continue
+        for entity in (catalog_ds or {}).get("entities") or []:
+            if entity_type is not None:
+                if entity.get("type") == entity_type:
+                    results.append(entity)
+                continue
+
+            indicators = {indicator.get("name"): indicator for indicator in entity.get("indicators") or []}
+            for rule in entity.get("alert_rules") or []:
+                if severity is not None and rule.get("severity") != severity:
+                    continue
+                if min_bad_minutes is not None and (rule.get("bad_minutes") or 0) < min_bad_minutes:
+                    continue
+                if not any(key in rule for key in THRESHOLD_KEYS):
+                    continue
+                if metric is not None and not any(
+                    metric in extract_metrics(str(indicators[name].get("query") or ""))
+                    for name in referenced_indicators(rule, indicators)
+                ):
+                    continue
+                results.append(rule)
+    return results
+
+
+def index_query(index, entity_type=None, **filters):
+    """Answer a query from the index"""
+    if entity_type is not None:
+        return index.query_entities(entity_type=entity_type)
+    return index.query_rules(**filters)
+
+
+def timed(func, repeat):
+    """Median and max wall time of func in ms, and its last result"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(1000 * (time.perf_counter() - start))
+    return statistics.median(timings), max(timings), result
+
+
+def copy_catalog(catalog_dir, target_dir, copies):
+    """Copy each catalog file copies times into target_dir"""
+    for file_name in os.listdir(catalog_dir):
+        if not file_name.endswith(".yaml"):
+            continue
+        stem = file_name[: -len(".yaml")]
+        for copy_index in range(copies):
+            target_name = file_name if copy_index == 0 else f"{stem}_{copy_index}.yaml"
+            shutil.copyfile(os.path.join(catalog_dir, file_name), os.path.join(target_dir, target_name))
+
+
+def run_benchmark(catalog_dir, repeat):
+    """Time every query in every mode"""
+    cold_index_file = os.path.join(catalog_dir, "cold-index.sqlite")
+
+    def cold(filters):
+        if os.path.exists(cold_index_file):
+            os.remove(cold_index_file)
+        with CatalogIndex(catalog_dir, cold_index_file) as index:
+            index.refresh()
+            return index_query(index, **filters)
+
+    results = []
+    with CatalogIndex(catalog_dir, os.path.join(catalog_dir, "warm-index.sqlite")) as warm_index:
+        for name, filters in QUERIES.items():
+            reparse = timed(lambda: reparse_query(catalog_dir, **filters), repeat)
+            cold_run = timed(lambda: cold(filters), repeat)
+            warm_index.refresh()
+            warm = timed(lambda: (warm_index.refresh(), index_query(warm_index, **filters))[1], repeat)
+            if not len(reparse[2]) == len(cold_run[2]) == len(warm[2]):
+                logging.error(
+                    "%s: row counts differ - reparse=%d cold=%d warm=%d",
+                    name,
+                    len(reparse[2]),
+                    len(cold_run[2]),
+                    len(warm[2]),
+                )
+            results.append((name, len(warm[2]), reparse, cold_run, warm))
+    return results
+
+
+def print_results(results):
+    """Print the timings table"""
+    print(f"{'query':32} {'rows':>5} {'reparse ms':>16} {'cold ms':>16} {'warm ms':>16} {'speedup':>8}")
+    for name, rows, reparse, cold, warm in results:
+        cells = [f"{median:7.2f} ({worst:6.2f})" for median, worst, _ in (reparse, cold, warm)]
+        print(f"{name:32} {rows:5d} {cells[0]:>16} {cells[1]:>16} {cells[2]:>16} {reparse[0] / warm[0]:7.0f}x")
+    print("median (max) of each mode, speedup is reparse / warm")
+
+
+def main():
+    """Main function"""
+    args = load_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    with tempfile.TemporaryDirectory(prefix="bench-catalog-") as catalog_dir:
+        copy_catalog(args["catalog_dir"], catalog_dir, args["copies"])
+        file_count = len([name for name in os.listdir(catalog_dir) if name.endswith(".yaml")])
+        print(f"{file_count} catalog files, {args['repeat']} runs per query and mode")
+        print_results(run_benchmark(catalog_dir, args["repeat"]))
+    return 0
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    sys.exit(exit_status)
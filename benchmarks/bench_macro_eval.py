@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the NumPy macro evaluator - throughput in series x points per second
+
+Evaluates the window kernels and every macro in --macros over --series synthetic random walks of --days of 1 minute
+points, with gaps. The rolling median and EWMA kernels are also computed with a per-point Python loop over the first
+--baseline-series series, checked against the vectorized results and timed for comparison.
+
+Sample usage
+
+python benchmarks/bench_macro_eval.py
+python benchmarks/bench_macro_eval.py --series 500 --days 30 --macros high_spike,changepoint
+"""
+
+import os
+import sys
+import time
+import argparse
+import logging
+import statistics
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+# pylint: disable=wrong-import-position
+from last9_macro_eval import MacroEvaluator, rolling_average, rolling_median, smooth_exponential
+from last9_macros import DEFAULT_MACROS_FILE, load_macros
+
+DEFAULT_MACROS = "low_value,high_value,high_spike,low_spike,changepoint,high_changepoint,explain_high_spike"
+WINDOW_STEPS = 60
+EWMA_FACTOR = 0.9
+
+
+def load_args():
+    """Parse cli"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--macros-file", help="Macros file", default=DEFAULT_MACROS_FILE)
+    parser.add_argument("--macros", help="Comma separated macros to time", default=DEFAULT_MACROS)
+    parser.add_argument("--series", type=int, help="Number of series", default=100)
+    parser.add_argument("--days", type=int, help="Days of 1 minute points per series", default=7)
+    parser.add_argument("--repeat", type=int, help="Runs per macro", default=3)
+    parser.add_argument("--baseline-series", type=int, help="Series also evaluated point by point", default=2)
+    parser.add_argument("--seed", type=int, help="Random seed", default=7)
+    return vars(parser.parse_args(sys.argv[1:]))
+
+
+def random_series(series_count, points, rng):
+    """series_count random walks with spikes and 1% missing points"""
+    values = 100 + np.cumsum(rng.normal(0, 1, (series_count, points)), axis=1)
+    spikes = rng.random((series_count, points)) < 0.001
+    values[spikes] *= 1.5
+    values[rng.random((series_count, points)) < 0.01] = np.nan
+    return values
+
+
+def loop_median(values, steps):
+    """Rolling median point by point - the baseline"""
+    result = np.full(values.shape, np.nan)
+    for row in range(values.shape[0]):
+        for column in range(values.shape[1]):
+            window = values[row, max(0, column - steps + 1) : column + 1]
+            window = window[~np.isnan(window)]
+            if window.size:
+                result[row, column] = np.median(window)
+    return result
+
+
+def loop_ewma(values, factor):
+    """EWMA point by point - the baseline"""
+    result = np.full(values.shape, np.nan)
+    for row in range(values.shape[0]):
+        state = None
+        for column, value in enumerate(values[row].tolist()):
+            if value != value:
+                continue
+            state = value if state is None else state + factor * (value - state)
+            result[row, column] = state
+    return result
+
+
+def timed(func, repeat):
+    """Median wall time of func in seconds, and its last result"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+
+def main():
+    """Main function"""
+    args = load_args()
+    logging.basicConfig(level=logging.ERROR)
+    rng = np.random.default_rng(args["seed"])
+    values = random_series(args["series"], args["days"] * 24 * 60, rng)
+    evaluator = MacroEvaluator(load_macros(args["macros_file"]))
+    print(
+        f"{values.shape[0]} series x {values.shape[1]} points ({args['days']} days), median of {args['repeat']} runs"
+    )
+    print(f"{'workload':24} {'seconds':>9} {'M points/s':>11}")
+
+    def report(name, seconds):
+        print(f"{name:24} {seconds:9.3f} {values.size / seconds / 1e6:11.2f}")
+
+    workloads = {
+        "median_over_time[1h]": lambda: rolling_median(values, WINDOW_STEPS),
+        "avg_over_time[1h]": lambda: rolling_average(values, WINDOW_STEPS),
+        f"smooth_exponential {EWMA_FACTOR}": lambda: smooth_exponential(values, EWMA_FACTOR),
+    }
+    kernel_results = {}
+    for name, func in workloads.items():
+        seconds, kernel_results[name] = timed(func, args["repeat"])
+        report(name, seconds)
+    for name in args["macros"].split(","):
+        seconds, _ = timed(lambda: evaluator.evaluate_macro(name, [9.0, values]), args["repeat"])
+        report(f"{name}(9)", seconds)
+
+    status = 0
+    baseline = values[: args["baseline_series"]]
+    if baseline.size:
+        print(f"point by point baseline over {baseline.shape[0]} series")
+        for name, loop in (
+            ("median_over_time[1h]", lambda: loop_median(baseline, WINDOW_STEPS)),
+            (f"smooth_exponential {EWMA_FACTOR}", lambda: loop_ewma(baseline, EWMA_FACTOR)),
+        ):
+            seconds, expected = timed(loop, 1)
+            print(f"{name:24} {seconds:9.3f} {baseline.size / seconds / 1e6:11.2f}")
+            if not np.allclose(kernel_results[name][: baseline.shape[0]], expected, equal_nan=True, rtol=1e-9):
+                print(f"ERROR: {name} differs from the point by point baseline")
+                status = 1
+    return status
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    sys.exit(exit_status)
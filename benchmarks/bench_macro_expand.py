@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""
+Benchmark macro expansion - expanding the whole catalog repeatedly with and without the expansion cache
+
+The workload is every macro call of the alert catalog plus, scaled by --entities, synthetic entities calling every
+macro of macros.txt on their own indicator - the same shape as a catalog where many entities use the same alert
+templates. Two timings are reported:
+
+    uncached  a new MacroExpander per round, every call is expanded from scratch
+    cached    one MacroExpander for all rounds, repeated (macro, args) are cache hits
+
+Sample usage
+
+python benchmarks/bench_macro_expand.py
+python benchmarks/bench_macro_expand.py --entities 200 --rounds 10
+"""
+
+import os
+import sys
+import time
+import argparse
+import logging
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+# pylint: disable=wrong-import-position
+from expand_macros import expand_catalog
+from last9_catalog import DEFAULT_CATALOG_DIR
+from last9_macros import DEFAULT_MACROS_FILE, MacroExpander, load_macros
+
+# Sample arguments by macro parameter name, anything else is treated as the metric
+SAMPLE_ARGS = {
+    "tolerance": "3",
+    "per": "5",
+    "sensitivity": "3",
+    "degradation_percent": "0.2",
+    "absolute_value": "10",
+    "absolute_percent": "5",
+    "std_factor": "3",
+    "percentile": "0.9",
+    "threshold": "0.5",
+    "event_threshold": "10",
+    "normal_threshold": "5",
+    "window": "5m",
+    "wait_duration": "5m",
+    "t": "2",
+    "dmin": "100",
+    "metric_filter": 'service="checkout"',
+    "good_codes": 'code=~"2.."',
+    "all_codes": 'code=~".*"',
+}
+
+
+def load_args():
+    """Parse cli"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--catalog-dir", help="Alert catalog directory", default=DEFAULT_CATALOG_DIR)
+    parser.add_argument("--macros-file", help="Macros file", default=DEFAULT_MACROS_FILE)
+    parser.add_argument("--entities", type=int, help="Synthetic entities calling every macro", default=50)
+    parser.add_argument("--rounds", type=int, help="Expansions of the whole workload per mode", default=5)
+    return vars(parser.parse_args(sys.argv[1:]))
+
+
+def synthetic_calls(macros, entity_count):
+    """(expression, indicator queries) of synthetic entities calling every macro on their indicator
+
+    Entities come in pairs monitoring the same service so that half of the calls repeat an earlier one.
+    """
+    calls = []
+    for entity_index in range(entity_count):
+        service = f"svc-{entity_index // 2}"
+        queries = {"Latency": f'sum by (service) (rate(http_request_duration_seconds_sum{{service="{service}"}}[1m]))'}
+        for macro in macros.values():
+            args = [SAMPLE_ARGS.get(param, "Latency") for param in macro.params]
+            calls.append((f"{macro.name}({', '.join(args)})", queries))
+    return calls
+
+
+def expand_round(expander, catalog_dir, calls):
+    """Expand the catalog and the synthetic calls once - returns the number of expansions"""
+    rows, _ = expand_catalog(expander, catalog_dir)
+    for expression, queries in calls:
+        expander.expand(expression, resolve=queries.get)
+    return len(rows) + len(calls)
+
+
+def timed_rounds(func, rounds):
+    """Wall time of each round in ms, and the last result"""
+    timings = []
+    result = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = func()
+        timings.append(1000 * (time.perf_counter() - start))
+    return timings, result
+
+
+def main():
+    """Main function"""
+    args = load_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    start = time.perf_counter()
+    macros = load_macros(args["macros_file"])
+    parse_ms = 1000 * (time.perf_counter() - start)
+    calls = synthetic_calls(macros, args["entities"])
+
+    uncached, expansions = timed_rounds(
+        lambda: expand_round(MacroExpander(macros), args["catalog_dir"], calls), args["rounds"]
+    )
+    cached_expander = MacroExpander(macros)
+    cached, _ = timed_rounds(lambda: expand_round(cached_expander, args["catalog_dir"], calls), args["rounds"])
+
+    print(f"{len(macros)} macros parsed in {parse_ms:.1f} ms, {expansions} macro calls per round")
+    print(f"{'mode':10} {'first ms':>10} {'median ms':>10} {'calls/s':>10}")
+    for name, timings in (("uncached", uncached), ("cached", cached)):
+        median = statistics.median(timings)
+        print(f"{name:10} {timings[0]:10.1f} {median:10.1f} {expansions / median * 1000:10.0f}")
+    total = cached_expander.hits + cached_expander.misses
+    print(
+        f"cache: {len(cached_expander.cache)} entries, {cached_expander.hits / total:.1%} hit rate over {total} calls"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    sys.exit(exit_status)
@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the IaC toolchain end to end against local stand-ins, and compare with a stored baseline
+
+For every scale (number of alert entities, default 10, 1000 and 10000) synthetic inputs are generated in a temporary
+directory and each workload runs the real script as a subprocess:
+
+    fetch             fetch-alerts.py --incremental into an empty directory, against a Last9 API stub (see stubs.py)
+    fetch_unchanged   the same fetch again - every entity unchanged
+    fetch_pages       fetch-alerts.py against a stub paginating by page number only, with a default page size below
+                      --page-size - fails unless every entity is written
+    fetch_hydrate     fetch-alerts.py against a stub listing entity summaries, fetching every entity's details
+                      concurrently from a detail endpoint answering after DETAIL_LATENCY_MS
+    render_manifest   patch_template.py --manifest rendering an alert template for each of <scale> TOML sections
+    render_dashboard  patch_template.py --output-file streaming a dashboard template with <scale> panels
+    iac_apply         run_iac_files.py --action apply over the entities split into files of --entities-per-file, with
+                      a fake l9iac and moto's S3 as the backup bucket
+    iac_unchanged     the same apply again - every file unchanged since the last apply
+
+Each workload records its wall time, the peak RSS of its largest process and the requests served by the stand-in.
+With --repeat N every scale runs N times from fresh inputs and the median wall time is kept.
+
+Results are compared with --baseline (benchmarks/baseline.json). A workload regresses when its wall time or peak RSS
+grows by more than --tolerance (and by more than a small absolute margin, to ignore noise on tiny workloads) or when
+it makes more requests. Regressions make the run exit with status 1. No baseline ships with the repo - numbers are
+only comparable on the same machine, record one there with --update-baseline.
+
+iac_apply / iac_unchanged need moto[server] (pip install 'moto[server]') and are skipped without it.
+
+Sample usage
+
+python benchmarks/bench_pipeline.py --scales 10,1000 --update-baseline
+python benchmarks/bench_pipeline.py --scales 10,1000
+python benchmarks/bench_pipeline.py --workloads fetch,fetch_unchanged --repeat 3 --output /tmp/bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import logging
+import platform
+import resource
+import tempfile
+import statistics
+import subprocess
+
+from stubs import ORG, StubProcess, synthetic_entity, write_fake_l9iac
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+sys.path.insert(0, SCRIPTS_DIR)
+
+# pylint: disable=wrong-import-position
+from last9_yaml import dump_yaml
+
+WORKLOADS = (
+    "fetch",
+    "fetch_unchanged",
+    "fetch_pages",
+    "fetch_hydrate",
+    "render_manifest",
+    "render_dashboard",
+    "iac_apply",
+    "iac_unchanged",
+)
+DEFAULT_BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+BUCKET = "last9-iac-bench"
+
+# Changes below these are noise whatever the relative change
+MIN_WALL_DELTA_SEC = 0.1
+MIN_RSS_DELTA_MB = 5
+
+# Latency of the stub's entity detail endpoint - a round trip to the API rather than to localhost
+DETAIL_LATENCY_MS = 10
+
+ALERT_TEMPLATE = """entities:
+  - name: ${cluster} health
+    type: infra-alerts
+    external_ref: ${cluster}-health
+    data_source: ${data_source}
+    indicators:
+      - name: Scrape errors
+        query: sum(rate(vm_promscrape_scrapes_failed_total{cluster="${cluster}"}[5m]))
+      - name: Dropped samples
+        query: sum(rate(vmagent_remotewrite_samples_dropped_total{cluster="${cluster}"}[5m]))
+    alert_rules:
+      - name: Scrape errors high
+        indicator: Scrape errors
+        greater_than: ${scrape_error_threshold}
+        bad_minutes: 5
+        total_minutes: 10
+      - name: Samples dropped
+        indicator: Dropped samples
+        greater_than: 0
+        bad_minutes: 3
+        total_minutes: 5
+"""
+
+DASHBOARD_PANEL = {
+    "type": "timeseries",
+    "datasource": {"type": "prometheus", "uid": "${datasource_uid}"},
+    "targets": [
+        {
+            "expr": 'sum by (job) (rate(vm_promscrape_scrapes_total{cluster="${cluster}",job="job-%d"}'
+            "[$$__rate_interval]))",
+            "legendFormat": "{{job}}",
+        }
+    ],
+}
+
+
+def load_args():
+    """Parse cli"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", help="Comma separated entity counts", default="10,1000,10000")
+    parser.add_argument("--workloads", help=f"Comma separated workloads of {','.join(WORKLOADS)}", default="all")
+    parser.add_argument("--entities-per-file", type=int, help="Entities per IaC file for iac_*", default=10)
+    parser.add_argument("--iac-workers", type=int, help="run_iac_files.py --workers", default=4)
+    parser.add_argument("--repeat", type=int, help="Runs of every scale, the median wall time is kept", default=1)
+    parser.add_argument("--baseline", help="Baseline results file", default=DEFAULT_BASELINE_FILE)
+    parser.add_argument("--update-baseline", action="store_true", help="Store these results as the baseline")
+    parser.add_argument("--tolerance", type=float, help="Allowed relative growth before a regression", default=0.25)
+    parser.add_argument("--output", help="Also write the results to this JSON file", default=None)
+    parser.add_argument("--keep-workdir", action="store_true", help="Keep the generated inputs and outputs")
+    parser.add_argument("--log-level", help="Log level", default=os.environ.get("LOG_LEVEL", "INFO"))
+    return vars(parser.parse_args(sys.argv[1:]))
+
+
+def validate_args(args):
+    """Validate input args"""
+    try:
+        args["scales"] = [int(scale) for scale in args["scales"].split(",") if scale.strip()]
+    except ValueError:
+        logging.error("scales=%s must be comma separated integers", args["scales"])
+        return False
+    if not args["scales"] or min(args["scales"]) < 1:
+        logging.error("scales=%s must be positive", args["scales"])
+        return False
+
+    workloads = WORKLOADS if args["workloads"] == "all" else args["workloads"].split(",")
+    unknown = sorted(set(workloads) - set(WORKLOADS))
+    if unknown:
+        logging.error("Unknown workloads %s - valid workloads are %s", unknown, ",".join(WORKLOADS))
+        return False
+    args["workloads"] = [workload for workload in WORKLOADS if workload in workloads]
+
+    if "iac_unchanged" in args["workloads"] and "iac_apply" not in args["workloads"]:
+        # iac_unchanged re-runs the apply, it needs the state iac_apply leaves behind
+        args["workloads"].insert(args["workloads"].index("iac_unchanged"), "iac_apply")
+    if "fetch_unchanged" in args["workloads"] and "fetch" not in args["workloads"]:
+        args["workloads"].insert(0, "fetch")
+
+    if args["entities_per_file"] < 1 or args["iac_workers"] < 1 or args["repeat"] < 1:
+        logging.error("entities_per_file, iac_workers and repeat must be at least 1")
+        return False
+    return True
+
+
+def run_measured(cmd, cwd, env, log_file):
+    """Run cmd, output to log_file - returns (exit status, wall seconds, peak RSS in MB of its largest process)"""
+    with open(log_file, "a", encoding="utf-8") as log_fd:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=log_fd, stderr=subprocess.STDOUT)
+        # wait4 rather than proc.wait() - it returns the child's resource usage, including its waited for children
+        _, wait_status, rusage = os.wait4(proc.pid, 0)
+        wall_sec = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(wait_status)
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    max_rss_mb = rusage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return proc.returncode, wall_sec, max_rss_mb
+
+
+def script_cmd(script, *args):
+    """Command running one of the scripts with this interpreter"""
+    return [sys.executable, os.path.join(SCRIPTS_DIR, script)] + [str(arg) for arg in args]
+
+
+def write_render_inputs(workdir, scale):
+    """Alert template, vars file with scale sections, render manifest and a dashboard template with scale panels"""
+    render_dir = os.path.join(workdir, "render")
+    os.makedirs(render_dir, exist_ok=True)
+
+    alert_template = os.path.join(render_dir, "health.yaml")
+    with open(alert_template, "w", encoding="utf-8") as output_fd:
+        output_fd.write(ALERT_TEMPLATE)
+
+    vars_lines, manifest_lines = [], []
+    for index in range(scale):
+        section = f"cluster-{index:05d}"
+        vars_lines += [
+            f'["{section}"]',
+            f'cluster = "{section}"',
+            f'data_source = "prometheus-{index % 5}"',
+            f"scrape_error_threshold = {index % 7 + 1}",
+            "",
+        ]
+        manifest_lines += [
+            "[[render]]",
+            f'tmpl_file = "{alert_template}"',
+            f'tmpl_vars_file = "{os.path.join(render_dir, "vars.toml")}"',
+            f'tmpl_vars_file_section = "{section}"',
+            f'output_file = "{os.path.join(render_dir, "out", section, "health.yaml")}"',
+            "",
+        ]
+    vars_lines += ["[grafana_dashboards]", 'cluster = "bench"', 'datasource_uid = "bench-uid"', ""]
+    with open(os.path.join(render_dir, "vars.toml"), "w", encoding="utf-8") as output_fd:
+        output_fd.write("\n".join(vars_lines))
+    with open(os.path.join(render_dir, "manifest.toml"), "w", encoding="utf-8") as output_fd:
+        output_fd.write("\n".join(manifest_lines))
+
+    panels = []
+    for index in range(scale):
+        panel = json.loads(json.dumps(DASHBOARD_PANEL))
+        panel["id"] = index + 1
+        panel["title"] = f"Scrapes of job-{index}"
+        panel["gridPos"] = {"h": 8, "w": 12, "x": 12 * (index % 2), "y": 8 * (index // 2)}
+        panel["targets"][0]["expr"] = panel["targets"][0]["expr"] % index
+        panels.append(panel)
+    dashboard = {"dashboard": {"title": "${cluster} scrapes", "tags": ["last9_managed"], "panels": panels}}
+    with open(os.path.join(render_dir, "dashboard.json"), "w", encoding="utf-8") as output_fd:
+        json.dump(dashboard, output_fd, indent=2)
+    return render_dir
+
+
+def write_iac_inputs(workdir, scale, entities_per_file):
+    """IaC files of scale synthetic entities, the list of them and an iac config - paths relative to workdir"""
+    alerts_dir = os.path.join("workspace", "alerts", "bench")
+    os.makedirs(os.path.join(workdir, alerts_dir), exist_ok=True)
+    input_files = []
+    for start in range(0, scale, entities_per_file):
+        input_file = os.path.join(alerts_dir, f"bench-{start // entities_per_file:05d}.yaml")
+        entities = [synthetic_entity(index) for index in range(start, min(start + entities_per_file, scale))]
+        with open(os.path.join(workdir, input_file), "w", encoding="utf-8") as output_fd:
+            output_fd.write(dump_yaml({"entities": entities}))
+        input_files.append(input_file)
+
+    with open(os.path.join(workdir, "iac_target_files.txt"), "w", encoding="utf-8") as output_fd:
+        output_fd.write("\n".join(input_files) + "\n")
+    with open(os.path.join(workdir, "iac-config.json"), "w", encoding="utf-8") as output_fd:
+        # The fake l9iac ignores the API config, run_iac_files.py only validates it
+        api_config = {"refresh_token": "bench", "api_base_url": "http://127.0.0.1:9", "org": ORG}
+        json.dump({"api_config": {"write": api_config}, "state_lock_file_path": "alerting-iac-state.lock"}, output_fd)
+    return len(input_files)
+
+
+def run_scale(args, scale, workdir, s3_stub):
+    """Run every workload at one scale - returns {workload: result dict}"""
+    env = dict(os.environ, LOG_LEVEL="WARNING", LAST9_TOKEN_CACHE="0", LAST9_CACHE_DIR=workdir)
+    # The scripts must not pick up instrumentation or caches of the machine running the benchmark
+    for key in ("LAST9_IAC_METRICS_DIR", "LAST9_IAC_TRACE_DIR", "LAST9_API_CONFIG_STR"):
+        env.pop(key, None)
+    log_file = os.path.join(workdir, "bench.log")
+    results = {}
+
+    def _measure(workload, cmd, stub, cwd=workdir, run_env=env):
+        if stub is not None:
+            stub.reset()
+        exit_status, wall_sec, max_rss_mb = run_measured(cmd, cwd, run_env, log_file)
+        results[workload] = {
+            "wall_sec": round(wall_sec, 4),
+            "max_rss_mb": round(max_rss_mb, 1),
+            "requests": stub.request_count() if stub is not None else 0,
+            "failed": exit_status != 0,
+        }
+        if exit_status != 0:
+            logging.error("%s@%d failed with exit status %d - see %s", workload, scale, exit_status, log_file)
+
+    def _fetch_cmd(api, output_dir, *fetch_args):
+        return script_cmd(
+            "fetch-alerts.py",
+            "--config-file",
+            os.path.join(workdir, "no-config.json"),
+            "--api-base-url",
+            api.url,
+            "--org",
+            ORG,
+            "--read-refresh-token",
+            "bench-refresh-token",
+            "--output-dir",
+            os.path.join(workdir, output_dir),
+            *fetch_args,
+        )
+
+    fetch_workloads = [workload for workload in args["workloads"] if workload in ("fetch", "fetch_unchanged")]
+    if fetch_workloads:
+        with StubProcess("last9", "--entities", scale) as api:
+            cmd = _fetch_cmd(api, "fetched", "--incremental")
+            for workload in fetch_workloads:
+                _measure(workload, cmd, api)
+
+    if "fetch_pages" in args["workloads"]:
+        with StubProcess("last9", "--entities", scale, "--pagination", "page") as api:
+            _measure("fetch_pages", _fetch_cmd(api, "paged"), api)
+        written = len([name for name in os.listdir(os.path.join(workdir, "paged")) if name.endswith(".yaml")])
+        if written != scale:
+            logging.error("fetch_pages@%d wrote %d of %d alerts", scale, written, scale)
+            results["fetch_pages"]["failed"] = True
+
+    if "fetch_hydrate" in args["workloads"]:
+        with StubProcess("last9", "--entities", scale, "--summaries", "--detail-latency-ms", DETAIL_LATENCY_MS) as api:
+            # No rate limit - the benchmark measures the concurrency, not the configured request rate
+            _measure("fetch_hydrate", _fetch_cmd(api, "hydrated", "--hydrate-rate", "0"), api)
+
+    if any(workload.startswith("render") for workload in args["workloads"]):
+        render_dir = write_render_inputs(workdir, scale)
+        if "render_manifest" in args["workloads"]:
+            _measure(
+                "render_manifest", script_cmd("patch_template.py", "--manifest", f"{render_dir}/manifest.toml"), None
+            )
+        if "render_dashboard" in args["workloads"]:
+            cmd = script_cmd(
+                "patch_template.py",
+                "--tmpl-file",
+                f"{render_dir}/dashboard.json",
+                "--tmpl-vars-file",
+                f"{render_dir}/vars.toml",
+                "--tmpl-vars-file-section",
+                "grafana_dashboards",
+                "--output-file",
+                f"{render_dir}/out/dashboard.json",
+            )
+            _measure("render_dashboard", cmd, None)
+
+    iac_workloads = [workload for workload in args["workloads"] if workload.startswith("iac")]
+    if iac_workloads and s3_stub is not None:
+        write_iac_inputs(workdir, scale, args["entities_per_file"])
+        bin_dir = os.path.join(workdir, "bin")
+        write_fake_l9iac(bin_dir)
+        prefix = f"scale-{scale}-{os.path.basename(workdir)}"
+        iac_env = dict(
+            env,
+            PATH=bin_dir + os.pathsep + env.get("PATH", ""),
+            LAST9_S3_ENDPOINT_URL=s3_stub.url,
+            AWS_ACCESS_KEY_ID="bench",
+            AWS_SECRET_ACCESS_KEY="bench",
+            AWS_DEFAULT_REGION="us-east-1",
+        )
+        cmd = script_cmd(
+            "run_iac_files.py",
+            "--action",
+            "apply",
+            "--input-files-list",
+            "iac_target_files.txt",
+            "--iac-config-file",
+            "iac-config.json",
+            "--backup-s3-bucket",
+            f"s3://{BUCKET}/{prefix}",
+            "--workers",
+            args["iac_workers"],
+        )
+        for workload in iac_workloads:
+            _measure(workload, cmd, s3_stub, run_env=iac_env)
+    return results
+
+
+def run_suite(args):
+    """{"<workload>@<scale>": result} over all scales, the median of --repeat runs"""
+    s3_stub = None
+    if any(workload.startswith("iac") for workload in args["workloads"]):
+        try:
+            s3_stub = StubProcess("s3", "--bucket", BUCKET).start()
+        except RuntimeError as ex:
+            logging.warning(
+                "Skipping iac workloads - failed to start the S3 stand-in, is moto[server] installed? - %s", ex
+            )
+
+    results = {}
+    try:
+        for scale in args["scales"]:
+            rounds = []
+            for _ in range(args["repeat"]):
+                workdir = tempfile.mkdtemp(prefix=f"last9-bench-{scale}-")
+                try:
+                    rounds.append(run_scale(args, scale, workdir, s3_stub))
+                finally:
+                    if args["keep_workdir"]:
+                        logging.info("Kept inputs and outputs of scale %d in %s", scale, workdir)
+                    else:
+                        shutil.rmtree(workdir, ignore_errors=True)
+            for workload in rounds[0]:
+                runs = [run[workload] for run in rounds]
+                results[f"{workload}@{scale}"] = {
+                    "wall_sec": round(statistics.median(run["wall_sec"] for run in runs), 4),
+                    "max_rss_mb": max(run["max_rss_mb"] for run in runs),
+                    "requests": runs[-1]["requests"],
+                    "failed": any(run["failed"] for run in runs),
+                }
+                logging.info("%s@%d done - %s", workload, scale, results[f"{workload}@{scale}"])
+    finally:
+        if s3_stub is not None:
+            s3_stub.stop()
+    return results
+
+
+def environment():
+    """Where the results were measured - baselines only compare on the same machine"""
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def compare(args, results, baseline):
+    """Rows of (name, result, baseline result, [regressions])"""
+    rows = []
+    for name, result in results.items():
+        base = baseline.get("results", {}).get(name)
+        regressions = []
+        if result["failed"]:
+            regressions.append("failed")
+        if base is not None:
+            for key, min_delta in (("wall_sec", MIN_WALL_DELTA_SEC), ("max_rss_mb", MIN_RSS_DELTA_MB)):
+                delta = result[key] - base[key]
+                if delta > min_delta and result[key] > base[key] * (1 + args["tolerance"]):
+                    regressions.append(key)
+            if result["requests"] > base["requests"]:
+                regressions.append("requests")
+        rows.append((name, result, base, regressions))
+    return rows
+
+
+def _change(value, base_value):
+    if not base_value:
+        return ""
+    return f"{(value - base_value) / base_value:+.0%}"
+
+
+def print_report(rows):
+    """Print results next to the baseline"""
+    print(
+        f"{'workload':28} {'wall s':>9} {'vs base':>8} {'rss MB':>8} {'vs base':>8} {'requests':>9} {'vs base':>8}"
+        "  status"
+    )
+    for name, result, base, regressions in rows:
+        base = base or {}
+        print(
+            f"{name:28} {result['wall_sec']:9.3f} {_change(result['wall_sec'], base.get('wall_sec')):>8} "
+            f"{result['max_rss_mb']:8.1f} {_change(result['max_rss_mb'], base.get('max_rss_mb')):>8} "
+            f"{result['requests']:9d} {_change(result['requests'], base.get('requests')):>8}  "
+            + ("REGRESSED " + ",".join(regressions) if regressions else ("ok" if base else "no baseline"))
+        )
+
+
+def load_baseline(baseline_file):
+    """Stored baseline, empty if there is none"""
+    if not os.path.exists(baseline_file):
+        return {}
+    with open(baseline_file, "r", encoding="utf-8") as input_fd:
+        return json.load(input_fd)
+
+
+def setup_logging(log_level):
+    """Setup logging"""
+    log_level = getattr(logging, log_level.upper())
+    logging.basicConfig(
+        level=log_level, format="%(asctime)s.%(msecs)03d %(levelname)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    return True
+
+
+def main():
+    """Main function"""
+    args = load_args()
+
+    if not setup_logging(args["log_level"]):
+        return 1
+
+    if not validate_args(args):
+        return 1
+
+    baseline = load_baseline(args["baseline"])
+    if not baseline:
+        logging.warning("No baseline at %s - record one with --update-baseline", args["baseline"])
+    elif baseline.get("environment") != environment():
+        logging.warning("Baseline was measured on %s - results may not compare", baseline.get("environment"))
+
+    results = run_suite(args)
+    rows = compare(args, results, baseline)
+    print_report(rows)
+    logging.info(
+        "Peak RSS is a floor of this process' own (%.1f MB) - children inherit it across fork and exec",
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024),
+    )
+
+    output_ds = {"environment": environment(), "results": results}
+    if args["output"]:
+        with open(args["output"], "w", encoding="utf-8") as output_fd:
+            json.dump(output_ds, output_fd, indent=2)
+
+    if args["update_baseline"]:
+        if any(result["failed"] for result in results.values()):
+            logging.error("Not updating the baseline - some workloads failed")
+            return 1
+        # Keep baseline entries of scales / workloads not run this time
+        output_ds["results"] = {**baseline.get("results", {}), **results}
+        with open(args["baseline"], "w", encoding="utf-8") as output_fd:
+            json.dump(output_ds, output_fd, indent=2, sort_keys=True)
+        logging.info("Updated baseline %s", args["baseline"])
+        return 0
+
+    regressed = [name for name, _, _, regressions in rows if regressions]
+    if regressed:
+        logging.error("%d workloads regressed: %s", len(regressed), ",".join(regressed))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    sys.exit(exit_status)
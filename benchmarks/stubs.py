@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+
+"""
+Local stand-ins for the services the IaC toolchain talks to - used by bench_pipeline.py
+
+    Last9APIStub      HTTP server answering the token exchange and a cursor or page numbered entities endpoint
+                      with synthetic alert managers - or with their summaries and a detail endpoint per entity
+    S3Stub            moto's S3 behind a local HTTP server - point the scripts at it with LAST9_S3_ENDPOINT_URL
+    write_fake_l9iac  a shell script named l9iac which writes the state lock an apply would write
+
+Both servers listen on a free local port and count the requests they serve. GET /__bench__/requests returns the count
+as JSON, DELETE resets it.
+
+The benchmark runs each stand-in in a process of its own (StubProcess, which runs this file). Linux carries a
+process' peak RSS over fork and exec, so a child of a process holding moto or pages of 10k entities would report that
+process' memory as its own.
+
+Sample usage
+
+    with StubProcess("last9", "--entities", 1000) as api:
+        run fetch-alerts.py --api-base-url {api.url} ...
+    print(api.request_count())
+
+python benchmarks/stubs.py last9 --entities 1000
+python benchmarks/stubs.py last9 --entities 1000 --summaries --detail-latency-ms 50
+python benchmarks/stubs.py last9 --entities 1000 --pagination page
+python benchmarks/stubs.py s3 --bucket last9-iac-bench
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import logging
+import threading
+import subprocess
+import http.server
+import urllib.request
+from urllib.parse import parse_qs, urlparse
+
+ORG = "bench"
+COUNT_PATH = "/__bench__/requests"
+TOKEN_RESPONSE = {"access_token": "bench.access.token", "expires_in": 3600}
+# Page size of --pagination page when the request has no per_page - smaller than fetch-alerts.py's --page-size
+DEFAULT_PER_PAGE = 100
+# Fields of the entities listed with --summaries
+SUMMARY_KEYS = ("name", "entity_class", "type", "external_ref", "updated_at")
+EXTERNAL_REF_RE = re.compile(r"svc-(\d{5})-alerts")
+
+
+def synthetic_entity(index):
+    """An alert manager shaped like the ones fetch-alerts.py writes - 3 indicators and 3 alert rules"""
+    service = f"svc-{index:05d}"
+    indicators = [
+        {
+            "name": "Availability",
+            "query": f'sum(rate(http_requests_total{{service="{service}",code!~"5.."}}[1m])) / '
+            f'sum(rate(http_requests_total{{service="{service}"}}[1m])) * 100',
+            "unit": "percent",
+        },
+        {
+            "name": "Latency p99",
+            "query": "histogram_quantile(0.99, sum by (le) "
+            f'(rate(http_request_duration_seconds_bucket{{service="{service}"}}[5m])))',
+            "unit": "seconds",
+        },
+        {
+            "name": "Throughput",
+            "query": f'sum(rate(http_requests_total{{service="{service}"}}[1m]))',
+            "unit": "rpm",
+        },
+    ]
+    alert_rules = [
+        {
+            "name": f"{indicator['name']} breach",
+            "indicator": indicator["name"],
+            "less_than" if indicator["name"] == "Availability" else "greater_than": 99 if index % 2 else 1,
+            "bad_minutes": 5,
+            "total_minutes": 10,
+            "severity": "breach" if index % 3 else "threat",
+            "mute": False,
+        }
+        for indicator in indicators
+    ]
+    return {
+        "name": f"{service} alerts",
+        "entity_class": "alert-manager",
+        "type": "service-alerts",
+        "external_ref": f"{service}-alerts",
+        "data_source": "bench-prometheus",
+        "description": f"Synthetic alert manager {index}",
+        "tags": ["bench", f"team-{index % 10}"],
+        "indicators": indicators,
+        "alert_rules": alert_rules,
+        "updated_at": 1700000000 + index,
+    }
+
+
+class _QuietHTTPServer(http.server.ThreadingHTTPServer):
+    """Threaded HTTP server which does not print clients dropping their connection"""
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # fetch-alerts.py leaves its endpoint probes behind on daemon threads
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _CountingServer:
+    """Threaded HTTP server on a free local port, counting the requests it serves"""
+
+    def __init__(self):
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def count(self, method, path):
+        """Handle the count endpoint - returns (status, body) for it, None for requests to count and serve"""
+        if path != COUNT_PATH:
+            with self._lock:
+                self.requests += 1
+            return None
+        with self._lock:
+            body = json.dumps({"requests": self.requests}).encode("utf-8")
+            if method == "DELETE":
+                self.requests = 0
+        return "200 OK", body
+
+    def make_server(self):
+        """Server bound to 127.0.0.1:0"""
+        raise NotImplementedError
+
+    def setup(self, url):
+        """Called once the server listens, before its URL is handed out"""
+
+    def serve(self):
+        """Print the server URL on stdout, then serve until killed"""
+        self._server = self.make_server()
+        host, port = self._server.server_address[:2]
+        thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        thread.start()
+        self.setup(f"http://{host}:{port}")
+        print(f"http://{host}:{port}", flush=True)
+        thread.join()
+
+
+class Last9APIStub(_CountingServer):
+    """Last9 API stand-in - token exchange and the organization entities endpoint
+
+    Pages are chained by next_cursor (and also served for limit + page / per_page), or with pagination="page" only
+    numbered - page and per_page, which defaults to DEFAULT_PER_PAGE, limit is ignored - with no cursor. With summaries the entities endpoint lists entities without indicators and alert rules, which are served by
+    <entities endpoint>/<external_ref> after detail_delay_sec. Other candidate endpoints fetch-alerts.py probes
+    answer 404. Pages are rendered once and then served from memory so the stub costs little next to the client
+    being measured.
+    """
+
+    def __init__(self, entity_count, org=ORG, summaries=False, detail_delay_sec=0.0, pagination="cursor"):
+        super().__init__()
+        self.entity_count = entity_count
+        self.pagination = pagination
+        self.entities_path = f"/organizations/{org}/entities"
+        self.summaries = summaries
+        self.detail_delay_sec = detail_delay_sec
+        self._pages = {}
+
+    def page(self, offset, limit):
+        """Serialized page of entities starting at offset"""
+        key = (offset, limit)
+        if key not in self._pages:
+            end = min(offset + limit, self.entity_count)
+            entities = [synthetic_entity(index) for index in range(offset, end)]
+            if self.summaries:
+                entities = [{key: entity[key] for key in SUMMARY_KEYS} for entity in entities]
+            page_ds = {"entities": entities}
+            if end < self.entity_count and self.pagination == "cursor":
+                page_ds["next_cursor"] = str(end)
+            self._pages[key] = json.dumps(page_ds).encode("utf-8")
+        return self._pages[key]
+
+    def respond(self, method, path, query):
+        """(status code, body) of a request"""
+        counted = self.count(method, path)
+        if counted is not None:
+            return 200, counted[1]
+        if method == "POST" and path.endswith("/oauth/access_token"):
+            return 200, json.dumps(TOKEN_RESPONSE).encode("utf-8")
+        if method == "GET" and path == self.entities_path:
+            params = {key: values[0] for key, values in parse_qs(query).items()}
+            if self.pagination == "page":
+                per_page = int(params.get("per_page", DEFAULT_PER_PAGE))
+                return 200, self.page((int(params.get("page", 1)) - 1) * per_page, per_page)
+            limit = int(params.get("limit", self.entity_count)) or self.entity_count
+            if "cursor" in params:
+                offset = int(params["cursor"])
+            else:
+                offset = (int(params.get("page", 1)) - 1) * int(params.get("per_page", limit))
+            return 200, self.page(offset, limit)
+        if method == "GET" and self.summaries and path.startswith(self.entities_path + "/"):
+            match = EXTERNAL_REF_RE.fullmatch(path[len(self.entities_path) + 1 :])
+            if not match or int(match.group(1)) >= self.entity_count:
+                return 404, b"{}"
+            time.sleep(self.detail_delay_sec)
+            return 200, json.dumps(synthetic_entity(int(match.group(1)))).encode("utf-8")
+        return 404, b"{}"
+
+    def make_server(self):
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            """Handler of the stub"""
+
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in two writes - with Nagle each keep-alive response waits for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def _handle(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                parsed = urlparse(self.path)
+                status, body = stub.respond(self.command, parsed.path, parsed.query)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = do_DELETE = _handle
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        return _QuietHTTPServer(("127.0.0.1", 0), Handler)
+
+
+class S3Stub(_CountingServer):
+    """moto's S3 served over HTTP, with the given buckets created - needs moto[server]"""
+
+    def __init__(self, buckets=()):
+        super().__init__()
+        self.buckets = buckets
+
+    def setup(self, url):
+        import boto3  # pylint: disable=import-outside-toplevel
+
+        client = boto3.client(
+            "s3", endpoint_url=url, aws_access_key_id="bench", aws_secret_access_key="bench", region_name="us-east-1"
+        )
+        for bucket in self.buckets:
+            client.create_bucket(Bucket=bucket)
+
+    def make_server(self):
+        # pylint: disable=import-outside-toplevel
+        from moto.server import DomainDispatcherApplication, create_backend_app
+        from werkzeug.serving import make_server
+
+        # Request lines of every S3 call would drown the benchmark output
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        app = DomainDispatcherApplication(create_backend_app)
+
+        def counting_app(environ, start_response):
+            counted = self.count(environ["REQUEST_METHOD"], environ.get("PATH_INFO", ""))
+            if counted is None:
+                return app(environ, start_response)
+            start_response(counted[0], [("Content-Type", "application/json")])
+            return [counted[1]]
+
+        return make_server("127.0.0.1", 0, counting_app, threaded=True)
+
+
+class StubProcess:
+    """A stand-in running in a child process - python benchmarks/stubs.py <kind> [args]"""
+
+    def __init__(self, kind, *args):
+        self.cmd = [sys.executable, os.path.abspath(__file__), kind] + [str(arg) for arg in args]
+        self.url = None
+        self._proc = None
+
+    def start(self):
+        """Start the stand-in and wait until it listens - raises RuntimeError if it fails to start"""
+        self._proc = subprocess.Popen(self.cmd, stdout=subprocess.PIPE, text=True)
+        self.url = self._proc.stdout.readline().strip()
+        if not self.url:
+            self._proc.wait()
+            raise RuntimeError(f"{' '.join(self.cmd)} exited with status {self._proc.returncode}")
+        return self
+
+    def _count(self, method):
+        request = urllib.request.Request(self.url + COUNT_PATH, method=method)
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return json.load(response)["requests"]
+
+    def request_count(self):
+        """Requests served since start() or reset()"""
+        return self._count("GET")
+
+    def reset(self):
+        """Forget the requests counted so far"""
+        self._count("DELETE")
+
+    def stop(self):
+        """Stop the stand-in"""
+        self._proc.terminate()
+        self._proc.wait()
+        self._proc.stdout.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+FAKE_L9IAC = """#!/bin/sh
+# Fake l9iac for benchmarks - an apply writes the file's lock (the file name up to the first dot + .lock), as the real
+# l9iac records its state there
+action=""
+manifest_file=""
+while [ $# -gt 0 ]; do
+  case $1 in
+  -mf) manifest_file=$2; shift;;
+  plan|apply) action=$1;;
+  esac
+  shift
+done
+echo "fake l9iac action=$action file=$manifest_file"
+if [ "$action" = "apply" ]; then
+  cksum "$manifest_file" > "${manifest_file%%.*}.lock"
+fi
+"""
+
+
+def write_fake_l9iac(bin_dir):
+    """Write the fake l9iac into bin_dir - prepend bin_dir to PATH to use it"""
+    os.makedirs(bin_dir, exist_ok=True)
+    path = os.path.join(bin_dir, "l9iac")
+    with open(path, "w", encoding="utf-8") as output_fd:
+        output_fd.write(FAKE_L9IAC)
+    os.chmod(path, 0o755)
+    return path
+
+
+def load_args():
+    """Parse cli"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("kind", choices=["last9", "s3"], help="Stand-in to run")
+    parser.add_argument("--entities", type=int, help="Entities served by the last9 stand-in", default=10)
+    parser.add_argument("--summaries", action="store_true", help="List entity summaries, serve details per entity")
+    parser.add_argument("--detail-latency-ms", type=float, help="Delay of each entity detail response", default=0)
+    parser.add_argument(
+        "--pagination", choices=["cursor", "page"], help="Pagination of the entities endpoint", default="cursor"
+    )
+    parser.add_argument("--bucket", action="append", help="Bucket to create in the s3 stand-in", default=[])
+    return vars(parser.parse_args(sys.argv[1:]))
+
+
+def main():
+    """Main function"""
+    args = load_args()
+    if args["kind"] == "last9":
+        stub = Last9APIStub(
+            args["entities"],
+            summaries=args["summaries"],
+            detail_delay_sec=args["detail_latency_ms"] / 1000,
+            pagination=args["pagination"],
+        )
+    else:
+        stub = S3Stub(args["bucket"])
+    try:
+        stub.serve()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    sys.exit(exit_status)
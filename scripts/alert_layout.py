@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""
+Convert a set of alert manager files between layouts - split grouped files into one file per alert, merge per alert
+files by type or into shards, and write or restore .jsonl.gz archives
+
+    files    one <alert-name>.yaml per entity
+    by-type  one <type>.yaml per entity type
+    shards   --shards alerts-NNN-of-MMM.yaml files, an entity's shard is picked by the hash of its external_ref
+
+Inputs are alert files, directories of alert files (*.yaml / *.yml directly in them, in any layout) and archives
+written by fetch-alerts.py --archive or this script. Entities are streamed - one input file and one entity per open
+output file are held in memory. Alert files of another layout or shard count already in the output dir are removed
+once the new files are written, so the directory never holds an entity twice.
+
+Sample usage
+
+python scripts/alert_layout.py --input ../acme-alerts --output-dir ../acme-alerts-by-type --output-format by-type
+python scripts/alert_layout.py --input ../acme-alerts-by-type --output-dir ../acme-alerts --output-format files
+python scripts/alert_layout.py --input ../acme-alerts --archive acme-alerts.jsonl.gz
+python scripts/alert_layout.py --input acme-alerts.jsonl.gz --output-dir ../acme-alerts --output-format shards
+"""
+
+import os
+import sys
+import argparse
+import logging
+
+from last9_layout import ARCHIVE_SUFFIX, DEFAULT_SHARDS, OUTPUT_FORMATS, ArchiveWriter, LayoutWriter, iter_entities
+
+
+def load_args():
+    """Parse cli"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input",
+        action="append",
+        help="Alert file, directory of alert files or archive - repeat for several",
+        required=True,
+    )
+    parser.add_argument("--output-dir", help="Directory to write the alert files to", default=None)
+    parser.add_argument("--output-format", help="Layout of the output dir", choices=OUTPUT_FORMATS, default="files")
+    parser.add_argument("--shards", type=int, help="Number of files of the shards layout", default=DEFAULT_SHARDS)
+    parser.add_argument("--archive", help=f"Also write the entities to this {ARCHIVE_SUFFIX} archive", default=None)
+    parser.add_argument("--log-level", help="Log level", default=os.environ.get("LOG_LEVEL", "INFO"))
+    return vars(parser.parse_args(sys.argv[1:]))
+
+
+def validate_args(args):
+    """Validate input args"""
+    for path in args["input"]:
+        if not os.path.exists(path):
+            logging.error("input=%s does not exist", path)
+            return False
+    if not args["output_dir"] and not args["archive"]:
+        logging.error("Nothing to write - set --output-dir and/or --archive")
+        return False
+    if args["output_dir"]:
+        output_dir = os.path.abspath(args["output_dir"])
+        if any(os.path.abspath(path) == output_dir for path in args["input"]):
+            logging.error("output_dir=%s must not be an input directory", args["output_dir"])
+            return False
+    if args["shards"] < 1:
+        logging.error("shards=%s must be at least 1", args["shards"])
+        return False
+    if args["archive"] and not args["archive"].endswith(ARCHIVE_SUFFIX):
+        logging.error("archive=%s must end with %s", args["archive"], ARCHIVE_SUFFIX)
+        return False
+    return True
+
+
+def convert(args):
+    """Stream the entities of the inputs into the output dir / archive - returns (entities, {path: count})"""
+    layout = None
+    archive = None
+    if args["output_dir"]:
+        os.makedirs(args["output_dir"], exist_ok=True)
+        layout = LayoutWriter(args["output_dir"], args["output_format"], args["shards"])
+    if args["archive"]:
+        archive = ArchiveWriter(args["archive"])
+
+    count = 0
+    written = set()
+    try:
+        for source, entity in iter_entities(args["input"]):
+            if layout is not None:
+                path = layout.write(entity)
+                if args["output_format"] == "files":
+                    if path in written:
+                        logging.warning(
+                            "%s: entity %r overwrites an earlier one in %s", source, entity.get("name"), path
+                        )
+                    written.add(path)
+            if archive is not None:
+                archive.write(entity)
+            count += 1
+    except BaseException:
+        for writer in (layout, archive):
+            if writer is not None:
+                writer.abort()
+        raise
+
+    counts = layout.close() if layout is not None else {}
+    if layout is not None:
+        for path in layout.removed:
+            logging.info("Removed %s - left by another layout", path)
+    if archive is not None:
+        archive.close()
+        counts[archive.path] = archive.count
+    return count, counts
+
+
+def setup_logging(log_level):
+    """Setup logging"""
+    log_level = getattr(logging, log_level.upper())
+    logging.basicConfig(
+        level=log_level, format="%(asctime)s.%(msecs)03d %(levelname)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    return True
+
+
+def main():
+    """Main function"""
+    args = load_args()
+
+    if not setup_logging(args["log_level"]):
+        return 1
+
+    if not validate_args(args):
+        return 1
+
+    try:
+        count, counts = convert(args)
+    except Exception as ex:  # pylint: disable=broad-except
+        logging.error("Failed to convert - caught exception - %s", str(ex).replace("\n", " "))
+        return 1
+
+    for path, path_count in sorted(counts.items()):
+        logging.debug("Wrote %s - %d entities", path, path_count)
+    logging.info("Wrote %d entities to %d files", count, len(counts))
+    return 0
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    sys.exit(exit_status)
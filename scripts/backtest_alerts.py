@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+
+"""
+Backtest alert rules against recorded indicator series - when would each rule have fired, and how often would it have
+flapped (see last9_backtest for the series file layouts)
+
+Rules are read from catalog / alert files, directories of them and .jsonl.gz archives. A rule is backtested against
+the series named after its indicator ("<entity name>/<indicator>" or "<indicator>"). A rule whose expression calls a
+macro on indicators - high_spike(9, 5xx Status) - is backtested against the macro's result over their series (see
+last9_macro_eval). Other expressions, and rules without a recorded series, are reported as skipped.
+
+--set evaluates each rule for every combination of the given values instead of its own, e.g. to tune a threshold.
+
+Sample usage
+
+python scripts/backtest_alerts.py --rules last9-alert-catalog/pg_alerts.yaml --series pg-metrics.csv
+python scripts/backtest_alerts.py --series exports/ --rule "Critical Connection Utilization" --set threshold=80,85,90
+python scripts/backtest_alerts.py --rules ../acme-alerts --series exports/ --format json --intervals
+"""
+
+import os
+import sys
+import json
+import time
+import glob
+import fnmatch
+import argparse
+import logging
+import datetime
+import itertools
+from collections import Counter
+
+import numpy as np
+
+from last9_backtest import (
+    STEP_SEC,
+    Series,
+    SeriesError,
+    backtest_rule,
+    find_series,
+    load_series,
+    rule_indicator,
+    rule_operator,
+    stack_series,
+)
+from last9_catalog import DEFAULT_CATALOG_DIR
+from last9_layout import ARCHIVE_SUFFIX, iter_entities
+from last9_macro_eval import MacroEvaluator, as_rows
+from last9_macros import DEFAULT_MACROS_FILE, load_macros, parse_call
+
+SET_KEYS = ("threshold", "bad_minutes", "total_minutes")
+RESULT_COLUMNS = (
+    "entity",
+    "rule",
+    "operator",
+    "threshold",
+    "bad_minutes",
+    "total_minutes",
+    "minutes",
+    "bad",
+    "fired",
+    "firing_minutes",
+    "longest",
+    "flaps",
+)
+
+
+def load_args():
+    """Parse cli"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--rules",
+        action="append",
+        help=f"Catalog / alert file, directory or archive - repeat for several (default: {DEFAULT_CATALOG_DIR})",
+        default=None,
+    )
+    parser.add_argument(
+        "--series",
+        action="append",
+        help="CSV / NPZ / Parquet series file or directory of them - repeat for several",
+        required=True,
+    )
+    parser.add_argument("--rule", action="append", help="Only rules whose name matches this glob - repeatable")
+    parser.add_argument("--entity", action="append", help="Only rules of entities whose name matches this glob")
+    parser.add_argument("--severity", help="Only rules of this severity", choices=["breach", "threat", "warning"])
+    parser.add_argument("--macros-file", help="Macros file for rules calling macros", default=DEFAULT_MACROS_FILE)
+    parser.add_argument("--include-disabled", action="store_true", help="Also backtest rules with is_disabled set")
+    parser.add_argument(
+        "--set",
+        action="append",
+        dest="set_values",
+        help=f"KEY=V1,V2,... - backtest every combination of these values, KEY is one of {', '.join(SET_KEYS)}",
+        default=[],
+    )
+    parser.add_argument(
+        "--flap-minutes",
+        type=int,
+        help="Count a firing starting this soon after the previous one ended as a flap (default: total_minutes)",
+        default=None,
+    )
+    parser.add_argument("--intervals", action="store_true", help="List the firing intervals of every rule")
+    parser.add_argument("--format", help="Output format", choices=["table", "json"], default="table")
+    parser.add_argument("--log-level", help="Log level", default=os.environ.get("LOG_LEVEL", "INFO"))
+    return vars(parser.parse_args(sys.argv[1:]))
+
+
+def parse_set_values(set_values):
+    """{key: [values]} of --set options, None if one is invalid"""
+    variants = {}
+    for set_value in set_values:
+        key, _, values = set_value.partition("=")
+        if key not in SET_KEYS:
+            logging.error("--set %s - key must be one of %s", set_value, ", ".join(SET_KEYS))
+            return None
+        try:
+            variants[key] = [(float if key == "threshold" else int)(value) for value in values.split(",")]
+        except ValueError:
+            logging.error("--set %s - values must be numbers", set_value)
+            return None
+    return variants
+
+
+def validate_args(args):
+    """Validate input args"""
+    args["rules"] = args["rules"] or [DEFAULT_CATALOG_DIR]
+    for path in args["rules"] + args["series"]:
+        if not os.path.exists(path):
+            logging.error("%s does not exist", path)
+            return False
+    args["variants"] = parse_set_values(args["set_values"])
+    if args["variants"] is None:
+        return False
+    if args["flap_minutes"] is not None and args["flap_minutes"] < 0:
+        logging.error("flap_minutes=%s must not be negative", args["flap_minutes"])
+        return False
+    return True
+
+
+def rule_files(paths):
+    """Rule files of files and directories - *.yaml / *.yml / archives directly in directories"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                sorted(
+                    glob.glob(os.path.join(path, "*.yaml"))
+                    + glob.glob(os.path.join(path, "*.yml"))
+                    + glob.glob(os.path.join(path, "*" + ARCHIVE_SUFFIX))
+                )
+            )
+        else:
+            files.append(path)
+    return files
+
+
+def matches(name, patterns):
+    """Whether name matches one of the glob patterns, True without patterns"""
+    return not patterns or any(fnmatch.fnmatchcase(name or "", pattern) for pattern in patterns)
+
+
+def selected_rules(args):
+    """(file, entity, rule) of the rules to backtest - files which do not parse are skipped with a warning"""
+    for file_path in rule_files(args["rules"]):
+        try:
+            entities = list(iter_entities([file_path]))
+        except Exception as ex:  # pylint: disable=broad-except
+            logging.warning("Skipping %s - failed to parse - %s", file_path, str(ex).replace("\n", " "))
+            continue
+        for _, entity in entities:
+            if not matches(entity.get("name"), args["entity"]):
+                continue
+            for rule in entity.get("alert_rules") or []:
+                if not matches(rule.get("name"), args["rule"]):
+                    continue
+                if args["severity"] and rule.get("severity") != args["severity"]:
+                    continue
+                yield file_path, entity, rule
+
+
+def iso(epoch):
+    """ISO 8601 UTC time of epoch seconds"""
+    return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def result_row(file_path, entity, rule, indicator, result):
+    """Report row of a backtest result"""
+    durations = [(end - start) // 60 for start, end in result.intervals]
+    return {
+        "file": file_path,
+        "entity": entity.get("name"),
+        "rule": rule.get("name"),
+        "indicator": indicator,
+        "operator": result.operator,
+        "threshold": result.threshold,
+        "bad_minutes": result.bad_minutes,
+        "total_minutes": result.total_minutes,
+        "minutes": result.minutes,
+        "bad": result.bad,
+        "fired": len(result.intervals),
+        "firing_minutes": sum(durations),
+        "longest": max(durations, default=0),
+        "flaps": result.flaps,
+        "intervals": [{"start": iso(start), "end": iso(end)} for start, end in result.intervals],
+    }
+
+
+def rule_series(evaluator, series, entity, rule):
+    """(label, Series, None) of the values a rule compares, (label, None, reason) if there are none
+
+    A rule whose expression calls a macro on indicators - high_spike(9, 5xx Status) - compares the macro's result.
+    """
+    indicator, reason = rule_indicator(entity, rule)
+    if reason is None:
+        recorded = find_series(series, entity, indicator)
+        return indicator, recorded, None if recorded is not None else "no series"
+
+    expression = str(rule.get("expression") or "").strip()
+    call = parse_call(expression)
+    if evaluator is None or call is None or call[0] not in evaluator.macros:
+        return indicator, None, reason
+    recorded = {arg: find_series(series, entity, arg) for arg in call[1]}
+    recorded = {arg: item for arg, item in recorded.items() if item is not None}
+    if not recorded:
+        return expression, None, "no series"
+    start, rows = stack_series(list(recorded.values()))
+    try:
+        values = evaluator.evaluate_call(expression, dict(zip(recorded, rows)).get)
+    except ValueError as ex:
+        return expression, None, f"unsupported macro - {ex}"
+    if isinstance(values, dict):
+        return expression, None, "macro returns several series"
+    return expression, Series(start, np.broadcast_to(as_rows(values), rows.shape)[0]), None
+
+
+def run_backtest(args, series):
+    """Backtest the selected rules - returns (rows, skipped)"""
+    keys = sorted(args["variants"])
+    combinations = [dict(zip(keys, values)) for values in itertools.product(*(args["variants"][key] for key in keys))]
+    evaluator = None
+    if os.path.isfile(args["macros_file"]):
+        evaluator = MacroEvaluator(load_macros(args["macros_file"]), step_sec=STEP_SEC)
+    rows = []
+    skipped = []
+    for file_path, entity, rule in selected_rules(args):
+        item = {"file": file_path, "entity": entity.get("name"), "rule": rule.get("name")}
+        if rule.get("is_disabled") and not args["include_disabled"]:
+            skipped.append(dict(item, indicator=rule.get("indicator"), reason="disabled"))
+            continue
+        if rule_operator(rule)[0] is None:
+            skipped.append(dict(item, indicator=rule.get("indicator"), reason="no threshold"))
+            continue
+        label, values, reason = rule_series(evaluator, series, entity, rule)
+        if reason is not None:
+            skipped.append(dict(item, indicator=label, reason=reason))
+            continue
+
+        for overrides in combinations:
+            try:
+                result = backtest_rule(values, rule, flap_minutes=args["flap_minutes"], **overrides)
+            except (TypeError, ValueError) as ex:
+                skipped.append(dict(item, indicator=label, reason=f"invalid rule - {ex}"))
+                continue
+            rows.append(result_row(file_path, entity, rule, label, result))
+    return rows, skipped
+
+
+def print_table(args, rows):
+    """Print the results as a table, with their firing intervals if asked to"""
+    cells = [[("" if row[column] is None else str(row[column])) for column in RESULT_COLUMNS] for row in rows]
+    widths = [max([len(column)] + [len(cell[index]) for cell in cells]) for index, column in enumerate(RESULT_COLUMNS)]
+    print("  ".join(column.ljust(width) for column, width in zip(RESULT_COLUMNS, widths)).rstrip())
+    for row, cell in zip(rows, cells):
+        print("  ".join(value.ljust(width) for value, width in zip(cell, widths)).rstrip())
+        if args["intervals"]:
+            for interval in row["intervals"]:
+                print(f"    {interval['start']} - {interval['end']}")
+
+
+def setup_logging(log_level):
+    """Setup logging"""
+    log_level = getattr(logging, log_level.upper())
+    logging.basicConfig(
+        level=log_level, format="%(asctime)s.%(msecs)03d %(levelname)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    return True
+
+
+def main():
+    """Main function"""
+    args = load_args()
+
+    if not setup_logging(args["log_level"]):
+        return 1
+
+    if not validate_args(args):
+        return 1
+
+    start = time.perf_counter()
+    try:
+        series = load_series(args["series"])
+    except (OSError, SeriesError) as ex:
+        logging.error("Failed to load series - %s", ex)
+        return 1
+    load_sec = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rows, skipped = run_backtest(args, series)
+    backtest_sec = time.perf_counter() - start
+
+    if args["format"] == "json":
+        if not args["intervals"]:
+            rows = [{key: value for key, value in row.items() if key != "intervals"} for row in rows]
+        print(json.dumps({"results": rows, "skipped": skipped}, indent=2))
+    else:
+        print_table(args, rows)
+
+    for item in skipped:
+        logging.debug("Skipped %s / %s (%s) - %s", item["entity"], item["rule"], item["indicator"], item["reason"])
+    if skipped:
+        reasons = Counter(item["reason"].split(" - ")[0] for item in skipped)
+        logging.info(
+            "Skipped %d rules - %s", len(skipped), ", ".join(f"{reason}: {count}" for reason, count in reasons.items())
+        )
+    logging.info(
+        "Loaded %d series (%d minutes) in %.2f s, backtested %d rule variants in %.2f s",
+        len(series),
+        sum(len(item.values) for item in series.values()),
+        load_sec,
+        len(rows),
+        backtest_sec,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    sys.exit(exit_status)
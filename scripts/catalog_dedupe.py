@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+"""
+Find indicators of the alert catalog evaluating the same PromQL under different names, and consolidate them
+
+Indicator queries are compared in their canonical form (see last9_promql) together with the entity data_source and
+the indicator unit. Duplicates are reported per group:
+
+    entity        duplicates within one alert manager - consolidated with --output-dir
+    cross-entity  the same query in several alert managers - reported only, as an indicator can only be used by the
+                  alert rules of its own entity
+
+With --output-dir the catalog is written there with every within-entity group reduced to its first indicator and the
+indicator / expression of the alert rules using the others pointed at it. Files without duplicates (or that fail to
+parse) are copied as is.
+
+Every indicator is evaluated once per --evaluation-interval seconds (default 60), so each removed duplicate saves
+60 / interval evaluations per minute.
+
+Sample usage
+
+python scripts/catalog_dedupe.py
+python scripts/catalog_dedupe.py --format json
+python scripts/catalog_dedupe.py --output-dir /tmp/consolidated-catalog
+"""
+
+import os
+import re
+import sys
+import copy
+import glob
+import json
+import shutil
+import argparse
+import logging
+
+from last9_catalog import DEFAULT_CATALOG_DIR
+from last9_promql import normalize_query
+from last9_yaml import atomic_write_text, dump_yaml, load_yaml_file
+
+
+def load_args():
+    """Parse cli"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--catalog-dir", help="Alert catalog directory", default=DEFAULT_CATALOG_DIR)
+    parser.add_argument("--output-dir", help="Write the consolidated catalog to this directory", default=None)
+    parser.add_argument(
+        "--evaluation-interval", type=int, help="Seconds between two evaluations of an indicator", default=60
+    )
+    parser.add_argument("--format", help="Report format", choices=["table", "json"], default="table")
+    parser.add_argument("--log-level", help="Log level", default=os.environ.get("LOG_LEVEL", "INFO"))
+    return vars(parser.parse_args(sys.argv[1:]))
+
+
+def validate_args(args):
+    """Validate input args"""
+    if not os.path.isdir(args["catalog_dir"]):
+        logging.error("catalog_dir=%s is not a directory", args["catalog_dir"])
+        return False
+    if args["evaluation_interval"] <= 0:
+        logging.error("evaluation_interval=%s must be positive", args["evaluation_interval"])
+        return False
+    if args["output_dir"] and os.path.abspath(args["output_dir"]) == os.path.abspath(args["catalog_dir"]):
+        logging.error("output_dir must not be the catalog_dir")
+        return False
+    return True
+
+
+def load_catalog(catalog_dir):
+    """{file name: parsed catalog} of the catalog files that parse"""
+    catalog = {}
+    for path in sorted(glob.glob(f"{catalog_dir}/*.yaml")):
+        try:
+            catalog[os.path.basename(path)] = load_yaml_file(path) or {}
+        except Exception as ex:  # pylint: disable=broad-except
+            logging.warning("Skipping catalog file %s - failed to parse - %s", path, str(ex).replace("\n", " "))
+    return catalog
+
+
+def indicator_key(entity, indicator):
+    """Indicators with the same key evaluate the same series"""
+    return (entity.get("data_source"), indicator.get("unit"), normalize_query(indicator.get("query") or ""))
+
+
+def find_duplicates(catalog):
+    """Groups of indicators sharing a key - dicts with the query, its scope and (file, entity, indicator) members"""
+    members_by_key = {}
+    for file_name, catalog_ds in catalog.items():
+        for entity in catalog_ds.get("entities") or []:
+            for indicator in entity.get("indicators") or []:
+                members_by_key.setdefault(indicator_key(entity, indicator), []).append(
+                    (file_name, entity.get("external_ref") or entity.get("name"), indicator.get("name"))
+                )
+
+    groups = []
+    for (_, _, query), members in members_by_key.items():
+        entities = {}
+        for member in members:
+            entities.setdefault(member[:2], []).append(member)
+        for entity_members in entities.values():
+            if len(entity_members) > 1:
+                groups.append({"scope": "entity", "query": query, "members": entity_members})
+        if len(entities) > 1:
+            # One indicator per entity - the within-entity duplicates are already counted above
+            groups.append(
+                {"scope": "cross-entity", "query": query, "members": [group[0] for group in entities.values()]}
+            )
+    return groups
+
+
+def rename_indicators(text, renames):
+    """Replace whole indicator names in an alert rule expression"""
+    if not renames or not text:
+        return text
+    pattern = "|".join(re.escape(name) for name in sorted(renames, key=len, reverse=True))
+    return re.sub(r"(?<![\w])(" + pattern + r")(?![\w])", lambda match: renames[match.group(1)], text)
+
+
+def consolidate_entity(entity):
+    """Copy of entity with duplicate indicators removed and its alert rules using the kept ones
+
+    Returns the entity and a dict of removed indicator name to kept indicator name.
+    """
+    kept = {}
+    renames = {}
+    indicators = []
+    for indicator in entity.get("indicators") or []:
+        key = indicator_key(entity, indicator)
+        if key in kept:
+            renames[indicator.get("name")] = kept[key]
+            continue
+        kept[key] = indicator.get("name")
+        indicators.append(indicator)
+
+    if not renames:
+        return entity, renames
+
+    entity = copy.deepcopy(entity)
+    entity["indicators"] = indicators
+    for rule in entity.get("alert_rules") or []:
+        if rule.get("indicator") in renames:
+            rule["indicator"] = renames[rule["indicator"]]
+        if isinstance(rule.get("expression"), str):
+            rule["expression"] = rename_indicators(rule["expression"], renames)
+    return entity, renames
+
+
+def write_consolidated_catalog(catalog_dir, output_dir, catalog):
+    """Write the consolidated catalog to output_dir - returns the number of indicators removed"""
+    os.makedirs(output_dir, exist_ok=True)
+    removed = 0
+    for path in sorted(glob.glob(f"{catalog_dir}/*")):
+        file_name = os.path.basename(path)
+        if not os.path.isfile(path) or file_name.startswith("."):
+            continue
+
+        file_renames = {}
+        if file_name in catalog:
+            catalog_ds = dict(catalog[file_name])
+            entities = []
+            for entity in catalog_ds.get("entities") or []:
+                entity, renames = consolidate_entity(entity)
+                entities.append(entity)
+                file_renames.update(renames)
+            catalog_ds["entities"] = entities
+
+        output_file = os.path.join(output_dir, file_name)
+        if file_renames:
+            atomic_write_text(output_file, dump_yaml(catalog_ds))
+            removed += len(file_renames)
+            for name, kept_name in file_renames.items():
+                logging.info("%s: replaced indicator %r by %r", file_name, name, kept_name)
+        else:
+            # Copied verbatim to keep the comments and layout of untouched files
+            shutil.copyfile(path, output_file)
+    return removed
+
+
+def summarize(groups, evaluation_interval):
+    """Duplicate counts and the evaluations per minute consolidating them saves"""
+    evaluations_per_minute = 60 / evaluation_interval
+    summary = {}
+    for scope in ("entity", "cross-entity"):
+        duplicates = sum(len(group["members"]) - 1 for group in groups if group["scope"] == scope)
+        summary[scope] = {
+            "groups": sum(1 for group in groups if group["scope"] == scope),
+            "duplicate_indicators": duplicates,
+            "evaluations_per_minute_saved": duplicates * evaluations_per_minute,
+        }
+    return summary
+
+
+def print_report(args, groups, summary):
+    """Print the duplicate groups and the summary"""
+    if args["format"] == "json":
+        print(json.dumps({"groups": groups, "summary": summary}, indent=2))
+        return
+
+    for group in groups:
+        print(f"[{group['scope']}] {group['query']}")
+        for index, (file_name, entity, indicator) in enumerate(group["members"]):
+            print(f"    {'keep' if index == 0 else 'dup '}  {file_name}  {entity}  {indicator}")
+    for scope, counts in summary.items():
+        print(
+            f"{scope}: {counts['duplicate_indicators']} duplicate indicators in {counts['groups']} groups - "
+            f"{counts['evaluations_per_minute_saved']:g} evaluations/min saved"
+            + (" if consolidated" if scope == "cross-entity" else "")
+        )
+
+
+def setup_logging(log_level):
+    """Setup logging"""
+    log_level = getattr(logging, log_level.upper())
+    logging.basicConfig(
+        level=log_level, format="%(asctime)s.%(msecs)03d %(levelname)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    return True
+
+
+def main():
+    """Main function"""
+    args = load_args()
+
+    if not setup_logging(args["log_level"]):
+        return 1
+
+    if not validate_args(args):
+        return 1
+
+    catalog = load_catalog(args["catalog_dir"])
+    groups = find_duplicates(catalog)
+    print_report(args, groups, summarize(groups, args["evaluation_interval"]))
+
+    if args["output_dir"]:
+        removed = write_consolidated_catalog(args["catalog_dir"], args["output_dir"], catalog)
+        logging.info("Wrote consolidated catalog to %s - %d indicators removed", args["output_dir"], removed)
+    return 0
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    sys.exit(exit_status)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+"""
+Query the alert catalog through its on-disk index (see last9_catalog)
+
+The index is refreshed before every query - only catalog files whose mtime and content changed are re-parsed - so a
+warm query only stats the catalog files and runs one SQLite query.
+
+Sample usage
+
+python scripts/catalog_index.py rules --metric kafka_consumergroup_lag
+python scripts/catalog_index.py rules --severity breach --min-bad-minutes 5
+python scripts/catalog_index.py entities --type infra-alerts
+python scripts/catalog_index.py metrics --format json
+python scripts/catalog_index.py build
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+
+from last9_catalog import DEFAULT_CATALOG_DIR, CatalogIndex
+
+RULE_COLUMNS = (
+    "file",
+    "entity",
+    "name",
+    "severity",
+    "operator",
+    "threshold",
+    "bad_minutes",
+    "total_minutes",
+    "metrics",
+)
+ENTITY_COLUMNS = ("file", "name", "external_ref", "type", "indicators", "rules")
+METRIC_COLUMNS = ("metric", "indicators", "rules")
+
+
+def load_args():
+    """Parse cli"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--catalog-dir", help="Alert catalog directory", default=DEFAULT_CATALOG_DIR)
+    parser.add_argument(
+        "--index-file", help="Index file (default: .last9-catalog-index.sqlite in the catalog dir)", default=None
+    )
+    parser.add_argument("--format", help="Output format", choices=["table", "json"], default="table")
+    parser.add_argument("--log-level", help="Log level", default=os.environ.get("LOG_LEVEL", "INFO"))
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("build", help="Refresh the index and report what was re-parsed")
+
+    rules_parser = subparsers.add_parser("rules", help="Alert rules matching all given filters")
+    rules_parser.add_argument("--metric", help="Rules whose indicators read this metric")
+    rules_parser.add_argument("--severity", help="Rule severity", choices=["breach", "threat", "warning"])
+    rules_parser.add_argument("--min-bad-minutes", type=int, help="Rules with at least this many bad_minutes")
+    rules_parser.add_argument("--indicator", help="Rules using this indicator")
+    rules_parser.add_argument("--type", dest="entity_type", help="Rules of entities of this type")
+
+    entities_parser = subparsers.add_parser("entities", help="Entities with their indicator and rule counts")
+    entities_parser.add_argument("--type", dest="entity_type", help="Entity type")
+
+    subparsers.add_parser("metrics", help="Metrics read by the catalog with their indicator and rule counts")
+    return vars(parser.parse_args(sys.argv[1:]))
+
+
+def validate_args(args):
+    """Validate input args"""
+    if not os.path.isdir(args["catalog_dir"]):
+        logging.error("catalog_dir=%s is not a directory", args["catalog_dir"])
+        return False
+    return True
+
+
+def print_rows(args, rows, columns):
+    """Print query rows as a table or JSON"""
+    if args["format"] == "json":
+        print(json.dumps(rows, indent=2))
+        return
+
+    cells = [[("" if row[column] is None else str(row[column])) for column in columns] for row in rows]
+    widths = [max([len(column)] + [len(cell[index]) for cell in cells]) for index, column in enumerate(columns)]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)).rstrip())
+    for cell in cells:
+        print("  ".join(value.ljust(width) for value, width in zip(cell, widths)).rstrip())
+
+
+def setup_logging(log_level):
+    """Setup logging"""
+    log_level = getattr(logging, log_level.upper())
+    logging.basicConfig(
+        level=log_level, format="%(asctime)s.%(msecs)03d %(levelname)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    return True
+
+
+def main():
+    """Main function"""
+    args = load_args()
+
+    if not setup_logging(args["log_level"]):
+        return 1
+
+    if not validate_args(args):
+        return 1
+
+    start = time.perf_counter()
+    with CatalogIndex(args["catalog_dir"], args["index_file"]) as index:
+        counts = index.refresh()
+        refresh_ms = 1000 * (time.perf_counter() - start)
+
+        if args["command"] == "build":
+            for path, error in index.failed_files():
+                logging.warning("Catalog file %s failed to parse - %s", path, error.replace("\n", " "))
+            logging.info(
+                "Catalog index %s - %s in %.1f ms",
+                index.index_file,
+                " ".join(f"{outcome}={count}" for outcome, count in counts.items()),
+                refresh_ms,
+            )
+            return 0
+
+        if args["command"] == "rules":
+            rows = index.query_rules(
+                metric=args["metric"],
+                severity=args["severity"],
+                min_bad_minutes=args["min_bad_minutes"],
+                indicator=args["indicator"],
+                entity_type=args["entity_type"],
+            )
+            columns = RULE_COLUMNS
+        elif args["command"] == "entities":
+            rows = index.query_entities(entity_type=args["entity_type"])
+            columns = ENTITY_COLUMNS
+        else:
+            rows = index.query_metrics()
+            columns = METRIC_COLUMNS
+
+    print_rows(args, rows, columns)
+    logging.debug("Query returned %d rows in %.1f ms", len(rows), 1000 * (time.perf_counter() - start))
+    return 0
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    sys.exit(exit_status)
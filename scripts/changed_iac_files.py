@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+"""
+List the workspace files to plan for a git range - the files changed in the range plus the rendered files whose
+template or vars file section changed, looked up in the render index (see last9_render_index)
+
+A change to templates/alerts/vmagent/health.yaml or to one section of workspace/config/*.toml selects exactly the
+rendered files depending on it. They are reported, and listed with their committed content - --render-stale
+re-renders them in place first, which leaves uncommitted changes in the workspace. Files rendered with tmpl_var*
+environment overrides are only re-rendered under the same overrides. Files missing from the index (rendered before it
+existed, or written by hand) are selected only when they change.
+
+One `git diff --name-only` call, the index and the changed templates / vars files are read - nothing is rendered
+unless asked to.
+
+Sample usage
+
+python scripts/changed_iac_files.py
+python scripts/changed_iac_files.py --git-range origin/main...HEAD --render-stale
+python scripts/changed_iac_files.py --all-stale --format json
+"""
+
+import os
+import sys
+import json
+import argparse
+import logging
+import subprocess
+
+from last9_render_index import DEFAULT_INDEX_FILE, env_vars_match, load_index, norm_path, record_renders, stale_outputs
+
+
+def load_args():
+    """Parse cli"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--git-range",
+        help="Revision or range given to git diff - a single revision compares it with the working tree",
+        default="HEAD^",
+    )
+    parser.add_argument(
+        "--all-stale",
+        action="store_true",
+        help="Check every indexed file against its template and vars file, not only those changed in the range",
+    )
+    parser.add_argument("--render-stale", action="store_true", help="Re-render the stale files before listing them")
+    parser.add_argument("--workspace-dir", help="Directory of the iac files", default="workspace")
+    parser.add_argument("--render-index", help="Render index file", default=DEFAULT_INDEX_FILE)
+    parser.add_argument("--format", help="Output format", choices=["lines", "json"], default="lines")
+    parser.add_argument("--log-level", help="Log level", default=os.environ.get("LOG_LEVEL", "INFO"))
+    return vars(parser.parse_args(sys.argv[1:]))
+
+
+def validate_args(args):
+    """Validate input args"""
+    if not args["git_range"] and not args["all_stale"]:
+        logging.error("Provide --git-range or --all-stale")
+        return False
+    return True
+
+
+def git_changed_paths(git_range):
+    """Paths changed in a git range, None if git failed"""
+    try:
+        output = subprocess.run(
+            ["git", "diff", "--name-only", git_range], check=True, capture_output=True, text=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError) as ex:
+        logging.error("git diff --name-only %s failed - %s", git_range, getattr(ex, "stderr", "") or ex)
+        return None
+    return {norm_path(line) for line in output.splitlines() if line}
+
+
+def render_stale(outputs, stale):
+    """Re-render stale outputs and record them in the index - returns the outputs which failed"""
+    # Imported here - rendering is optional and pulls in the template machinery
+    from patch_template import env_tmpl_vars, render_entry  # pylint: disable=import-outside-toplevel
+
+    env_vars = env_tmpl_vars()
+    failed = []
+    records = []
+    for output_file, _ in stale:
+        entry = outputs[output_file]
+        if not env_vars_match(entry, env_vars):
+            logging.error(
+                "Not re-rendering %s - it was rendered with tmpl_var* environment overrides %s, not the current %s",
+                output_file,
+                entry.get("env_vars") or "none",
+                sorted(env_vars) or "none",
+            )
+            failed.append(output_file)
+            continue
+        output_file, error, record = render_entry(
+            {
+                "tmpl_file": entry["tmpl_file"],
+                "tmpl_vars_file": entry["tmpl_vars_file"],
+                "tmpl_vars_file_section": entry["tmpl_vars_file_section"],
+                "vars": entry.get("vars") or {},
+                "ignore_missing_vars": False,
+                "output_file": output_file,
+            }
+        )
+        if error is None:
+            logging.info("Re-rendered %s", output_file)
+            records.append(record)
+        else:
+            logging.error("Failed to re-render %s - %s", output_file, error)
+            failed.append(output_file)
+    return records, failed
+
+
+def files_to_plan(args, changed_paths, stale):
+    """Existing workspace files changed in the range or stale, the render index excluded"""
+    workspace_dir = norm_path(args["workspace_dir"]) + os.sep
+    index_file = norm_path(args["render_index"])
+    selected = {path for path in changed_paths or () if path.startswith(workspace_dir)}
+    selected.update(output_file for output_file, _ in stale)
+    selected.discard(index_file)
+    return sorted(path for path in selected if os.path.isfile(path))
+
+
+def setup_logging(log_level):
+    """Setup logging"""
+    log_level = getattr(logging, log_level.upper())
+    logging.basicConfig(
+        level=log_level, format="%(asctime)s.%(msecs)03d %(levelname)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    return True
+
+
+def main():
+    """Main function"""
+    args = load_args()
+
+    if not setup_logging(args["log_level"]):
+        return 1
+
+    if not validate_args(args):
+        return 1
+
+    changed_paths = None
+    if args["git_range"]:
+        changed_paths = git_changed_paths(args["git_range"])
+        if changed_paths is None:
+            return 1
+
+    outputs = load_index(args["render_index"])
+    stale = stale_outputs(outputs, None if args["all_stale"] else changed_paths)
+    for output_file, reason in stale:
+        if args["render_stale"]:
+            logging.info("Stale %s - %s", output_file, reason)
+        else:
+            logging.warning("Stale %s - %s - re-render it, or pass --render-stale", output_file, reason)
+
+    failed = []
+    if args["render_stale"] and stale:
+        records, failed = render_stale(outputs, stale)
+        record_renders(records, args["render_index"])
+
+    plan_files = files_to_plan(args, changed_paths, stale)
+    if args["format"] == "json":
+        print(
+            json.dumps(
+                {
+                    "changed": sorted(changed_paths or ()),
+                    "stale": [{"file": output_file, "reason": reason} for output_file, reason in stale],
+                    "plan": plan_files,
+                    "failed": failed,
+                },
+                indent=2,
+            )
+        )
+    else:
+        for path in plan_files:
+            print(path)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    sys.exit(exit_status)
@@ -1,20 +1,70 @@
 #!/usr/bin/env python
 
-"""Create Grafana dashboard from input payload"""
+"""
+Create Grafana dashboards from input payloads
+
+Sample usage
+
+python scripts/create_grafana_dashboard.py --input-file workspace/grafana-dashboards/vmagent/health.json --no-dry
+
+Bulk mode uploads every payload of a directory (or listed in a file, one path per line) concurrently over one write
+token and one connection pool, then prints a per dashboard status and latency table
+
+python scripts/create_grafana_dashboard.py --input-dir workspace/grafana-dashboards --workers 8 --gzip --no-dry
+
+With --sync a fingerprint of each payload (ignoring id and version) is stored as a last9_fingerprint:<hash> dashboard
+tag next to last9_managed. The fingerprints of all last9_managed dashboards are fetched in one search call up front,
+and only dashboards whose fingerprint differs are uploaded (with overwrite), so unchanged dashboards keep their version.
+"""
 
 import os
 import sys
 import json
+import gzip
+import glob
+import hashlib
+import time
 import argparse
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 import requests
 
+from last9_config import ConfigError, parse_iac_config
+from last9_http import DEFAULT_POOL_SIZE, get_access_token, get_session, invalidate_access_token, log_request_stats
+from last9_instrument import inc, run_instrumented, span
+
+MANAGED_TAG = 'last9_managed'
+FINGERPRINT_TAG_PREFIX = 'last9_fingerprint:'
+# Grafana caps tags at 50 characters - 18 for the prefix leaves room for 32 hex chars (128 bits) of sha256
+FINGERPRINT_LENGTH = 32
+
+# Shared by the upload workers - kept out of args so it stays JSON serialisable for the debug dump
+_TOKEN_LOCK = threading.Lock()
+_GZIP_LOCK = threading.Lock()
+
 
 def load_args():
     """Parse cli"""
     parser = argparse.ArgumentParser()
-    parser.add_argument("--input-file", help="Grafana dashboard json payload file", required=True)
+    parser.add_argument("--input-file", help="Grafana dashboard json payload file", default='')
+    parser.add_argument("--input-dir", help="Upload every *.json dashboard payload in this directory", default='')
+    parser.add_argument(
+        "--input-files-list", help="Upload the dashboard payload files listed in this file, one per line", default=''
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of dashboards to upload in parallel",
+        default=int(os.environ.get("LAST9_DASHBOARD_WORKERS", "4")),
+    )
+    parser.add_argument(
+        "--gzip",
+        action="store_true",
+        dest="gzip",
+        help="gzip request bodies - falls back to plain bodies if the API answers 415",
+    )
     parser.add_argument(
         "--api-config-str",
         help="Last9 API config string",
@@ -34,6 +84,12 @@ def load_args():
         "--no-overwrite", action="store_false", dest="overwrite", help="Do not overwrite existing dashboard"
     )
     parser.set_defaults(overwrite=False)
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        dest="sync",
+        help="Only upload dashboards whose content fingerprint differs from the deployed one - implies --overwrite",
+    )
     parser.add_argument("--log-level", help="Log level", default=os.environ.get("LOG_LEVEL", "INFO"))
     return vars(parser.parse_args(sys.argv[1:]))
 
@@ -42,20 +98,32 @@ def load_args():
 # pylint: disable=too-many-return-statements
 def validate_args(args):
     """Validate input args"""
-    # Validate input file exists
-    if not os.path.exists(args['input_file']):
-        logging.error("input_file - %s does not exist", args["input_file"])
+    input_opts = [key for key in ('input_file', 'input_dir', 'input_files_list') if args[key] != '']
+    if len(input_opts) != 1:
+        logging.error("Provide exactly one of --input-file, --input-dir and --input-files-list - got %s", input_opts)
         return False
 
-    # Validate input file is valid json
-    args['input_payload'] = {}
-    try:
-        with open(args['input_file'], 'r', encoding='utf-8') as input_fd:
-            args['input_payload'] = json.load(input_fd)
-    except Exception as ex:
-        logging.error("input_file - %s failed to load json - caught exception - %s", args["input_file"], str(ex))
+    if args['workers'] < 1:
+        logging.error("workers=%s must be at least 1", args['workers'])
+        return False
+
+    args['input_files'] = get_input_files(args)
+    if args['input_files'] is False:
         return False
 
+    # Validate input files exist and are valid json
+    args['input_payloads'] = []
+    for input_file in args['input_files']:
+        if not os.path.exists(input_file):
+            logging.error("input_file - %s does not exist", input_file)
+            return False
+        try:
+            with open(input_file, 'r', encoding='utf-8') as input_fd:
+                args['input_payloads'].append((input_file, json.load(input_fd)))
+        except Exception as ex:
+            logging.error("input_file - %s failed to load json - caught exception - %s", input_file, str(ex))
+            return False
+
     # Validate if api_config_string is provided then other API args are not provided i.e.
     # api_base_url, org and api_write_refresh_token are not provided
     if args['api_config_str'] != '':
@@ -85,16 +153,15 @@ def validate_args(args):
 
     # Validate that api_config_string is valid json and has the mandatory args to set the args variables i.e.
     # set api_base_url, org and api_write_refresh_token
-    try:
-        args['api_config_ds'] = json.loads(args['api_config_str'])
-        args['api_write_refresh_token'] = (
-            args['api_config_ds'].get('api_config', {}).get('write', {}).get('refresh_token', '')
-        )
-        args['api_base_url'] = args['api_config_ds'].get('api_config', {}).get('write', {}).get('api_base_url', '')
-        args['org'] = args['api_config_ds'].get('api_config', {}).get('write', {}).get('org', '')
-    except Exception as ex:
-        logging.error("api_config_str=%s failed to load json - caught exception - %s", args["api_config_str"], str(ex))
-        return False
+    if args['api_config_str'] != '':
+        try:
+            write_config = parse_iac_config(args['api_config_str'], 'api_config_str').api('write')
+        except ConfigError as ex:
+            logging.error("Failed to load api config - %s", ex)
+            return False
+        args['api_write_refresh_token'] = write_config.refresh_token
+        args['api_base_url'] = write_config.api_base_url
+        args['org'] = write_config.org
 
     if len(args['api_write_refresh_token']) == 0:
         if len(args['api_config_str']) > 0:
@@ -120,24 +187,58 @@ def validate_args(args):
     return True
 
 
+def get_input_files(args):
+    """Payload files to upload - False on error"""
+    if args['input_file'] != '':
+        return [args['input_file']]
+
+    if args['input_dir'] != '':
+        if not os.path.isdir(args['input_dir']):
+            logging.error("input_dir - %s is not a directory", args["input_dir"])
+            return False
+        input_files = sorted(glob.glob(os.path.join(args['input_dir'], '*.json')))
+    else:
+        if not os.path.exists(args['input_files_list']):
+            logging.error("input_files_list - %s does not exist", args["input_files_list"])
+            return False
+        with open(args['input_files_list'], 'r', encoding='utf-8') as list_fd:
+            input_files = [line.strip() for line in list_fd if line.strip() and not line.strip().startswith('#')]
+
+    if not input_files:
+        logging.error("No dashboard payload files found")
+        return False
+    return input_files
+
+
 def get_write_token(args):
-    """Get write token from read refresh token"""
+    """Get write token from write refresh token"""
     url = f"{args['api_base_url']}/oauth/access_token"
-    headers = {
-        "Content-Type": "application/json",
-    }
-    data = {"refresh_token": args['api_write_refresh_token']}
-
-    response = requests.post(url, headers=headers, json=data, timeout=60)
 
     try:
-        response.raise_for_status()
-    except requests.exceptions.HTTPError as ex:
+        return get_access_token(args['api_base_url'], args['api_write_refresh_token'])
+    except requests.exceptions.RequestException as ex:
         err_msg = f"Failed to call {url} - caught_exception={str(ex)}"
         logging.error(err_msg)
         return False
 
-    return response.json()['access_token']
+
+def refresh_write_token(args, rejected_token):
+    """Replace a write token the API rejected with 401 by a new one, once per run - returns False if there is none
+
+    A cached token may have been revoked before its expiry. Uploads running concurrently share the refreshed token.
+    """
+    with _TOKEN_LOCK:
+        if args['api_write_token'] != rejected_token:
+            return args['api_write_token']
+        if args.get('token_refreshed'):
+            return False
+        args['token_refreshed'] = True
+        logging.warning("Access token rejected with 401 - exchanging the refresh token again")
+        invalidate_access_token(args['api_base_url'], args['api_write_refresh_token'])
+        access_token = get_write_token(args)
+        if access_token is not False:
+            args['api_write_token'] = access_token
+        return access_token
 
 
 def _extract_domain(url):
@@ -147,43 +248,200 @@ def _extract_domain(url):
     return False
 
 
-def create_dashboard(args):
-    """Create Grafana dashboard"""
+def _grafana_url(args, path):
+    """Grafana API url proxied through the Last9 API - False if api_base_url has no domain"""
     domain = _extract_domain(args['api_base_url'])
     if domain is False:
         return False
+    return f"https://{domain}/api/gp/v1/organizations/{args['org']}/api/{path}"
 
-    url = f"https://{domain}/api/gp/v1/organizations/{args['org']}/api/dashboards/db"
-    headers = {
+
+def _headers(args):
+    return {
         'Accept': 'application/json',
         'Content-Type': 'application/json',
         'X-LAST9-API-TOKEN': f"Bearer {args['api_write_token']}",
     }
 
+
+def dashboard_fingerprint(payload):
+    """Hash of the canonical payload - id, version, overwrite and fingerprint tags do not count as changes"""
+    dashboard = {key: value for key, value in payload.get('dashboard', {}).items() if key not in ('id', 'version')}
+    dashboard['tags'] = [tag for tag in dashboard.get('tags', []) if not str(tag).startswith(FINGERPRINT_TAG_PREFIX)]
+    canonical = {key: value for key, value in payload.items() if key not in ('dashboard', 'overwrite')}
+    canonical['dashboard'] = dashboard
+    canonical_str = json.dumps(canonical, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical_str.encode('utf-8')).hexdigest()[:FINGERPRINT_LENGTH]
+
+
+def with_fingerprint(payload, fingerprint):
+    """Copy of payload with the fingerprint tag set on the dashboard"""
+    dashboard = dict(payload.get('dashboard', {}))
+    tags = [tag for tag in dashboard.get('tags', []) if not str(tag).startswith(FINGERPRINT_TAG_PREFIX)]
+    dashboard['tags'] = tags + [f"{FINGERPRINT_TAG_PREFIX}{fingerprint}"]
+    return {**payload, 'dashboard': dashboard}
+
+
+def get_deployed_fingerprints(args):
+    """Fingerprints of all last9_managed dashboards keyed by title (None if untagged) - False on error"""
+    url = _grafana_url(args, 'search')
+    if url is False:
+        return False
+
+    params = {'tag': MANAGED_TAG, 'type': 'dash-db', 'limit': 5000}
+    try:
+        access_token = args['api_write_token']
+        response = get_session().get(url, headers=_headers(args), params=params, timeout=60)
+        if response.status_code == 401 and refresh_write_token(args, access_token) is not False:
+            response = get_session().get(url, headers=_headers(args), params=params, timeout=60)
+        response.raise_for_status()
+        search_ds = response.json()
+    except (requests.exceptions.RequestException, ValueError) as ex:
+        logging.error("Failed to call %s - caught_exception=%s", url, str(ex))
+        return False
+
+    fingerprints = {}
+    for item in search_ds:
+        fingerprint_tags = [tag for tag in item.get('tags', []) if str(tag).startswith(FINGERPRINT_TAG_PREFIX)]
+        fingerprints[item.get('title', '')] = (
+            fingerprint_tags[0][len(FINGERPRINT_TAG_PREFIX) :] if fingerprint_tags else None
+        )
+    logging.info("Found %d %s dashboards", len(fingerprints), MANAGED_TAG)
+    return fingerprints
+
+
+def _response_json(response):
+    try:
+        return response.json()
+    except ValueError:
+        return {'body': response.text[:500]}
+
+
+def _post_payload(args, url, headers, payload):
+    """POST a payload - gzip compressed if enabled and still accepted by the API"""
+    body = json.dumps(payload).encode('utf-8')
+    if args['gzip']:
+        response = get_session().post(
+            url, headers={**headers, 'Content-Encoding': 'gzip'}, data=gzip.compress(body), timeout=60
+        )
+        if response.status_code != 415:
+            return response
+        with _GZIP_LOCK:
+            if args['gzip']:
+                logging.warning("Got 415 for gzip compressed body - sending uncompressed bodies from now on")
+                args['gzip'] = False
+    return get_session().post(url, headers=headers, data=body, timeout=60)
+
+
+def create_dashboard(args, input_file, payload):
+    """Create Grafana dashboard - returns a result dict with status created / updated / unchanged / exists / dry_run /
+    failed
+    """
+    result = {
+        'file': input_file,
+        'title': payload.get('dashboard', {}).get('title', ''),
+        'status': 'failed',
+        'http_status': '',
+        'latency_ms': 0.0,
+    }
+    url = _grafana_url(args, 'dashboards/db')
+    if url is False:
+        return result
+
+    created_status = 'created'
+    if args['sync']:
+        fingerprint = dashboard_fingerprint(payload)
+        deployed_fingerprints = args['deployed_fingerprints']
+        if deployed_fingerprints.get(result['title']) == fingerprint:
+            logging.info("Dashboard %s from %s unchanged - skipping upload", result['title'], input_file)
+            result['status'] = 'unchanged'
+            return result
+        payload = with_fingerprint(payload, fingerprint)
+        if result['title'] in deployed_fingerprints:
+            created_status = 'updated'
+
     if args['dry_run']:
-        logging.info("dry_run set - skipping dashboard creation")
-        return True
+        logging.info("dry_run set - skipping dashboard creation for %s", input_file)
+        result['status'] = 'dry_run'
+        return result
 
     if args['overwrite']:
-        args['input_payload']['overwrite'] = True
+        payload = {**payload, 'overwrite': True}
+
+    start = time.perf_counter()
+    try:
+        with span('upload') as trace_args:
+            trace_args['file'] = input_file
+            access_token = args['api_write_token']
+            response = _post_payload(args, url, _headers(args), payload)
+            if response.status_code == 401 and refresh_write_token(args, access_token) is not False:
+                response = _post_payload(args, url, _headers(args), payload)
+    except requests.exceptions.RequestException as ex:
+        logging.error("Failed to call %s for %s - caught_exception=%s", url, input_file, str(ex))
+        return result
+    finally:
+        result['latency_ms'] = 1000 * (time.perf_counter() - start)
+    result['http_status'] = str(response.status_code)
 
-    response = requests.post(url, headers=headers, data=json.dumps(args['input_payload']), timeout=60)
     try:
         response.raise_for_status()
     except requests.exceptions.HTTPError as ex:
         status_code = response.status_code
-        response_ds = response.json()
-        if str(status_code) == '412' and response_ds['status'] == 'name-exists' and not args['overwrite']:
-            logging.warning("Got response=%s - ignoring as --no-overwrite flag set", str(response_ds))
-            return True
+        response_ds = _response_json(response)
+        if str(status_code) == '412' and response_ds.get('status') == 'name-exists' and not args['overwrite']:
+            logging.warning(
+                "Got response=%s for %s - ignoring as --no-overwrite flag set", str(response_ds), input_file
+            )
+            result['status'] = 'exists'
+            return result
 
-        err_msg = f"Failed to call {url} - caught_exception={str(ex)} - response={response.json()}"
+        err_msg = f"Failed to call {url} for {input_file} - caught_exception={str(ex)} - response={response_ds}"
         logging.error(err_msg)
-        return False
-
-    logging.info("Dumping output")
-    logging.info(response.json())
-    return True
+        return result
+
+    logging.info("Dumping output for %s", input_file)
+    logging.info(_response_json(response))
+    result['status'] = created_status
+    return result
+
+
+def create_dashboards(args):
+    """Upload all dashboards with a bounded worker pool - returns result dicts in input order"""
+
+    def _create(item):
+        input_file, payload = item
+        try:
+            return create_dashboard(args, input_file, payload)
+        except Exception as ex:  # pylint: disable=broad-except
+            logging.error("Failed to create dashboard for %s - caught exception - %s", input_file, str(ex))
+            return {'file': input_file, 'title': '', 'status': 'failed', 'http_status': '', 'latency_ms': 0.0}
+
+    with ThreadPoolExecutor(max_workers=args['workers']) as executor:
+        return list(executor.map(_create, args['input_payloads']))
+
+
+def print_summary(results):
+    """Print per dashboard status and latency"""
+    file_width = max(len('file'), *(len(result['file']) for result in results))
+    title_width = max(len('title'), *(len(result['title']) for result in results))
+    lines = [
+        "------------------------",
+        f"  {'file':<{file_width}}  {'title':<{title_width}}  {'status':<9} {'http':<4} {'latency_ms':>10}",
+    ]
+    for result in results:
+        lines.append(
+            f"  {result['file']:<{file_width}}  {result['title']:<{title_width}}  {result['status']:<9} "
+            f"{result['http_status']:<4} {result['latency_ms']:10.1f}"
+        )
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    lines.append(
+        f"SUMMARY: dashboards={len(results)} "
+        + " ".join(f"{status}={count}" for status, count in sorted(counts.items()))
+    )
+    lines.append("------------------------")
+    sys.stderr.write("\n".join(lines) + "\n")
 
 
 def setup_logging(log_level):
@@ -202,22 +460,41 @@ def main():
     if not setup_logging(args["log_level"]):
         return 1
 
-    if not validate_args(args):
+    with span('load_config'):
+        valid_args = validate_args(args)
+    if not valid_args:
         return 1
 
-    args['api_write_token'] = get_write_token(args)
+    # Size the shared connection pool to the worker count before the token exchange creates it
+    get_session(pool_size=max(args['workers'], DEFAULT_POOL_SIZE))
+    with span('token_exchange'):
+        args['api_write_token'] = get_write_token(args)
     if args['api_write_token'] is False:
         return 1
 
-    logging.debug("Dumping args")
-    logging.debug(json.dumps(args, indent=2))
-
-    if not create_dashboard(args):
+    if args['sync']:
+        args['overwrite'] = True
+        with span('fetch_fingerprints'):
+            args['deployed_fingerprints'] = get_deployed_fingerprints(args)
+        if args['deployed_fingerprints'] is False:
+            logging.warning("Failed to fetch deployed dashboard fingerprints - uploading all dashboards")
+            args['deployed_fingerprints'] = {}
+
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("Dumping args")
+        logging.debug(json.dumps({key: value for key, value in args.items() if key != 'input_payloads'}, indent=2))
+
+    results = create_dashboards(args)
+    for result in results:
+        inc('dashboards', status=result['status'])
+    print_summary(results)
+    log_request_stats()
+
+    if any(result['status'] == 'failed' for result in results):
         return 1
-
     return 0
 
 
 if __name__ == "__main__":
-    exit_status = main()
+    exit_status = run_instrumented('create_grafana_dashboard', main)
     sys.exit(exit_status)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+"""
+Evaluate anomaly macros of last9-alert-catalog/macros.txt over recorded series, offline (see last9_macro_eval)
+
+Each --call names a macro and its arguments but the last one - the metric - which is every selected series (see
+last9_backtest for the series file layouts). All series are evaluated at once, on their common 1 minute grid. The
+summary lists, per call and series, the steps with a result and those with a result above zero, which is when the
+catalog's anomaly rules (greater_than: 0) are bad. --output writes the results as a series file, one
+"<call>/<series>" column each, which backtest_alerts.py and this script read back.
+
+Sample usage
+
+python scripts/evaluate_macros.py --series exports/ --call 'high_spike(9)' --call 'low_value(5)'
+python scripts/evaluate_macros.py --series pg-metrics.csv --select 'HighConnection*' --call 'changepoint(3)' \
+    --output anomalies.npz
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import fnmatch
+import argparse
+import logging
+
+import numpy as np
+
+from last9_backtest import STEP_SEC, SeriesError, load_series, stack_series
+from last9_macro_eval import MacroEvaluator
+from last9_macros import DEFAULT_MACROS_FILE, load_macros, parse_call
+
+SUMMARY_COLUMNS = ("call", "series", "points", "results", "above_zero", "max")
+
+
+def load_args():
+    """Parse cli"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--series",
+        action="append",
+        help="CSV / NPZ / Parquet series file or directory of them - repeat for several",
+        required=True,
+    )
+    parser.add_argument("--select", action="append", help="Only series whose name matches this glob - repeatable")
+    parser.add_argument(
+        "--call",
+        action="append",
+        help="Macro call without its metric argument, e.g. high_spike(9) - repeat for several",
+        required=True,
+    )
+    parser.add_argument("--macros-file", help="Macros file", default=DEFAULT_MACROS_FILE)
+    parser.add_argument("--output", help="Write the results to this .npz or .csv series file", default=None)
+    parser.add_argument("--format", help="Output format", choices=["table", "json"], default="table")
+    parser.add_argument("--log-level", help="Log level", default=os.environ.get("LOG_LEVEL", "INFO"))
+    return vars(parser.parse_args(sys.argv[1:]))
+
+
+def validate_args(args):
+    """Validate input args"""
+    for path in args["series"] + [args["macros_file"]]:
+        if not os.path.exists(path):
+            logging.error("%s does not exist", path)
+            return False
+    if args["output"] and os.path.splitext(args["output"])[1].lower() not in (".npz", ".csv"):
+        logging.error("output=%s must be a .npz or .csv file", args["output"])
+        return False
+    return True
+
+
+def parse_calls(evaluator, calls):
+    """[(call, macro name, leading argument values)] of --call options, None if one is invalid"""
+    parsed = []
+    for call in calls:
+        name, arg_texts = parse_call(call) or (call.strip(), [])
+        macro = evaluator.macros.get(name)
+        if macro is None:
+            logging.error("--call %s - unknown macro %s", call, name)
+            return None
+        if len(arg_texts) != len(macro.params) - 1:
+            logging.error(
+                "--call %s - %s(%s) takes %d arguments before the metric",
+                call,
+                name,
+                ", ".join(macro.params),
+                len(macro.params) - 1,
+            )
+            return None
+        try:
+            parsed.append((call, name, [evaluator.evaluate(arg_text) for arg_text in arg_texts]))
+        except ValueError as ex:
+            logging.error("--call %s - %s", call, ex)
+            return None
+    return parsed
+
+
+def summary_rows(call, names, inputs, result):
+    """Summary row per series of one call's result"""
+    present = ~np.isnan(result)
+    above_zero = present & (np.where(present, result, 0) > 0)
+    rows = []
+    for index, name in enumerate(names):
+        values = result[index][present[index]]
+        rows.append(
+            {
+                "call": call,
+                "series": name,
+                "points": int(np.count_nonzero(~np.isnan(inputs[index]))),
+                "results": int(values.size),
+                "above_zero": int(np.count_nonzero(above_zero[index])),
+                "max": float(values.max()) if values.size else None,
+            }
+        )
+    return rows
+
+
+def write_output(path, start, steps, columns):
+    """Write {name: row} as a wide series file"""
+    timestamps = start + STEP_SEC * np.arange(steps, dtype=np.int64)
+    if path.lower().endswith(".npz"):
+        np.savez_compressed(path, timestamp=timestamps, **columns)
+        return
+    with open(path, "w", encoding="utf-8", newline="") as output_fd:
+        csv.writer(output_fd).writerow(["timestamp"] + list(columns))
+        table = np.column_stack([timestamps] + list(columns.values()))
+        np.savetxt(output_fd, table, delimiter=",", fmt=["%d"] + ["%.10g"] * len(columns))
+
+
+def print_table(rows):
+    """Print the summary rows"""
+    cells = [[("" if row[column] is None else str(row[column])) for column in SUMMARY_COLUMNS] for row in rows]
+    widths = [
+        max([len(column)] + [len(cell[index]) for cell in cells]) for index, column in enumerate(SUMMARY_COLUMNS)
+    ]
+    print("  ".join(column.ljust(width) for column, width in zip(SUMMARY_COLUMNS, widths)).rstrip())
+    for cell in cells:
+        print("  ".join(value.ljust(width) for value, width in zip(cell, widths)).rstrip())
+
+
+def setup_logging(log_level):
+    """Setup logging"""
+    log_level = getattr(logging, log_level.upper())
+    logging.basicConfig(
+        level=log_level, format="%(asctime)s.%(msecs)03d %(levelname)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    return True
+
+
+def main():
+    """Main function"""
+    args = load_args()
+
+    if not setup_logging(args["log_level"]):
+        return 1
+
+    if not validate_args(args):
+        return 1
+
+    evaluator = MacroEvaluator(load_macros(args["macros_file"]), step_sec=STEP_SEC)
+    calls = parse_calls(evaluator, args["call"])
+    if calls is None:
+        return 1
+
+    try:
+        series = load_series(args["series"])
+    except (OSError, SeriesError) as ex:
+        logging.error("Failed to load series - %s", ex)
+        return 1
+    names = sorted(
+        name
+        for name in series
+        if not args["select"] or any(fnmatch.fnmatchcase(name, glob) for glob in args["select"])
+    )
+    if not names:
+        logging.error("No series selected")
+        return 1
+    start, inputs = stack_series([series[name] for name in names])
+
+    rows = []
+    columns = {}
+    for call, name, leading_args in calls:
+        began = time.perf_counter()
+        try:
+            result = evaluator.evaluate_macro(name, leading_args + [inputs])
+        except ValueError as ex:
+            logging.error("Failed to evaluate %s - %s", call, ex)
+            return 1
+        elapsed = time.perf_counter() - began
+        outputs = result if isinstance(result, dict) else {None: result}
+        for alias, output in outputs.items():
+            output = np.broadcast_to(np.asarray(output, dtype=np.float64), inputs.shape)
+            label = call if alias is None else f"{call}/{alias}"
+            rows.extend(summary_rows(label, names, inputs, output))
+            columns.update({f"{label}/{series_name}": output[index] for index, series_name in enumerate(names)})
+        logging.info(
+            "Evaluated %s over %d series x %d steps in %.3f s - %.1f M points/s",
+            call,
+            inputs.shape[0],
+            inputs.shape[1],
+            elapsed,
+            inputs.size / max(elapsed, 1e-9) / 1e6,
+        )
+
+    if args["format"] == "json":
+        print(json.dumps(rows, indent=2))
+    else:
+        print_table(rows)
+
+    if args["output"]:
+        try:
+            write_output(args["output"], start, inputs.shape[1], columns)
+        except OSError as ex:
+            logging.error("Failed to write %s - %s", args["output"], ex)
+            return 1
+        logging.info("Wrote %d result series to %s", len(columns), args["output"])
+    return 0
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    sys.exit(exit_status)
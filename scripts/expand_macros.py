@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+"""
+Expand the Levitate macro calls of the alert catalog into plain MetricsQL (see last9_macros)
+
+Every alert rule expression and indicator query of the catalog calling a macro is expanded, macro arguments naming an
+indicator of the same entity being replaced by its query. Sub-expressions evaluated more than once per entity are
+listed after the expansions with a suggested shared indicator name - candidates for recording-style indicators.
+
+Sample usage
+
+python scripts/expand_macros.py
+python scripts/expand_macros.py --format json
+python scripts/expand_macros.py --expression 'high_spike(3, sum(rate(http_requests_total{code=~"5.."}[1m])))'
+"""
+
+import os
+import sys
+import glob
+import json
+import hashlib
+import argparse
+import logging
+
+from last9_catalog import DEFAULT_CATALOG_DIR
+from last9_macros import MacroExpander, load_macros, shared_subexpressions
+from last9_yaml import load_yaml_file
+
+SHARED_INDICATOR_PREFIX = "shared:"
+MACROS_FILE_NAME = "macros.txt"
+
+
+def load_args():
+    """Parse cli"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--catalog-dir", help="Alert catalog directory", default=DEFAULT_CATALOG_DIR)
+    parser.add_argument("--macros-file", help="Macros file (default: <catalog-dir>/macros.txt)", default=None)
+    parser.add_argument("--expression", help="Expand this expression instead of the catalog", default=None)
+    parser.add_argument("--format", help="Output format", choices=["table", "json"], default="table")
+    parser.add_argument("--log-level", help="Log level", default=os.environ.get("LOG_LEVEL", "INFO"))
+    return vars(parser.parse_args(sys.argv[1:]))
+
+
+def validate_args(args):
+    """Validate input args"""
+    if args["macros_file"] is None:
+        args["macros_file"] = os.path.join(args["catalog_dir"], MACROS_FILE_NAME)
+    if not os.path.isfile(args["macros_file"]):
+        logging.error("macros_file=%s does not exist", args["macros_file"])
+        return False
+    if args["expression"] is None and not os.path.isdir(args["catalog_dir"]):
+        logging.error("catalog_dir=%s is not a directory", args["catalog_dir"])
+        return False
+    return True
+
+
+def shared_indicator_name(query):
+    """Stable name for an indicator holding a shared sub-expression"""
+    return SHARED_INDICATOR_PREFIX + hashlib.sha256(query.encode("utf-8")).hexdigest()[:12]
+
+
+def expand_catalog(expander, catalog_dir):
+    """Expansions of the macro calls of every catalog file, and the shared sub-expressions of each entity"""
+    rows, shared = [], []
+    for path in sorted(glob.glob(f"{catalog_dir}/*.yaml")):
+        file_name = os.path.basename(path)
+        try:
+            catalog_ds = load_yaml_file(path) or {}
+        except Exception as ex:  # pylint: disable=broad-except
+            logging.warning("Skipping catalog file %s - failed to parse - %s", path, str(ex).replace("\n", " "))
+            continue
+
+        for entity in catalog_ds.get("entities") or []:
+            entity_ref = entity.get("external_ref") or entity.get("name")
+            queries = {
+                indicator.get("name"): str(indicator.get("query") or "")
+                for indicator in entity.get("indicators") or []
+            }
+            sources = [("indicator", name, query) for name, query in queries.items()]
+            sources += [
+                ("rule", rule.get("name"), str(rule.get("expression") or ""))
+                for rule in entity.get("alert_rules") or []
+            ]
+
+            entity_expansions = []
+            for kind, name, text in sources:
+                if not expander.has_calls(text):
+                    continue
+                try:
+                    expanded = expander.expand(text, resolve=queries.get, expansions=entity_expansions)
+                except ValueError as ex:
+                    logging.error("%s: failed to expand %s %r - %s", file_name, kind, name, ex)
+                    continue
+                rows.append(
+                    {
+                        "file": file_name,
+                        "entity": entity_ref,
+                        "kind": kind,
+                        "name": name,
+                        "text": text,
+                        "query": expanded,
+                    }
+                )
+
+            for entry in shared_subexpressions(entity_expansions):
+                shared.append(
+                    {"file": file_name, "entity": entity_ref, "name": shared_indicator_name(entry["query"]), **entry}
+                )
+    return rows, shared
+
+
+def print_table(rows, shared):
+    """Print expansions and shared sub-expressions"""
+    for row in rows:
+        print(f"{row['file']}  {row['entity']}  {row['kind']} {row['name']!r}")
+        print(f"    {row['text']}")
+        print(f"    => {row['query']}")
+    if shared:
+        print("\nShared sub-expressions (evaluations per entity, suggested indicator, source lets):")
+    for entry in shared:
+        sources = ",".join(entry["sources"])
+        print(f"{entry['file']}  {entry['entity']}  {entry['evaluations']}x  {entry['name']}  {sources}")
+        print(f"    {entry['query']}")
+
+
+def setup_logging(log_level):
+    """Setup logging"""
+    log_level = getattr(logging, log_level.upper())
+    logging.basicConfig(
+        level=log_level, format="%(asctime)s.%(msecs)03d %(levelname)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    return True
+
+
+def main():
+    """Main function"""
+    args = load_args()
+
+    if not setup_logging(args["log_level"]):
+        return 1
+
+    if not validate_args(args):
+        return 1
+
+    try:
+        expander = MacroExpander(load_macros(args["macros_file"]))
+    except ValueError as ex:
+        logging.error("Failed to parse macros_file=%s - %s", args["macros_file"], ex)
+        return 1
+
+    if args["expression"] is not None:
+        try:
+            print(expander.expand(args["expression"]))
+        except ValueError as ex:
+            logging.error("Failed to expand expression - %s", ex)
+            return 1
+        return 0
+
+    rows, shared = expand_catalog(expander, args["catalog_dir"])
+    if args["format"] == "json":
+        print(json.dumps({"expansions": rows, "shared": shared}, indent=2))
+    else:
+        print_table(rows, shared)
+    logging.info("Expanded %d macro calls - %d cache hits, %d misses", len(rows), expander.hits, expander.misses)
+    return 0
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    sys.exit(exit_status)
@@ -6,12 +6,45 @@ Fetch existing alert definitions from Last9 API and save them as YAML files
 import os
 import sys
 import json
+import math
+import time
 import argparse
+import queue
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import logging
+import multiprocessing
+import threading
 import requests
 from pathlib import Path
-from typing import Dict, List, Optional, Any
-from urllib.parse import urlparse
+from itertools import chain
+from typing import Dict, List, Optional, Any, Iterable, Iterator, Tuple
+from urllib.parse import quote, urlparse
+
+from last9_cache import cache_path, locked_json_cache
+from last9_config import ConfigError, parse_iac_config, read_config_file
+from last9_http import (
+    TokenBucket, get_access_token as get_cached_access_token, get_session, invalidate_access_token, log_request_stats,
+    new_session,
+)
+from last9_instrument import inc, run_instrumented, span
+
+# Endpoint which last answered for each (api_base_url, org)
+ENDPOINT_CACHE_FILE = os.environ.get("LAST9_ENDPOINT_CACHE_FILE", cache_path("endpoint-cache"))
+
+# Per output dir manifest of content hashes used by --incremental
+MANIFEST_FILE_NAME = ".last9-fetch-manifest.json"
+MANIFEST_VERSION = 1
+
+# Alert files serialized and written per worker task
+WRITE_BATCH_SIZE = 64
+
+# A listed entity without these keys is a summary - notification_channels alone is left out of entities without any
+SUMMARY_MISSING_KEYS = ('indicators', 'alert_rules')
+DEFAULT_HYDRATE_URL = '{endpoint}/{id}'
+# Entities held back per --hydrate-concurrency while the details of the oldest one are fetched, to keep their order
+HYDRATE_WINDOW_FACTOR = 4
 
 # Try to import yaml, install if needed
 try:
@@ -22,6 +55,12 @@ except ImportError:
     subprocess.check_call([sys.executable, "-m", "pip", "install", "PyYAML"])
     import yaml
 
+from last9_layout import (  # noqa: E402 - needs PyYAML installed above
+    ARCHIVE_SUFFIX, DEFAULT_SHARDS, OUTPUT_FORMATS, ArchiveWriter, LayoutWriter, entity_file_name, entity_type,
+    remove_stale_layout_files,
+)
+from last9_yaml import write_yaml_files  # noqa: E402 - needs PyYAML installed above
+
 
 def load_args():
     """Parse command line arguments"""
@@ -94,7 +133,87 @@ Examples:
         default="alert-manager"
     )
 
+    # Pagination options
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        help="Number of entities to request per page (default: 500, 0 disables pagination)",
+        default=int(os.environ.get("LAST9_FETCH_PAGE_SIZE", "500"))
+    )
+    parser.add_argument(
+        "--pagination",
+        choices=["auto", "cursor", "page", "none"],
+        help="Pagination style of the entities endpoint (default: auto - detect from the first page)",
+        default="auto"
+    )
+
+    # Endpoint discovery options
+    parser.add_argument(
+        "--probe-timeout",
+        type=float,
+        help="Timeout in seconds for each parallel endpoint discovery probe (default: 15)",
+        default=15
+    )
+
+    # Entity detail options
+    parser.add_argument(
+        "--hydrate",
+        choices=["auto", "always", "never"],
+        help="Fetch each entity's full definition from its detail endpoint - auto: only for entities listed without "
+             "indicators or alert_rules (default: auto)",
+        default="auto"
+    )
+    parser.add_argument(
+        "--hydrate-concurrency",
+        type=int,
+        help="Number of entity detail requests in flight at once (default: 8)",
+        default=int(os.environ.get("LAST9_FETCH_HYDRATE_CONCURRENCY", "8"))
+    )
+    parser.add_argument(
+        "--hydrate-rate",
+        type=float,
+        help="Entity detail requests per second, 0 for no limit (default: 50)",
+        default=float(os.environ.get("LAST9_FETCH_HYDRATE_RATE", "50"))
+    )
+    parser.add_argument(
+        "--hydrate-url",
+        help="Entity detail URL - {endpoint} is the entities endpoint, {id} the entity id (or external_ref if it has "
+             f"none), {{external_ref}} its external_ref (default: {DEFAULT_HYDRATE_URL})",
+        default=DEFAULT_HYDRATE_URL
+    )
+
+    # Output options
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of worker processes serializing and writing alert files (default: min(4, cpu count))",
+        default=int(os.environ.get("LAST9_FETCH_WORKERS", min(4, os.cpu_count() or 1)))
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=OUTPUT_FORMATS,
+        help="files: one <alert-name>.yaml per alert, by-type: one <type>.yaml per alert type, "
+             "shards: --shards alerts-NNN-of-MMM.yaml files (default: files)",
+        default="files"
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        help=f"Number of files of --output-format shards (default: {DEFAULT_SHARDS})",
+        default=DEFAULT_SHARDS
+    )
+    parser.add_argument(
+        "--archive",
+        help=f"Also write every alert to this gzip compressed JSON Lines file ({ARCHIVE_SUFFIX}), e.g. for backups",
+        default=None
+    )
+
     # Behavior options
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only rewrite alert files whose content changed since the last fetch (tracked in the output dir)"
+    )
     parser.add_argument(
         "--dry-run",
         action="store_true",
@@ -112,42 +231,25 @@ Examples:
 def validate_args(args: Dict) -> bool:
     """Validate and normalize arguments"""
 
-    # Try to load config from file first
-    if os.path.exists(args['config_file']):
-        try:
-            with open(args['config_file'], 'r') as f:
-                config = json.load(f)
-
-            # Extract API config
-            iac_config = config.get('iac_config', {})
-            api_config = iac_config.get('api_config', {})
-            read_config = api_config.get('read', {})
-
-            args['read_refresh_token'] = read_config.get('refresh_token', '')
-            args['api_base_url'] = read_config.get('api_base_url', '')
-            args['org'] = read_config.get('org', '')
-
+    # Try to load config from file first, then from the environment variable
+    try:
+        if os.path.exists(args['config_file']):
+            config_ds = read_config_file(args['config_file'])
+            read_config = parse_iac_config(config_ds.get('iac_config') or {}, args['config_file']).api('read')
             logging.info(f"Loaded configuration from {args['config_file']}")
-
-        except Exception as ex:
-            logging.error(f"Failed to load config file: {ex}")
-            return False
-
-    # Try environment variable if config file didn't work
-    elif args['api_config_str']:
-        try:
-            config_ds = json.loads(args['api_config_str'])
-            read_config = config_ds.get('api_config', {}).get('read', {})
-
-            args['read_refresh_token'] = read_config.get('refresh_token', '')
-            args['api_base_url'] = read_config.get('api_base_url', '')
-            args['org'] = read_config.get('org', '')
-
+        elif args['api_config_str']:
+            read_config = parse_iac_config(args['api_config_str']).api('read')
             logging.info("Loaded configuration from LAST9_API_CONFIG_STR")
+        else:
+            read_config = None
+    except ConfigError as ex:
+        logging.error(f"Failed to load config: {ex}")
+        return False
 
-        except Exception as ex:
-            logging.error(f"Failed to parse LAST9_API_CONFIG_STR: {ex}")
-            return False
+    if read_config is not None:
+        args['read_refresh_token'] = read_config.refresh_token
+        args['api_base_url'] = read_config.api_base_url
+        args['org'] = read_config.org
 
     # Validate required fields
     if not args['read_refresh_token']:
@@ -163,6 +265,36 @@ def validate_args(args: Dict) -> bool:
         logging.error("Organization not provided")
         return False
 
+    if args['workers'] < 1:
+        logging.error("--workers must be at least 1")
+        return False
+
+    if args['shards'] < 1:
+        logging.error("--shards must be at least 1")
+        return False
+
+    if args['hydrate_concurrency'] < 1:
+        logging.error("--hydrate-concurrency must be at least 1")
+        return False
+
+    if args['hydrate_rate'] < 0:
+        logging.error("--hydrate-rate must not be negative")
+        return False
+
+    try:
+        args['hydrate_url'].format(endpoint='', id='', external_ref='')
+    except (KeyError, IndexError, ValueError) as ex:
+        logging.error(f"--hydrate-url {args['hydrate_url']} is not a valid template: {ex!r}")
+        return False
+
+    if args['incremental'] and args['output_format'] != 'files':
+        logging.error("--incremental only applies to --output-format files")
+        return False
+
+    if args['archive'] and not args['archive'].endswith(ARCHIVE_SUFFIX):
+        logging.error(f"--archive must end with {ARCHIVE_SUFFIX}")
+        return False
+
     # Set default output directory based on org if not specified
     if not args['output_dir']:
         args['output_dir'] = f"../{args['org']}-alerts"
@@ -179,15 +311,8 @@ def validate_args(args: Dict) -> bool:
 
 def get_access_token(args: Dict) -> Optional[str]:
     """Exchange refresh token for access token"""
-    url = f"{args['api_base_url']}/oauth/access_token"
-    headers = {"Content-Type": "application/json"}
-    data = {"refresh_token": args['read_refresh_token']}
-
     try:
-        response = requests.post(url, headers=headers, json=data, timeout=60)
-        response.raise_for_status()
-
-        access_token = response.json()['access_token']
+        access_token = get_cached_access_token(args['api_base_url'], args['read_refresh_token'])
         logging.info("Successfully obtained access token")
         return access_token
 
@@ -198,11 +323,157 @@ def get_access_token(args: Dict) -> Optional[str]:
         return None
 
 
-def fetch_alerts(args: Dict, access_token: str) -> Optional[List[Dict]]:
-    """Fetch all alert definitions from Last9 API"""
+def _extract_entities(data: Any) -> List[Dict]:
+    """Extract the entity list from a response page"""
+    # Response structure may vary - handle different formats
+    if isinstance(data, list):
+        return data
+    if isinstance(data, dict):
+        # Try common keys
+        return data.get('entities', data.get('data', data.get('results', []))) or []
+    return []
+
+
+def _extract_next_cursor(data: Any) -> Optional[str]:
+    """Extract the next page cursor (or next page URL) from a response page, if any"""
+    if not isinstance(data, dict):
+        return None
+    for key in ('next_cursor', 'cursor', 'next'):
+        if data.get(key):
+            return str(data[key])
+    pagination = data.get('pagination') or data.get('meta') or {}
+    if isinstance(pagination, dict):
+        for key in ('next_cursor', 'cursor', 'next'):
+            if pagination.get(key):
+                return str(pagination[key])
+    return None
+
+
+def _page_params(args: Dict, params: Dict, page: int = 1, cursor: Optional[str] = None) -> Dict:
+    """Query parameters for one page request"""
+    page_params = dict(params)
+    if args['pagination'] == 'none' or args['page_size'] <= 0:
+        return page_params
+    page_params['limit'] = args['page_size']
+    if cursor:
+        page_params['cursor'] = cursor
+    elif args['pagination'] != 'cursor':
+        # Page 1 too - a page numbered API whose default page size is smaller would otherwise answer with a short first
+        # page, which looks like the last one
+        page_params['page'] = page
+        page_params['per_page'] = args['page_size']
+    return page_params
+
+
+def iter_alert_pages(args: Dict, url: str, headers: Dict, params: Dict, first_page: Any) -> Iterator[List[Dict]]:
+    """Yield pages of entities following cursor or page based pagination
+
+    Stops on an empty or short page, when the server ignores the page size, or when a page repeats the previous one,
+    so endpoints which do not paginate at all are only read once.
+    """
+    page_size = args['page_size']
+    page = 1
+    data = first_page
+    entities = _extract_entities(data)
+
+    while True:
+        logging.info(f"Fetched page {page} with {len(entities)} alert definitions")
+        yield entities
+
+        if args['pagination'] == 'none' or page_size <= 0:
+            return
+        if not entities or len(entities) > page_size:
+            return
+
+        cursor = _extract_next_cursor(data)
+        if args['pagination'] == 'cursor' and not cursor:
+            return
+        if not cursor and len(entities) < page_size:
+            return
+
+        first_ref = (entities[0].get('external_ref'), entities[0].get('name'))
+        page += 1
+        if cursor and cursor.startswith(('http://', 'https://')):
+            response = get_session().get(cursor, headers=headers, timeout=60)
+        else:
+            response = get_session().get(
+                url, headers=headers, params=_page_params(args, params, page=page, cursor=cursor), timeout=60
+            )
+        response.raise_for_status()
+
+        data = response.json()
+        entities = _extract_entities(data)
+        if entities and (entities[0].get('external_ref'), entities[0].get('name')) == first_ref:
+            logging.debug(f"Page {page} repeats page {page - 1} - endpoint does not paginate")
+            return
+
+
+def _probe_endpoint(
+    session, url: str, headers: Dict, params: Dict, timeout: float
+) -> Tuple[str, Optional[int], Any, Optional[str]]:
+    """Request the first page of a candidate endpoint - returns (url, status_code, data, etag)"""
+    try:
+        logging.debug(f"Trying endpoint: {url}")
+        response = session.get(url, headers=headers, params=params, timeout=timeout)
+    except requests.exceptions.RequestException as ex:
+        logging.debug(f"Endpoint {url} failed: {ex}")
+        return url, None, None, None
+
+    if response.status_code != 200:
+        return url, response.status_code, None, None
+
+    try:
+        return url, 200, response.json(), response.headers.get('ETag')
+    except ValueError as ex:
+        logging.debug(f"Endpoint {url} returned invalid json: {ex}")
+        return url, None, None, None
+
+
+def _discover_endpoint(
+    args: Dict, endpoints: List[str], headers: Dict, params: Dict
+) -> Tuple[Optional[str], Any, Optional[str], set]:
+    """Probe all candidate endpoints in parallel and return the first one answering with alerts
+
+    Returns (url, first_page_data, etag, statuses seen); url is None if no endpoint answered with alerts.
+    """
+    statuses = set()
+    # Probes get their own session with a single retry, and run on daemon threads so a hung candidate neither holds up
+    # the winner nor the interpreter exit
+    probe_session = new_session(pool_size=len(endpoints), max_retries=1)
+    results = queue.Queue()
+    timeout = args['probe_timeout']
+    for url in endpoints:
+        threading.Thread(
+            target=lambda u=url: results.put(_probe_endpoint(probe_session, u, headers, params, timeout)),
+            name=f"probe-{url}",
+            daemon=True,
+        ).start()
+
+    for _ in endpoints:
+        url, status_code, data, etag = results.get()
+        statuses.add(status_code)
+        if status_code == 200:
+            if _extract_entities(data):
+                return url, data, etag, statuses
+            logging.debug(f"No alerts found at endpoint {url}")
+        elif status_code == 404:
+            logging.debug(f"Endpoint not found: {url}")
+        elif status_code is not None:
+            logging.debug(f"Endpoint {url} returned status {status_code}")
+
+    return None, None, None, statuses
+
+
+def fetch_alerts(args: Dict, access_token: str, retry_unauthorized: bool = True) -> Optional[Iterator[Dict]]:
+    """Fetch all alert definitions from Last9 API
+
+    Returns an iterator streaming entities page by page, or None if no endpoint could be read. If the access token is
+    rejected with 401 - a cached token may have been revoked - it is dropped from the cache and the refresh token
+    exchanged once more.
+    """
 
     # Possible API endpoint patterns to try
-    # The exact endpoint may vary, so we try multiple patterns
+    # The exact endpoint may vary, so we probe them all and remember the one which worked
     possible_endpoints = [
         f"{args['api_base_url']}/organizations/{args['org']}/entities",
         f"{args['api_base_url']}/entities",
@@ -220,45 +491,78 @@ def fetch_alerts(args: Dict, access_token: str) -> Optional[List[Dict]]:
         'entity_class': args['entity_class']
     }
 
-    alerts = []
+    endpoint_key = f"{args['api_base_url']}|{args['org']}"
+    with locked_json_cache(ENDPOINT_CACHE_FILE, optional=True) as cache_ds:
+        cached_url = cache_ds.get(endpoint_key)
+
+    # In incremental mode a complete single page listing from the last run can be revalidated with its ETag
+    manifest_etag = args.get('manifest', {}).get('etag', {})
+    # An archive needs the full listing, a 304 would leave nothing to write to it
+    revalidate = bool(
+        not args['archive']
+        and cached_url
+        and manifest_etag.get('url') == cached_url
+        and manifest_etag.get('single_page')
+        and _manifest_files_exist(args)
+    )
 
-    for url in possible_endpoints:
-        try:
-            logging.debug(f"Trying endpoint: {url}")
-            response = requests.get(url, headers=headers, params=params, timeout=60)
-
-            if response.status_code == 200:
-                data = response.json()
-                logging.info(f"Successfully fetched data from endpoint")
-
-                # Extract alerts from response
-                # Response structure may vary - handle different formats
-                if isinstance(data, list):
-                    alerts = data
-                elif isinstance(data, dict):
-                    # Try common keys
-                    alerts = data.get('entities', data.get('data', data.get('results', [])))
-
-                if alerts:
-                    logging.info(f"Found {len(alerts)} alert definitions")
-                    return alerts
-                else:
-                    logging.debug(f"No alerts found at this endpoint")
-
-            elif response.status_code == 404:
-                logging.debug(f"Endpoint not found: {url}")
-            elif response.status_code == 401:
-                logging.error("Authentication failed - check your tokens")
-                return None
-            elif response.status_code == 403:
-                logging.error("Insufficient permissions - check token scope")
-                return None
-            else:
-                logging.debug(f"Endpoint returned status {response.status_code}")
-
-        except requests.exceptions.RequestException as ex:
-            logging.debug(f"Endpoint {url} failed: {ex}")
-            continue
+    url, data, etag, statuses = None, None, None, set()
+    if cached_url:
+        cached_headers = dict(headers, **{'If-None-Match': manifest_etag['etag']}) if revalidate else headers
+        _, status_code, cached_data, etag = _probe_endpoint(
+            get_session(), cached_url, cached_headers, _page_params(args, params), 60
+        )
+        statuses.add(status_code)
+        if status_code == 304:
+            logging.info("Alerts unchanged since last fetch (ETag matched)")
+            args['not_modified'] = True
+            return iter([])
+        if status_code == 200 and _extract_entities(cached_data):
+            logging.debug(f"Using cached endpoint: {cached_url}")
+            url, data = cached_url, cached_data
+        elif status_code == 404:
+            logging.info(f"Cached endpoint {cached_url} returned 404 - dropping it and rediscovering")
+            with locked_json_cache(ENDPOINT_CACHE_FILE, optional=True) as cache_ds:
+                cache_ds.pop(endpoint_key, None)
+
+    if url is None and not statuses & {401, 403}:
+        url, data, etag, probe_statuses = _discover_endpoint(
+            args, possible_endpoints, headers, _page_params(args, params)
+        )
+        statuses |= probe_statuses
+        if url is not None:
+            with locked_json_cache(ENDPOINT_CACHE_FILE, optional=True) as cache_ds:
+                cache_ds[endpoint_key] = url
+
+    if url is not None:
+        logging.info(f"Successfully fetched data from endpoint")
+        if 'manifest' in args:
+            entities = _extract_entities(data)
+            # Short pages and pages ignoring the page size hold the complete listing
+            single_page = not _extract_next_cursor(data) and (
+                args['pagination'] == 'none' or args['page_size'] <= 0 or len(entities) != args['page_size']
+            )
+            args['manifest']['etag'] = {'url': url, 'etag': etag, 'single_page': single_page} if etag else {}
+        pages = iter_alert_pages(args, url, headers, params, data)
+        alerts = chain.from_iterable(pages)
+        # A dry run only lists file names, which the summaries have
+        if args['hydrate'] != 'never' and not args['dry_run']:
+            return hydrate_alerts(args, url, headers, alerts)
+        return alerts
+
+    if 401 in statuses:
+        if retry_unauthorized:
+            logging.info("Access token rejected - exchanging the refresh token again")
+            invalidate_access_token(args['api_base_url'], args['read_refresh_token'])
+            access_token = get_access_token(args)
+            if access_token:
+                return fetch_alerts(args, access_token, retry_unauthorized=False)
+            return None
+        logging.error("Authentication failed - check your tokens")
+        return None
+    if 403 in statuses:
+        logging.error("Insufficient permissions - check token scope")
+        return None
 
     # If we get here, none of the endpoints worked
     logging.error("Could not fetch alerts from any known endpoint")
@@ -272,6 +576,136 @@ def fetch_alerts(args: Dict, access_token: str) -> Optional[List[Dict]]:
     return None
 
 
+def needs_hydration(args: Dict, alert: Dict) -> bool:
+    """Whether the full definition of a listed entity has to be fetched from its detail endpoint"""
+    if args['hydrate'] == 'auto' and all(key in alert for key in SUMMARY_MISSING_KEYS):
+        return False
+
+    # Incremental runs skip entities whose updated_at matches the manifest without looking at their content - unless
+    # the archive needs every entity in full
+    manifest = args.get('manifest')
+    if manifest is not None and not args['archive'] and alert.get('updated_at') is not None:
+        previous = manifest['entities'].get(alert.get('external_ref') or alert.get('name', 'unnamed'), {})
+        if (
+            previous.get('updated_at') == alert['updated_at']
+            and previous.get('file') == entity_file_name(alert)
+            and (Path(args['output_dir']) / previous['file']).exists()
+        ):
+            return False
+    return True
+
+
+def _extract_entity(data: Any) -> Any:
+    """Extract the entity from a detail response"""
+    if isinstance(data, dict):
+        for key in ('entity', 'data'):
+            if isinstance(data.get(key), dict):
+                return data[key]
+    return data
+
+
+def entity_detail_url(args: Dict, url: str, alert: Dict) -> str:
+    """Detail endpoint of a listed entity - url is the entities endpoint it was listed by"""
+    ref = alert.get('external_ref') or alert.get('name', 'unnamed')
+    return args['hydrate_url'].format(
+        endpoint=url,
+        id=quote(str(alert.get('id') or ref), safe=''),
+        external_ref=quote(str(ref), safe=''),
+    )
+
+
+def _fetch_entity_detail(
+    session, bucket: TokenBucket, detail_url: str, stats_key: str, headers: Dict, alert: Dict
+) -> Tuple[Dict, float, float]:
+    """Fetch the full definition of a listed entity - returns (entity, request seconds, rate limit wait seconds)"""
+    ref = alert.get('external_ref') or alert.get('name', 'unnamed')
+    wait_sec = bucket.acquire()
+    start = time.perf_counter()
+    try:
+        with span('hydrate_entity') as trace_args:
+            trace_args['external_ref'] = ref
+            response = session.get(detail_url, headers=headers, timeout=60, stats_key=stats_key)
+            response.raise_for_status()
+            detail = _extract_entity(response.json())
+            if not isinstance(detail, dict):
+                raise requests.exceptions.RequestException(f"{detail_url} did not return an entity")
+    except requests.exceptions.RequestException as ex:
+        logging.error(f"Failed to fetch details of alert {ref}: {ex}")
+        raise
+    # Fields only the summary has, such as updated_at, are kept
+    return dict(alert, **detail), time.perf_counter() - start, wait_sec
+
+
+def hydrate_alerts(args: Dict, url: str, headers: Dict, alerts: Iterable[Dict]) -> Iterator[Dict]:
+    """Replace listed summaries by the full entity definitions, fetched concurrently
+
+    Up to --hydrate-concurrency detail requests are in flight at once, started at no more than --hydrate-rate per
+    second. Entities stream through in listing order; each external_ref is fetched once, later duplicates are dropped.
+    Per entity request latencies are kept in args['hydrate_stats'] (see log_hydrate_stats).
+    """
+    concurrency = args['hydrate_concurrency']
+    # A session of its own - the shared one is sized for the sequential listing and would block the workers
+    session = new_session(pool_size=concurrency)
+    bucket = TokenBucket(args['hydrate_rate'], burst=concurrency)
+    # Request stats of all entities under one endpoint
+    template_url = args['hydrate_url'].format(endpoint=url, id='{id}', external_ref='{external_ref}')
+    stats_key = f"GET {urlparse(template_url).path}"
+    stats = args['hydrate_stats'] = {'latencies': [], 'wait_sec': 0.0, 'duplicates': 0, 'concurrency': concurrency}
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='hydrate')
+    pending = deque()
+    fetched_refs = set()
+
+    def _result(alert, future):
+        if future is None:
+            return alert
+        with span('hydrate_wait'):
+            entity, latency_sec, wait_sec = future.result()
+        stats['latencies'].append(latency_sec)
+        stats['wait_sec'] += wait_sec
+        return entity
+
+    try:
+        for alert in alerts:
+            future = None
+            if needs_hydration(args, alert):
+                ref = alert.get('external_ref') or alert.get('name', 'unnamed')
+                if ref in fetched_refs:
+                    logging.debug(f"Dropping duplicate listing of alert {ref}")
+                    stats['duplicates'] += 1
+                    continue
+                fetched_refs.add(ref)
+                detail_url = entity_detail_url(args, url, alert)
+                future = executor.submit(_fetch_entity_detail, session, bucket, detail_url, stats_key, headers, alert)
+            pending.append((alert, future))
+            while len(pending) > HYDRATE_WINDOW_FACTOR * concurrency:
+                yield _result(*pending.popleft())
+        while pending:
+            yield _result(*pending.popleft())
+    finally:
+        executor.shutdown(cancel_futures=True)
+        inc('alerts_hydrated', len(stats['latencies']))
+        inc('hydrate_duplicates', stats['duplicates'])
+
+
+def _percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest rank percentile of sorted values"""
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+def log_hydrate_stats(args: Dict):
+    """Log count and latency percentiles of the entity detail requests"""
+    stats = args.get('hydrate_stats')
+    if not stats or not stats['latencies']:
+        return
+    latencies = sorted(stats['latencies'])
+    logging.info(
+        f"Fetched details of {len(latencies)} alerts with concurrency {stats['concurrency']}: "
+        f"p50_ms={1000 * _percentile(latencies, 0.5):.1f} p90_ms={1000 * _percentile(latencies, 0.9):.1f} "
+        f"p99_ms={1000 * _percentile(latencies, 0.99):.1f} max_ms={1000 * latencies[-1]:.1f} "
+        f"avg_rate_limit_wait_ms={1000 * stats['wait_sec'] / len(latencies):.1f} duplicates={stats['duplicates']}"
+    )
+
+
 def convert_to_yaml(alert_entity: Dict) -> Dict:
     """Convert API response format to IaC YAML format"""
 
@@ -309,50 +743,230 @@ def convert_to_yaml(alert_entity: Dict) -> Dict:
     return yaml_entity
 
 
-def save_alerts(args: Dict, alerts: List[Dict]) -> int:
-    """Save alerts as YAML files to output directory"""
+def _manifest_path(args: Dict) -> Path:
+    return Path(args['output_dir']) / MANIFEST_FILE_NAME
+
+
+def load_manifest(args: Dict) -> Dict:
+    """Load the incremental fetch manifest from the output directory"""
+    manifest_path = _manifest_path(args)
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION:
+            return manifest
+        logging.info(f"Ignoring manifest {manifest_path} with unknown version")
+    except FileNotFoundError:
+        logging.info(f"No manifest found at {manifest_path} - fetching all alerts")
+    except (OSError, ValueError) as ex:
+        logging.warning(f"Ignoring unreadable manifest {manifest_path}: {ex}")
+    return {'version': MANIFEST_VERSION, 'entities': {}, 'etag': {}}
+
+
+def save_manifest(args: Dict, manifest: Dict):
+    """Atomically write the incremental fetch manifest"""
+    manifest_path = _manifest_path(args)
+    tmp_path = manifest_path.with_name(f".{manifest_path.name}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def _manifest_files_exist(args: Dict) -> bool:
+    output_dir = Path(args['output_dir'])
+    return all((output_dir / entry['file']).exists() for entry in args['manifest']['entities'].values())
+
+
+def entity_hash(yaml_entity: Dict) -> str:
+    """Canonical content hash of a converted entity"""
+    canonical = json.dumps(yaml_entity, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def save_alerts(args: Dict, alerts: Iterable[Dict]) -> Tuple[int, Dict[str, int]]:
+    """Save alerts as YAML files to output directory, in the layout of --output-format
+
+    alerts may be a stream - each entity is converted and written as it arrives. With --archive every alert is also
+    written to the archive. Returns the number of alerts saved and their counts by type.
+    """
 
     if args['dry_run']:
         print("\n" + "="*60)
         print("DRY RUN - Would save the following alerts:")
         print("="*60)
+        layout = LayoutWriter(args['output_dir'], args['output_format'], args['shards'])
+        count = 0
         for alert in alerts:
-            alert_name = alert.get('name', 'unnamed')
-            print(f"  {alert_name}.yaml")
-        return len(alerts), {}
-
-    output_dir = Path(args['output_dir'])
-    saved_count = 0
-    type_counts = {}
+            print(f"  {layout.file_name(alert)}: {alert.get('name', 'unnamed')}")
+            count += 1
+        return count, {}
 
-    # Save each alert as a separate file directly in output directory
+    archive = ArchiveWriter(args['archive']) if args['archive'] else None
+    if archive is not None:
+        alerts = _archived(alerts, archive)
+    try:
+        if args['output_format'] == 'files':
+            result = _save_files(args, alerts)
+        else:
+            result = _save_grouped(args, alerts)
+    except BaseException:
+        if archive is not None:
+            archive.abort()
+        raise
+    if archive is not None:
+        with span('write_archive'):
+            archive.close()
+        logging.info(f"Archived {archive.count} alerts to {archive.path}")
+    return result
+
+
+def _archived(alerts: Iterable[Dict], archive: ArchiveWriter) -> Iterator[Dict]:
+    """Pass alerts through, writing each converted alert to the archive"""
     for alert in alerts:
-        alert_name = alert.get('name', 'unnamed').lower().replace(' ', '-').replace('_', '-')
-        entity_type = alert.get('type', 'unknown').lower().replace(' ', '-')
+        archive.write(convert_to_yaml(alert))
+        yield alert
 
-        # Track counts by type for summary
-        type_counts[entity_type] = type_counts.get(entity_type, 0) + 1
 
-        # Convert to YAML format
-        yaml_entity = convert_to_yaml(alert)
+def _save_grouped(args: Dict, alerts: Iterable[Dict]) -> Tuple[int, Dict[str, int]]:
+    """Save alerts grouped into multi-entity files - by type or into shards"""
+    type_counts = {}
+    with LayoutWriter(args['output_dir'], args['output_format'], args['shards']) as layout:
+        for alert in alerts:
+            type_counts[entity_type(alert)] = type_counts.get(entity_type(alert), 0) + 1
+            layout.write(convert_to_yaml(alert))
+    for output_file, count in sorted(layout.counts.items()):
+        logging.info(f"Saved: {output_file} ({count} alerts)")
+    # Files of an earlier run in another layout or with another --shards would deploy their alerts a second time
+    for path in layout.removed:
+        logging.info(f"Removed: {path} (left by another layout)")
+    return sum(layout.counts.values()), type_counts
 
-        # Wrap in entities array to match template format
-        yaml_data = {
-            'entities': [yaml_entity]
-        }
 
-        # Write YAML file directly in output directory
-        output_file = output_dir / f"{alert_name}.yaml"
+def _save_files(args: Dict, alerts: Iterable[Dict]) -> Tuple[int, Dict[str, int]]:
+    """Save each alert as a separate <alert-name>.yaml file
 
-        try:
-            with open(output_file, 'w') as f:
-                yaml.dump(yaml_data, f, default_flow_style=False, sort_keys=False, allow_unicode=True)
+    In incremental mode entities whose updated_at or canonical content hash match the manifest are skipped; the
+    skipped count is set in args['unchanged_count'].
+    """
 
-            logging.info(f"Saved: {output_file}")
-            saved_count += 1
+    output_dir = Path(args['output_dir'])
+    saved_count = 0
+    type_counts = {}
+    incremental = 'manifest' in args
+    previous_entries = args['manifest']['entities'] if incremental else {}
+    current_entries = {}
+    refs_by_file = {}
+    output_files = set()
+    args['unchanged_count'] = 0
+
+    # Serialization and writes run in a process pool, WRITE_BATCH_SIZE files per task with a bounded number of tasks
+    # in flight so memory stays flat while entities stream in. Workers come from a forkserver, as forking this process
+    # while its HTTP and hydration threads hold locks can deadlock the children.
+    executor = None
+    if args['workers'] > 1:
+        mp_context = multiprocessing.get_context('forkserver')
+        executor = ProcessPoolExecutor(max_workers=args['workers'], mp_context=mp_context)
+    pending = deque()
+    batch = []
+
+    def _collect(results):
+        nonlocal saved_count
+        for output_file, error in results:
+            if error is None:
+                logging.info(f"Saved: {output_file}")
+                saved_count += 1
+                continue
+            logging.error(f"Failed to save {output_file}: {error}")
+            inc('alert_save_errors')
+            if incremental:
+                # Make sure the next incremental run retries this entity
+                current_entries.pop(refs_by_file[output_file], None)
+
+    def _flush():
+        nonlocal batch
+        if not batch:
+            return
+        if executor is None:
+            with span('write_yaml'):
+                results = write_yaml_files(batch)
+            _collect(results)
+        else:
+            pending.append(executor.submit(write_yaml_files, batch))
+            while len(pending) > 2 * args['workers']:
+                # Time spent blocked on the pool - the dumps themselves run in the worker processes
+                with span('write_yaml_wait'):
+                    results = pending.popleft().result()
+                _collect(results)
+        batch = []
+
+    def _drain():
+        _flush()
+        while pending:
+            with span('write_yaml_wait'):
+                results = pending.popleft().result()
+            _collect(results)
 
-        except Exception as ex:
-            logging.error(f"Failed to save {output_file}: {ex}")
+    try:
+        # Save each alert as a separate file directly in output directory
+        for alert in alerts:
+            alert_type = entity_type(alert)
+
+            # Track counts by type for summary
+            type_counts[alert_type] = type_counts.get(alert_type, 0) + 1
+
+            # Write YAML file directly in output directory
+            output_file = output_dir / entity_file_name(alert)
+            output_files.add(str(output_file))
+            if str(output_file) in refs_by_file:
+                logging.warning(f"Multiple alerts map to {output_file} - keeping the last one")
+                # Finish queued writes first so the last alert wins regardless of worker scheduling
+                _drain()
+
+            if incremental:
+                ref = alert.get('external_ref') or alert.get('name', 'unnamed')
+                previous = previous_entries.get(ref, {})
+                unchanged_on_disk = previous.get('file') == output_file.name and output_file.exists()
+                updated_at = alert.get('updated_at')
+
+                # Server side change marker - skip without even converting the entity
+                if unchanged_on_disk and updated_at is not None and previous.get('updated_at') == updated_at:
+                    current_entries[ref] = previous
+                    args['unchanged_count'] += 1
+                    continue
+
+            # Convert to YAML format
+            yaml_entity = convert_to_yaml(alert)
+
+            if incremental:
+                content_hash = entity_hash(yaml_entity)
+                current_entries[ref] = {'file': output_file.name, 'hash': content_hash, 'updated_at': updated_at}
+                if unchanged_on_disk and previous.get('hash') == content_hash:
+                    logging.debug(f"Unchanged: {output_file}")
+                    args['unchanged_count'] += 1
+                    continue
+
+            # Wrap in entities array to match template format
+            yaml_data = {
+                'entities': [yaml_entity]
+            }
+
+            refs_by_file[str(output_file)] = ref if incremental else None
+            batch.append((str(output_file), yaml_data))
+            if len(batch) >= WRITE_BATCH_SIZE:
+                _flush()
+
+        _drain()
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    if incremental:
+        args['manifest']['entities'] = current_entries
+        save_manifest(args, args['manifest'])
+
+    # Shards and by-type files of an earlier run would deploy their alerts a second time
+    for path in remove_stale_layout_files(output_dir, 'files', output_files):
+        logging.info(f"Removed: {path} (left by another layout)")
 
     return saved_count, type_counts
 
@@ -367,8 +981,13 @@ def print_summary(args: Dict, saved_count: int, type_counts: Dict[str, int]):
     if args['dry_run']:
         print(f"\nDRY RUN: Would fetch {saved_count} alerts")
     else:
-        print(f"\n✓ Successfully fetched {saved_count} alerts")
+        unchanged_count = args.get('unchanged_count', 0)
+        print(f"\n✓ Successfully fetched {saved_count + unchanged_count} alerts")
+        if args['incremental']:
+            print(f"✓ {saved_count} changed, {unchanged_count} unchanged (skipped)")
         print(f"✓ Saved to: {Path(args['output_dir']).absolute()}")
+        if args['archive']:
+            print(f"✓ Archived to: {Path(args['archive']).absolute()}")
 
         if type_counts:
             print("\nAlert breakdown by type:")
@@ -381,14 +1000,19 @@ def print_summary(args: Dict, saved_count: int, type_counts: Dict[str, int]):
     print("\n⚠ IMPORTANT: Review and test before deploying!")
 
     alerts_dir = Path(args['output_dir']).name
+    alert_file = {
+        'files': '<alert-name>.yaml',
+        'by-type': '<alert-type>.yaml',
+        'shards': f"alerts-NNN-of-{args['shards']:03d}.yaml",
+    }[args['output_format']]
 
     print("\n1. Review the fetched alerts:")
     print(f"   $ cd {args['output_dir']}")
     print(f"   $ ls *.yaml")
-    print(f"   $ cat <alert-name>.yaml")
+    print(f"   $ cat {alert_file}")
 
     print("\n2. Edit alerts as needed (update thresholds, channels, etc.):")
-    print(f"   $ vi <alert-name>.yaml")
+    print(f"   $ vi {alert_file}")
 
     print("\n3. Test locally with l9iac plan from iac-template directory:")
     print(f"   $ cd ../iac-template")
@@ -429,7 +1053,9 @@ def main() -> int:
     )
 
     # Validate configuration
-    if not validate_args(args):
+    with span('load_config'):
+        valid_args = validate_args(args)
+    if not valid_args:
         logging.error("Configuration validation failed")
         logging.error("")
         logging.error("Make sure you have either:")
@@ -440,17 +1066,27 @@ def main() -> int:
 
     # Get access token
     logging.info("Authenticating with Last9 API...")
-    access_token = get_access_token(args)
+    with span('token_exchange'):
+        access_token = get_access_token(args)
     if not access_token:
         logging.error("Authentication failed")
         return 1
 
+    if args['incremental'] and not args['dry_run']:
+        args['manifest'] = load_manifest(args)
+
     # Fetch alerts from API
     logging.info("Fetching alerts from Last9 API...")
-    alerts = fetch_alerts(args, access_token)
+    with span('fetch'):
+        alerts = fetch_alerts(args, access_token)
     if alerts is None:
         return 1
 
+    if args.get('not_modified'):
+        args['unchanged_count'] = len(args['manifest']['entities'])
+        print_summary(args, 0, {})
+        return 0
+
     if not alerts:
         logging.warning("No alerts found")
         logging.info("This could mean:")
@@ -459,8 +1095,18 @@ def main() -> int:
         logging.info("  - You don't have permission to read alerts")
         return 0
 
-    # Save alerts to files
-    saved_count, type_counts = save_alerts(args, alerts)
+    # Save alerts to files as pages arrive - the save phase includes fetching the pages after the first one
+    try:
+        with span('save'):
+            saved_count, type_counts = save_alerts(args, alerts)
+    except requests.exceptions.RequestException as ex:
+        logging.error(f"Failed to fetch alerts: {ex}")
+        return 1
+    inc('alerts_saved', saved_count)
+    inc('alerts_unchanged', args.get('unchanged_count', 0))
+
+    log_request_stats()
+    log_hydrate_stats(args)
 
     # Print summary
     print_summary(args, saved_count, type_counts)
@@ -469,4 +1115,4 @@ def main() -> int:
 
 
 if __name__ == "__main__":
-    sys.exit(main())
+    sys.exit(run_instrumented('fetch_alerts', main))
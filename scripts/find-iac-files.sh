@@ -2,14 +2,18 @@
 
 set -eou pipefail
 
+SCRIPT_DIR=$(cd -- "$(dirname -- "${BASH_SOURCE[0]}")" &>/dev/null && pwd)
+
 # Validate cli options
 function usage() {
   if [ -n "$1" ]; then
     >&2 echo -e "ERROR: $1\n"
   fi
   >&2 echo "Usage: $0 --all -git-diff"
-  >&2 echo "  ---all      Find all iac files"
-  >&2 echo "  --git-diff  Find iac files having git diff"
+  >&2 echo "  ---all            Find all iac files"
+  >&2 echo "  --git-diff        Find iac files having git diff, and rendered files whose template or vars changed"
+  >&2 echo "  --git-range R     Revision or range to diff (default: HEAD^)"
+  >&2 echo "  --render-stale    Re-render the files whose template or vars changed - leaves uncommitted changes"
   >&2 echo ""
   >&2 echo "Example: $0 --git-diff"
 }
@@ -18,12 +22,16 @@ function usage() {
 while [[ "$#" -gt 0 ]]; do case $1 in
     --all)      find_all_files="1"; shift;;
     --git-diff) find_git_diff_files="1"; shift;;
+    --git-range) git_range="$2"; shift; shift;;
+    --render-stale) render_stale="1"; shift;;
     *) usage "Unknown parameter passed: $1"; exit 1;
   esac
 done
 
 find_all_files=${find_all_files:-"0"}
 find_git_diff_files=${find_git_diff_files:-"0"}
+git_range=${git_range:-"HEAD^"}
+render_stale=${render_stale:-"0"}
 
 if [[ "$find_all_files" == "0" ]] && [[ "$find_git_diff_files" == "0" ]]; then
   >&2 echo "ERROR: Please specify at least one option --all or --git-diff"
@@ -35,5 +43,11 @@ if [[ "$find_all_files" == "1" ]]; then
 fi
 
 if [[ "$find_git_diff_files" == "1" ]]; then
-  \git diff --name-only HEAD^ "workspace" | \grep -e '.yaml' | sort | uniq
+  # Files changed in the range, plus the rendered files depending on a changed template or vars file section - see
+  # last9_render_index.py
+  detector_opts=(--git-range "$git_range")
+  if [[ "$render_stale" == "1" ]]; then
+    detector_opts+=(--render-stale)
+  fi
+  python3 "$SCRIPT_DIR/changed_iac_files.py" "${detector_opts[@]}" | \grep -e '.yaml' | sort | uniq
 fi
@@ -0,0 +1,296 @@
+"""
+Offline backtest of alert rules against recorded indicator series
+
+A rule fires at minute t when at least bad_minutes of the total_minutes ending at t are bad - the indicator compared
+with the rule's threshold (greater_than, less_than, ...) holds. Minutes without a sample are not bad.
+
+Series are loaded from CSV, NPZ or Parquet files in one of two layouts:
+
+    wide  a timestamp column plus one column per series
+    long  timestamp, series and value columns - one row per sample
+
+Timestamps are epoch seconds (or milliseconds) or ISO 8601 strings - UTC unless they carry a Z or UTC offset. Every
+series is put on its own 1 minute grid, the last sample of a minute wins. A series named "<entity name>/<indicator>"
+is used for the rules of that entity only, a series named "<indicator>" for the rules of every entity having that
+indicator.
+
+Each rule is evaluated over the whole series at once - the bad minutes of every window are a difference of two
+cumulative sums, firing intervals the edges of the resulting mask - so months of 1 minute data take milliseconds per
+rule.
+
+Sample usage
+
+    from last9_backtest import backtest_rule, load_series, rule_indicator
+
+    series = load_series(["pg-metrics.csv"])
+    for _, entity in iter_entities(["last9-alert-catalog/pg_alerts.yaml"]):
+        for rule in entity.get("alert_rules") or []:
+            name, reason = rule_indicator(entity, rule)
+            result = backtest_rule(series[name], rule)
+"""
+
+import os
+import csv
+import math
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import numpy as np
+
+from last9_catalog import THRESHOLD_KEYS
+
+SERIES_SUFFIXES = (".csv", ".npz", ".parquet")
+TIMESTAMP_COLUMN = "timestamp"
+SERIES_COLUMN = "series"
+VALUE_COLUMN = "value"
+STEP_SEC = 60
+
+OPERATORS = {
+    "greater_than": np.greater,
+    "greater_than_eq": np.greater_equal,
+    "less_than": np.less,
+    "less_than_eq": np.less_equal,
+    "equal_to": np.equal,
+    "not_equal_to": np.not_equal,
+}
+
+# values[i] is the sample of minute start + i * STEP_SEC, NaN where there is none
+Series = namedtuple("Series", ["start", "values"])
+BacktestResult = namedtuple(
+    "BacktestResult", ["operator", "threshold", "bad_minutes", "total_minutes", "minutes", "bad", "intervals", "flaps"]
+)
+
+
+class SeriesError(ValueError):
+    """A series file which cannot be read"""
+
+
+def _read_csv(path):
+    """{column: array} of a CSV file with a header row - values are parsed as floats, empty cells are NaN"""
+    with open(path, "r", encoding="utf-8", newline="") as input_fd:
+        reader = csv.reader(input_fd)
+        header = next(reader, None)
+        if not header:
+            raise SeriesError(f"{path} has no header row")
+        if SERIES_COLUMN not in header:
+            # All numeric (epoch timestamps, no empty cells) is the common case - parsed in C, several times faster
+            try:
+                table = np.loadtxt(input_fd, delimiter=",", ndmin=2, dtype=np.float64)
+                if table.shape[1] == len(header):
+                    return {name: table[:, index] for index, name in enumerate(header)}
+            except ValueError:
+                pass
+            input_fd.seek(0)
+            next(reader)
+        rows = [row for row in reader if row]
+    try:
+        table = np.array(rows, dtype=str).reshape(len(rows), len(header))
+    except ValueError:
+        raise SeriesError(f"{path}: rows do not all have {len(header)} columns") from None
+    columns = {}
+    for index, name in enumerate(header):
+        column = table[:, index]
+        if name == SERIES_COLUMN:
+            columns[name] = column
+            continue
+        column = np.where(column == "", "nan", column)
+        try:
+            columns[name] = column.astype(np.float64)
+        except ValueError:
+            if name != TIMESTAMP_COLUMN:
+                raise SeriesError(f"{path}: column {name} is not numeric") from None
+            columns[name] = column
+    return columns
+
+
+def _read_npz(path):
+    """{column: array} of an NPZ file, one array per column"""
+    with np.load(path, allow_pickle=False) as npz:
+        return {name: npz[name] for name in npz.files}
+
+
+def _read_parquet(path):
+    """{column: array} of a Parquet file - needs pyarrow"""
+    try:
+        import pyarrow.parquet  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        raise SeriesError(f"{path}: reading Parquet files needs pyarrow - pip install pyarrow") from None
+    table = pyarrow.parquet.read_table(path)
+    return {name: table.column(name).to_numpy() for name in table.column_names}
+
+
+def _iso_epoch_seconds(value):
+    """Epoch seconds of an ISO 8601 string or datetime - a Z or UTC offset is applied, values without one are UTC"""
+    if not isinstance(value, datetime):
+        text = value.decode("utf-8") if isinstance(value, bytes) else str(value)
+        text = text.strip()
+        # datetime.fromisoformat() only takes Z from Python 3.11 on
+        if text.endswith(("Z", "z")):
+            text = text[:-1] + "+00:00"
+        value = datetime.fromisoformat(text)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return math.floor(value.timestamp())
+
+
+def epoch_seconds(timestamps):
+    """Epoch seconds of epoch seconds / milliseconds, datetime64 values or ISO 8601 strings"""
+    timestamps = np.asarray(timestamps)
+    if timestamps.dtype.kind == "O":
+        try:
+            timestamps = timestamps.astype(np.float64)
+        except (TypeError, ValueError):
+            pass
+    if timestamps.dtype.kind in "USO":
+        # Not numpy's datetime64 parsing - it ignores UTC offsets, with a DeprecationWarning for each string
+        return np.array([_iso_epoch_seconds(value) for value in timestamps.tolist()], dtype=np.int64)
+    if timestamps.dtype.kind == "M":
+        return timestamps.astype("datetime64[s]").astype(np.int64)
+    timestamps = timestamps.astype(np.float64)
+    if np.isnan(timestamps).any():
+        raise ValueError("missing timestamps")
+    # Anything past 5138 AD in seconds is a millisecond timestamp
+    if timestamps.size and np.nanmax(timestamps) > 1e11:
+        timestamps = timestamps / 1000
+    return np.floor(timestamps).astype(np.int64)
+
+
+def to_grid(timestamps, values):
+    """Series of samples on the minute grid - the last sample of a minute wins"""
+    order = np.argsort(timestamps, kind="stable")
+    minutes = timestamps[order] // STEP_SEC
+    values = np.asarray(values, dtype=np.float64)[order]
+    first = minutes[0]
+    grid = np.full(minutes[-1] - first + 1, np.nan)
+    # Keep the last sample of each minute explicitly - fancy assignment does not define which duplicate wins
+    last = np.ones(len(minutes), dtype=bool)
+    last[:-1] = minutes[1:] != minutes[:-1]
+    grid[minutes[last] - first] = values[last]
+    return Series(int(first * STEP_SEC), grid)
+
+
+def columns_to_series(columns, path):
+    """{name: Series} of the columns of one file, in the wide or long layout"""
+    if TIMESTAMP_COLUMN not in columns:
+        raise SeriesError(f"{path} has no {TIMESTAMP_COLUMN} column")
+    try:
+        timestamps = epoch_seconds(columns[TIMESTAMP_COLUMN])
+    except ValueError as ex:
+        raise SeriesError(f"{path}: unreadable {TIMESTAMP_COLUMN} - {ex}") from None
+    if not len(timestamps):
+        return {}
+
+    if SERIES_COLUMN in columns:
+        if VALUE_COLUMN not in columns:
+            raise SeriesError(f"{path} has a {SERIES_COLUMN} column but no {VALUE_COLUMN} column")
+        names, inverse = np.unique(np.asarray(columns[SERIES_COLUMN]).astype(str), return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.searchsorted(inverse[order], np.arange(len(names) + 1))
+        values = np.asarray(columns[VALUE_COLUMN], dtype=np.float64)
+        return {
+            str(name): to_grid(timestamps[order[lo:hi]], values[order[lo:hi]])
+            for name, lo, hi in zip(names, bounds[:-1], bounds[1:])
+        }
+
+    return {name: to_grid(timestamps, column) for name, column in columns.items() if name != TIMESTAMP_COLUMN}
+
+
+def load_series(paths):
+    """{name: Series} of series files and directories of them - a series in a later file replaces an earlier one"""
+    readers = {".csv": _read_csv, ".npz": _read_npz, ".parquet": _read_parquet}
+    series = {}
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(SERIES_SUFFIXES))
+        else:
+            files = [path]
+        for file_path in files:
+            suffix = os.path.splitext(file_path)[1].lower()
+            if suffix not in readers:
+                raise SeriesError(f"{file_path}: unknown series file type - expected one of {SERIES_SUFFIXES}")
+            series.update(columns_to_series(readers[suffix](file_path), file_path))
+    return series
+
+
+def stack_series(series_list):
+    """(start, rows) of Series put on their common minute grid - one row each, NaN outside its own range"""
+    start = min(item.start for item in series_list)
+    end = max(item.start + len(item.values) * STEP_SEC for item in series_list)
+    rows = np.full((len(series_list), (end - start) // STEP_SEC), np.nan)
+    for row, item in zip(rows, series_list):
+        offset = (item.start - start) // STEP_SEC
+        row[offset : offset + len(item.values)] = item.values
+    return start, rows
+
+
+def rule_indicator(entity, rule):
+    """(indicator name, None) of the indicator a rule compares, (None, reason) if it is not a single indicator"""
+    indicator = rule.get("indicator")
+    expression = str(rule.get("expression") or "").strip()
+    indicator_names = {item.get("name") for item in entity.get("indicators") or []}
+    if expression and expression != indicator:
+        if expression not in indicator_names:
+            return None, "expression is not a single indicator"
+        indicator = expression
+    if not indicator:
+        return None, "no indicator"
+    return indicator, None
+
+
+def find_series(series, entity, indicator):
+    """Series recorded for an indicator of an entity - entity scoped first"""
+    return series.get(f"{entity.get('name')}/{indicator}", series.get(indicator))
+
+
+def rule_operator(rule):
+    """(operator, threshold) of a rule, (None, None) if it has no threshold"""
+    operator = next((key for key in THRESHOLD_KEYS if key in rule), None)
+    return (operator, rule[operator]) if operator else (None, None)
+
+
+def firing_mask(values, operator, threshold, bad_minutes, total_minutes):
+    """Per minute: whether at least bad_minutes of the total_minutes ending there are bad"""
+    with np.errstate(invalid="ignore"):
+        bad = OPERATORS[operator](values, threshold) & ~np.isnan(values)
+    bad_count = np.cumsum(bad, dtype=np.int64)
+    window_count = bad_count.copy()
+    window_count[total_minutes:] -= bad_count[:-total_minutes]
+    return bad, window_count >= bad_minutes
+
+
+def intervals_of(mask):
+    """(start, end) index pairs of the runs of True in mask, end exclusive"""
+    edges = np.diff(np.concatenate(([False], mask, [False])).astype(np.int8))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def backtest_rule(series, rule, flap_minutes=None, **overrides):
+    """BacktestResult of a rule over a Series
+
+    overrides replace the rule's threshold, bad_minutes or total_minutes. A firing interval starting within
+    flap_minutes (default: total_minutes) of the end of the previous one counts as a flap.
+    """
+    operator, threshold = rule_operator(rule)
+    threshold = float(overrides.get("threshold", threshold))
+    total_minutes = int(overrides.get("total_minutes", rule.get("total_minutes") or 1))
+    bad_minutes = int(overrides.get("bad_minutes", rule.get("bad_minutes") or total_minutes))
+    if not 1 <= bad_minutes <= total_minutes:
+        raise ValueError(f"bad_minutes={bad_minutes} must be between 1 and total_minutes={total_minutes}")
+    flap_minutes = total_minutes if flap_minutes is None else flap_minutes
+
+    bad, firing = firing_mask(series.values, operator, threshold, bad_minutes, total_minutes)
+    starts, ends = intervals_of(firing)
+    flaps = int(np.count_nonzero(starts[1:] - ends[:-1] <= flap_minutes))
+    intervals = [
+        (series.start + int(start) * STEP_SEC, series.start + int(end) * STEP_SEC) for start, end in zip(starts, ends)
+    ]
+    return BacktestResult(
+        operator,
+        threshold,
+        bad_minutes,
+        total_minutes,
+        int(np.count_nonzero(~np.isnan(series.values))),
+        int(np.count_nonzero(bad)),
+        intervals,
+        flaps,
+    )
@@ -0,0 +1,95 @@
+"""
+Small file-locked JSON caches shared across script invocations
+
+Used to keep state (access tokens, discovered endpoints, ...) between the back to back script runs made by the
+enable-* wrappers and CI jobs. Entries are read and written under an exclusive flock so concurrent runs do not
+clobber each other, and the file is replaced atomically.
+
+Sample usage
+
+    from last9_cache import locked_json_cache
+
+    with locked_json_cache("/tmp/.last9-iac.some-cache.json") as cache_ds:
+        cache_ds["key"] = "value"
+"""
+
+import os
+import json
+import fcntl
+import hashlib
+import logging
+import tempfile
+from contextlib import contextmanager
+
+CACHE_DIR = os.environ.get("LAST9_CACHE_DIR", tempfile.gettempdir())
+
+
+def cache_path(name):
+    """Path of a cache file in CACHE_DIR"""
+    return os.path.join(CACHE_DIR, f".last9-iac.{name}.json")
+
+
+def cache_key(*parts):
+    """Stable, non reversible key for parts which may contain secrets"""
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def _read_cache(path):
+    try:
+        with open(path, "r", encoding="utf-8") as cache_fd:
+            cache_ds = json.load(cache_fd)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as ex:
+        logging.warning("Ignoring unreadable cache file %s - %s", path, str(ex))
+        return {}
+    if not isinstance(cache_ds, dict):
+        return {}
+    return cache_ds
+
+
+def _write_cache(path, cache_ds, indent=None):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp-", suffix=".json")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp_fd:
+            json.dump(cache_ds, tmp_fd, sort_keys=True, indent=indent)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+@contextmanager
+def locked_json_cache(path, indent=None, lock_path=None, optional=False):
+    """Yield the cache dict under an exclusive lock and persist it if modified
+
+    The lock is taken on lock_path, by default path + ".lock", whose directory is created if needed. indent pretty
+    prints the file, for files kept in git. For caches which are only an optimization pass optional=True - if the
+    cache cannot be locked or written a warning is logged and the run goes on without it.
+    """
+    lock_path = lock_path or f"{path}.lock"
+    try:
+        os.makedirs(os.path.dirname(lock_path) or ".", exist_ok=True)
+        lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError as ex:
+        if not optional:
+            raise
+        logging.warning("Not using cache %s - %s", path, str(ex))
+        yield {}
+        return
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        cache_ds = _read_cache(path)
+        before = json.dumps(cache_ds, sort_keys=True)
+        yield cache_ds
+        if json.dumps(cache_ds, sort_keys=True) != before:
+            try:
+                _write_cache(path, cache_ds, indent)
+            except OSError as ex:
+                if not optional:
+                    raise
+                logging.warning("Failed to update cache %s - %s", path, str(ex))
+    finally:
+        fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        os.close(lock_fd)
@@ -0,0 +1,304 @@
+"""
+On-disk index of the alert catalog (last9-alert-catalog/*.yaml)
+
+Every catalog file is parsed once into a small SQLite database holding its entities, indicators (with the metrics
+their queries read), alert rules and the indicators each rule uses. A refresh only re-parses files whose mtime / size
+changed and whose sha256 differs from the indexed one, so queries against a warm index just stat the catalog files.
+
+Files that fail to parse are recorded with their error and skipped, the rest of the catalog stays queryable.
+
+Sample usage
+
+    from last9_catalog import CatalogIndex
+
+    with CatalogIndex("last9-alert-catalog") as index:
+        index.refresh()
+        rules = index.query_rules(metric="kafka_consumergroup_lag", severity="breach", min_bad_minutes=5)
+"""
+
+import os
+import re
+import glob
+import hashlib
+import logging
+import sqlite3
+
+from last9_yaml import load_yaml_file
+
+DEFAULT_CATALOG_DIR = "last9-alert-catalog"
+INDEX_FILE_NAME = ".last9-catalog-index.sqlite"
+# Bump when the schema or what gets extracted changes - older indexes are rebuilt from scratch
+SCHEMA_VERSION = 1
+
+THRESHOLD_KEYS = ("greater_than", "greater_than_eq", "less_than", "less_than_eq", "equal_to", "not_equal_to")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, sha256 TEXT, error TEXT
+);
+CREATE TABLE IF NOT EXISTS entities (
+    id INTEGER PRIMARY KEY, file TEXT, name TEXT, external_ref TEXT, type TEXT, entity_class TEXT, data_source TEXT
+);
+CREATE TABLE IF NOT EXISTS indicators (
+    id INTEGER PRIMARY KEY, entity_id INTEGER, file TEXT, name TEXT, query TEXT, unit TEXT
+);
+CREATE TABLE IF NOT EXISTS indicator_metrics (indicator_id INTEGER, file TEXT, metric TEXT);
+CREATE TABLE IF NOT EXISTS rules (
+    id INTEGER PRIMARY KEY, entity_id INTEGER, file TEXT, name TEXT, indicator TEXT, expression TEXT,
+    severity TEXT, operator TEXT, threshold NUMERIC, bad_minutes INTEGER, total_minutes INTEGER, is_disabled INTEGER
+);
+CREATE TABLE IF NOT EXISTS rule_indicators (rule_id INTEGER, file TEXT, indicator_id INTEGER);
+CREATE INDEX IF NOT EXISTS indicator_metrics_metric ON indicator_metrics (metric);
+CREATE INDEX IF NOT EXISTS rules_severity_bad_minutes ON rules (severity, bad_minutes);
+CREATE INDEX IF NOT EXISTS rule_indicators_indicator ON rule_indicators (indicator_id);
+CREATE INDEX IF NOT EXISTS entities_type ON entities (type);
+"""
+_FILE_TABLES = ("entities", "indicators", "indicator_metrics", "rules", "rule_indicators")
+
+_COMMENT_RE = re.compile(r"#[^\n]*")
+_STRING_RE = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'')
+_NAME_MATCHER_RE = re.compile(r'__name__\s*=\s*"([^"]+)"')
+_MATCHERS_RE = re.compile(r"\{[^}]*\}")
+_RANGE_RE = re.compile(r"\[[^\]]*\]")
+_GROUPING_RE = re.compile(r"\b(?:by|without|on|ignoring|group_left|group_right)\s*\([^)]*\)", re.IGNORECASE)
+_IDENT_RE = re.compile(r"(?<![\w:.])([a-zA-Z_:][\w:]*)(\s*\()?")
+# Words in queries which are not metric names - PromQL keywords and aggregations plus Levitate's if / default
+_NON_METRIC_WORDS = {
+    "and", "or", "unless", "by", "without", "on", "ignoring", "group_left", "group_right", "bool", "offset",
+    "inf", "nan", "if", "default", "sum", "avg", "min", "max", "count", "group", "stddev", "stdvar", "topk",
+    "bottomk", "quantile", "count_values",
+}  # fmt: skip
+
+
+def extract_metrics(query):
+    """Metric names read by a PromQL query"""
+    metrics = set(_NAME_MATCHER_RE.findall(query))
+    query = _STRING_RE.sub('""', query)
+    query = _COMMENT_RE.sub(" ", query)
+    query = _MATCHERS_RE.sub("{}", query)
+    query = _RANGE_RE.sub("[]", query)
+    query = _GROUPING_RE.sub(" ", query)
+    for match in _IDENT_RE.finditer(query):
+        name, is_call = match.groups()
+        if not is_call and name.lower() not in _NON_METRIC_WORDS:
+            metrics.add(name)
+    return sorted(metrics)
+
+
+def referenced_indicators(rule, indicator_names):
+    """Names of the entity's indicators a rule uses - its indicator plus any named in its expression"""
+    names = {rule["indicator"]} if rule.get("indicator") in indicator_names else set()
+    expression = str(rule.get("expression") or "")
+    for name in indicator_names:
+        if re.search(r"(?<![\w])" + re.escape(name) + r"(?![\w])", expression):
+            names.add(name)
+    return sorted(names)
+
+
+def file_sha256(path):
+    """sha256 of a file"""
+    with open(path, "rb") as input_fd:
+        return hashlib.sha256(input_fd.read()).hexdigest()
+
+
+class CatalogIndex:
+    """SQLite index over the catalog files of catalog_dir"""
+
+    def __init__(self, catalog_dir=DEFAULT_CATALOG_DIR, index_file=None):
+        self.catalog_dir = catalog_dir
+        self.index_file = index_file or os.path.join(catalog_dir, INDEX_FILE_NAME)
+        self.conn = sqlite3.connect(self.index_file)
+        self.conn.row_factory = sqlite3.Row
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            for table in ("files",) + _FILE_TABLES:
+                self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+            self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.conn.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the index database"""
+        self.conn.close()
+
+    def catalog_files(self):
+        """Catalog YAML files, relative to catalog_dir"""
+        return sorted(os.path.relpath(path, self.catalog_dir) for path in glob.glob(f"{self.catalog_dir}/*.yaml"))
+
+    def refresh(self):
+        """Re-index files that changed since the last refresh - returns a dict of counts per outcome"""
+        counts = {"unchanged": 0, "indexed": 0, "failed": 0, "removed": 0}
+        indexed = {row["path"]: row for row in self.conn.execute("SELECT * FROM files")}
+        catalog_files = self.catalog_files()
+
+        with self.conn:
+            for path in set(indexed) - set(catalog_files):
+                self._delete_file(path)
+                counts["removed"] += 1
+
+            for path in catalog_files:
+                stat = os.stat(os.path.join(self.catalog_dir, path))
+                row = indexed.get(path)
+                if row is not None and (row["mtime_ns"], row["size"]) == (stat.st_mtime_ns, stat.st_size):
+                    counts["unchanged"] += 1
+                    continue
+
+                sha256 = file_sha256(os.path.join(self.catalog_dir, path))
+                if row is not None and row["sha256"] == sha256:
+                    # Touched but not modified - just remember the new mtime
+                    self.conn.execute(
+                        "UPDATE files SET mtime_ns = ?, size = ? WHERE path = ?",
+                        (stat.st_mtime_ns, stat.st_size, path),
+                    )
+                    counts["unchanged"] += 1
+                    continue
+
+                error = self._index_file(path)
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                    (path, stat.st_mtime_ns, stat.st_size, sha256, error),
+                )
+                counts["failed" if error else "indexed"] += 1
+
+        logging.debug("Refreshed catalog index %s - %s", self.index_file, counts)
+        return counts
+
+    def _delete_file(self, path):
+        for table in _FILE_TABLES:
+            self.conn.execute(f"DELETE FROM {table} WHERE file = ?", (path,))
+        self.conn.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def _index_file(self, path):
+        """Replace the rows of one catalog file - returns an error string if it does not parse"""
+        for table in _FILE_TABLES:
+            self.conn.execute(f"DELETE FROM {table} WHERE file = ?", (path,))
+
+        try:
+            catalog_ds = load_yaml_file(os.path.join(self.catalog_dir, path))
+        except Exception as ex:  # pylint: disable=broad-except
+            logging.warning("Skipping catalog file %s - failed to parse - %s", path, str(ex).replace("\n", " "))
+            return str(ex)
+
+        for entity in (catalog_ds or {}).get("entities") or []:
+            cursor = self.conn.execute(
+                "INSERT INTO entities (file, name, external_ref, type, entity_class, data_source) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    path,
+                    entity.get("name"),
+                    entity.get("external_ref"),
+                    entity.get("type"),
+                    entity.get("entity_class"),
+                    entity.get("data_source"),
+                ),
+            )
+            entity_id = cursor.lastrowid
+
+            indicator_ids = {}
+            for indicator in entity.get("indicators") or []:
+                query = str(indicator.get("query") or "")
+                cursor = self.conn.execute(
+                    "INSERT INTO indicators (entity_id, file, name, query, unit) VALUES (?, ?, ?, ?, ?)",
+                    (entity_id, path, indicator.get("name"), query, indicator.get("unit")),
+                )
+                indicator_ids[indicator.get("name")] = cursor.lastrowid
+                self.conn.executemany(
+                    "INSERT INTO indicator_metrics VALUES (?, ?, ?)",
+                    [(cursor.lastrowid, path, metric) for metric in extract_metrics(query)],
+                )
+
+            for rule in entity.get("alert_rules") or []:
+                operator = next((key for key in THRESHOLD_KEYS if key in rule), None)
+                cursor = self.conn.execute(
+                    "INSERT INTO rules (entity_id, file, name, indicator, expression, severity, operator, threshold, "
+                    "bad_minutes, total_minutes, is_disabled) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        entity_id,
+                        path,
+                        rule.get("name"),
+                        rule.get("indicator"),
+                        str(rule.get("expression") or ""),
+                        rule.get("severity"),
+                        operator,
+                        rule.get(operator) if operator else None,
+                        rule.get("bad_minutes"),
+                        rule.get("total_minutes"),
+                        int(bool(rule.get("is_disabled", False))),
+                    ),
+                )
+                self.conn.executemany(
+                    "INSERT INTO rule_indicators VALUES (?, ?, ?)",
+                    [
+                        (cursor.lastrowid, path, indicator_ids[name])
+                        for name in referenced_indicators(rule, indicator_ids)
+                    ],
+                )
+        return None
+
+    def failed_files(self):
+        """(path, error) of catalog files that did not parse"""
+        return [
+            (row["path"], row["error"]) for row in self.conn.execute("SELECT * FROM files WHERE error IS NOT NULL")
+        ]
+
+    def query_rules(self, metric=None, severity=None, min_bad_minutes=None, indicator=None, entity_type=None):
+        """Alert rules matching all given filters, with their entity and the metrics they read"""
+        where, params = [], []
+        if metric is not None:
+            where.append(
+                "rules.id IN (SELECT rule_id FROM rule_indicators JOIN indicator_metrics "
+                "USING (indicator_id) WHERE metric = ?)"
+            )
+            params.append(metric)
+        if severity is not None:
+            where.append("rules.severity = ?")
+            params.append(severity)
+        if min_bad_minutes is not None:
+            where.append("rules.bad_minutes >= ?")
+            params.append(min_bad_minutes)
+        if indicator is not None:
+            where.append(
+                "rules.id IN (SELECT rule_id FROM rule_indicators JOIN indicators "
+                "ON indicators.id = rule_indicators.indicator_id WHERE indicators.name = ?)"
+            )
+            params.append(indicator)
+        if entity_type is not None:
+            where.append("entities.type = ?")
+            params.append(entity_type)
+
+        sql = (
+            "SELECT rules.*, entities.name AS entity, entities.type AS entity_type, "
+            "(SELECT group_concat(DISTINCT metric) FROM rule_indicators JOIN indicator_metrics USING (indicator_id) "
+            "WHERE rule_id = rules.id) AS metrics "
+            "FROM rules JOIN entities ON entities.id = rules.entity_id"
+        )
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY rules.file, rules.id"
+        return [dict(row) for row in self.conn.execute(sql, params)]
+
+    def query_entities(self, entity_type=None):
+        """Entities, optionally of one type, with their indicator and rule counts"""
+        sql = (
+            "SELECT entities.*, "
+            "(SELECT count(*) FROM indicators WHERE entity_id = entities.id) AS indicators, "
+            "(SELECT count(*) FROM rules WHERE entity_id = entities.id) AS rules FROM entities"
+        )
+        params = []
+        if entity_type is not None:
+            sql += " WHERE type = ?"
+            params.append(entity_type)
+        sql += " ORDER BY file, id"
+        return [dict(row) for row in self.conn.execute(sql, params)]
+
+    def query_metrics(self):
+        """Every metric read by an indicator with the number of indicators and rules using it"""
+        sql = (
+            "SELECT metric, count(DISTINCT indicator_metrics.indicator_id) AS indicators, "
+            "count(DISTINCT rule_indicators.rule_id) AS rules FROM indicator_metrics "
+            "LEFT JOIN rule_indicators USING (indicator_id) GROUP BY metric ORDER BY metric"
+        )
+        return [dict(row) for row in self.conn.execute(sql)]
@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+
+"""
+Config of the IaC scripts - parsed and validated once, with assumed role credentials cached across runs
+
+The config comes from .last9.config.json if it exists, from environment variables otherwise:
+
+    .last9.config.json              environment
+    aws_access_key_id               AWS_ACCESS_KEY_ID                required in the file
+    aws_secret_access_key           AWS_SECRET_ACCESS_KEY            required in the file
+    aws_default_region              AWS_DEFAULT_REGION               required in the file
+    last9_backup_s3_bucket          LAST9_BACKUP_S3_BUCKET           required
+    aws_assume_role_arn             AWS_ASSUME_ROLE_ARN
+    aws_assume_role_external_id     AWS_ASSUME_ROLE_EXTERNAL_ID
+    aws_assume_role_duration_sec    AWS_ASSUME_ROLE_DURATION_SEC     default 3600
+    iac_config                      LAST9_API_CONFIG_STR (json)      required, the l9iac config
+
+When an assume role ARN and external id are set, the role is assumed through STS once and its credentials are kept
+in a file-locked cache ($LAST9_CACHE_DIR/.last9-iac.sts-credentials.json) until REFRESH_BEFORE_SEC before they
+expire, so the back to back runs of the enable-* wrappers and CI jobs share one set of credentials.
+
+Python tools use load_config() / parse_iac_config() directly. Shell scripts run this file once, which validates the
+config, checks the backup bucket is reachable and writes the env vars file to source and the l9iac config file.
+
+Sample usage
+
+    from last9_config import ConfigError, load_config
+
+    config = load_config(".last9.config.json")
+    read_api = config.iac.api("read")
+    session = config.boto3_session()
+
+python scripts/last9_config.py --env-vars-file /tmp/.last9.config.sh --iac-config-file /tmp/.last9-iac.config.json
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import argparse
+import tempfile
+import logging
+from collections import namedtuple
+from urllib.parse import urlparse
+
+from last9_cache import cache_key, cache_path, locked_json_cache
+from last9_instrument import run_instrumented, span
+
+DEFAULT_CONFIG_FILE = ".last9.config.json"
+DEFAULT_ENV_VARS_FILE = "/tmp/.last9.config.sh"
+DEFAULT_IAC_CONFIG_FILE = "/tmp/.last9-iac.config.json"
+STS_CACHE_FILE = os.environ.get("LAST9_STS_CACHE_FILE", cache_path("sts-credentials"))
+
+# Do not reuse assumed role credentials expiring in the next 10 mins
+REFRESH_BEFORE_SEC = 600
+DEFAULT_ASSUME_ROLE_DURATION_SEC = 3600
+
+# key: (type, required in the config file, required in the environment) - the env var is the upper case key
+CONFIG_KEYS = {
+    "aws_access_key_id": (str, True, False),
+    "aws_secret_access_key": (str, True, False),
+    "aws_default_region": (str, True, False),
+    "last9_backup_s3_bucket": (str, True, True),
+    "aws_assume_role_arn": (str, False, False),
+    "aws_assume_role_external_id": (str, False, False),
+    "aws_assume_role_duration_sec": (int, False, False),
+}
+API_ACTIONS = ("read", "write", "delete")
+API_KEYS = ("refresh_token", "api_base_url", "org")
+
+# Commands the shell wrappers need besides python
+REQUIRED_COMMANDS = ("l9iac",)
+
+
+class ConfigError(ValueError):
+    """Invalid or incomplete config"""
+
+
+ApiConfig = namedtuple("ApiConfig", API_KEYS)
+
+
+class IacConfig(namedtuple("IacConfig", ["apis", "state_lock_file_path", "raw"])):
+    """l9iac config - apis maps the actions of api_config to ApiConfig, raw is the config as given"""
+
+    def api(self, action):
+        """ApiConfig of an action (read, write, delete) - raises ConfigError if it is not configured"""
+        if action not in self.apis:
+            raise ConfigError(f"api_config.{action} not specified")
+        return self.apis[action]
+
+
+class Last9Config(
+    namedtuple(
+        "Last9Config",
+        [
+            "iac",
+            "backup_s3_bucket",
+            "aws_access_key_id",
+            "aws_secret_access_key",
+            "aws_default_region",
+            "assume_role_arn",
+            "assume_role_external_id",
+            "assume_role_duration_sec",
+            "source",
+        ],
+    )
+):
+    """Validated config - see the module docstring for the keys it is loaded from"""
+
+    @property
+    def assumes_role(self):
+        """Whether AWS calls go through an assumed role"""
+        return bool(self.assume_role_arn and self.assume_role_external_id)
+
+    def base_session(self):
+        """boto3 session of the configured credentials (or boto3's default chain when there are none)"""
+        import boto3  # pylint: disable=import-outside-toplevel
+
+        return boto3.Session(
+            aws_access_key_id=self.aws_access_key_id or None,
+            aws_secret_access_key=self.aws_secret_access_key or None,
+            region_name=self.aws_default_region or None,
+        )
+
+    def aws_credentials(self):
+        """{"access_key_id", "secret_access_key", "session_token", "expires_at"} to use for AWS calls"""
+        if self.assumes_role:
+            return assumed_role_credentials(self)
+        return {
+            "access_key_id": self.aws_access_key_id,
+            "secret_access_key": self.aws_secret_access_key,
+            "session_token": None,
+            "expires_at": None,
+        }
+
+    def boto3_session(self):
+        """boto3 session of the credentials to use for AWS calls - the assumed role's if one is configured"""
+        import boto3  # pylint: disable=import-outside-toplevel
+
+        if not self.assumes_role:
+            return self.base_session()
+        credentials = self.aws_credentials()
+        return boto3.Session(
+            aws_access_key_id=credentials["access_key_id"],
+            aws_secret_access_key=credentials["secret_access_key"],
+            aws_session_token=credentials["session_token"],
+            region_name=self.aws_default_region or None,
+        )
+
+    def env_vars(self):
+        """Environment variables of the config, with the assumed role credentials if one is configured"""
+        credentials = self.aws_credentials()
+        env_vars = {
+            "AWS_ACCESS_KEY_ID": credentials["access_key_id"],
+            "AWS_SECRET_ACCESS_KEY": credentials["secret_access_key"],
+            "AWS_SESSION_TOKEN": credentials["session_token"],
+            "AWS_SESSION_EXPIRES_AT": credentials["expires_at"] and int(credentials["expires_at"]),
+            "AWS_DEFAULT_REGION": self.aws_default_region,
+            "AWS_ASSUME_ROLE_ARN": self.assume_role_arn,
+            "AWS_ASSUME_ROLE_EXTERNAL_ID": self.assume_role_external_id,
+            "AWS_ASSUME_ROLE_DURATION_SEC": self.assume_role_duration_sec if self.assumes_role else None,
+            "LAST9_BACKUP_S3_BUCKET": self.backup_s3_bucket,
+            "LAST9_API_CONFIG_STR": json.dumps(self.iac.raw, separators=(",", ":")),
+        }
+        return {key: str(value) for key, value in env_vars.items() if value not in (None, "")}
+
+
+def _typed(key, value, expected_type, source):
+    if expected_type is int:
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise ConfigError(f"{source} - {key}={value!r} is not an integer") from None
+    if not isinstance(value, str):
+        raise ConfigError(f"{source} - {key} must be a string")
+    return value
+
+
+def parse_iac_config(value, source="LAST9_API_CONFIG_STR"):
+    """IacConfig of a JSON string or an already parsed dict - raises ConfigError"""
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError as ex:
+            raise ConfigError(f"{source} - invalid json - {ex}") from None
+    if not isinstance(value, dict):
+        raise ConfigError(f"{source} - iac config must be a json object")
+    api_config = value.get("api_config")
+    if not isinstance(api_config, dict) or not api_config:
+        raise ConfigError(f"{source} - api_config not specified")
+
+    apis = {}
+    for action, action_config in api_config.items():
+        if action not in API_ACTIONS:
+            raise ConfigError(f"{source} - unknown api_config.{action} - expected one of {', '.join(API_ACTIONS)}")
+        if not isinstance(action_config, dict):
+            raise ConfigError(f"{source} - api_config.{action} must be a json object")
+        for key in API_KEYS:
+            if not isinstance(action_config.get(key), str) or not action_config[key]:
+                raise ConfigError(f"{source} - api_config.{action}.{key} not specified")
+        apis[action] = ApiConfig(*(action_config[key] for key in API_KEYS))
+
+    state_lock_file_path = value.get("state_lock_file_path", "")
+    if not isinstance(state_lock_file_path, str):
+        raise ConfigError(f"{source} - state_lock_file_path must be a string")
+    return IacConfig(apis, state_lock_file_path, value)
+
+
+def read_config_file(path):
+    """Parsed .last9.config.json - raises ConfigError"""
+    try:
+        with open(path, "r", encoding="utf-8") as config_fd:
+            config_ds = json.load(config_fd)
+    except OSError as ex:
+        raise ConfigError(f"config_file={path} - {ex}") from None
+    except ValueError as ex:
+        raise ConfigError(f"config_file={path} - invalid json - {ex}") from None
+    if not isinstance(config_ds, dict):
+        raise ConfigError(f"config_file={path} - must be a json object")
+    return config_ds
+
+
+def load_config(config_file=DEFAULT_CONFIG_FILE, environ=None):
+    """Last9Config from config_file if it exists, from environ (default os.environ) otherwise - raises ConfigError"""
+    if config_file and os.path.exists(config_file):
+        source = f"config_file={config_file}"
+        config_ds = read_config_file(config_file)
+        required_index = 1
+        iac_config = config_ds.get("iac_config")
+        if iac_config is None:
+            raise ConfigError(f"{source} - iac_config not specified")
+    else:
+        environ = os.environ if environ is None else environ
+        source = "environment"
+        config_ds = {key: environ.get(key.upper()) for key in CONFIG_KEYS}
+        required_index = 2
+        iac_config = environ.get("LAST9_API_CONFIG_STR") or None
+        if iac_config is None:
+            raise ConfigError(f"{source} - LAST9_API_CONFIG_STR not set")
+
+    values = {}
+    for key, spec in CONFIG_KEYS.items():
+        name = key if required_index == 1 else key.upper()
+        value = config_ds.get(key)
+        if value in (None, ""):
+            if spec[required_index]:
+                raise ConfigError(f"{source} - {name} not specified")
+            values[key] = None
+            continue
+        values[key] = _typed(name, value, spec[0], source)
+
+    duration_sec = values["aws_assume_role_duration_sec"] or DEFAULT_ASSUME_ROLE_DURATION_SEC
+    if duration_sec < 900:
+        raise ConfigError(f"{source} - aws_assume_role_duration_sec={duration_sec} must be at least 900")
+
+    return Last9Config(
+        iac=parse_iac_config(iac_config, source if required_index == 1 else "LAST9_API_CONFIG_STR"),
+        backup_s3_bucket=values["last9_backup_s3_bucket"].rstrip("/"),
+        aws_access_key_id=values["aws_access_key_id"],
+        aws_secret_access_key=values["aws_secret_access_key"],
+        aws_default_region=values["aws_default_region"],
+        assume_role_arn=values["aws_assume_role_arn"],
+        assume_role_external_id=values["aws_assume_role_external_id"],
+        assume_role_duration_sec=duration_sec,
+        source=source,
+    )
+
+
+def assumed_role_credentials(config, sts_client=None):
+    """Credentials of config's role - reused from STS_CACHE_FILE until REFRESH_BEFORE_SEC before they expire
+
+    The cache is held locked while the role is assumed, so concurrent runs wait for one assume role call instead of
+    each making their own. Entries are keyed by role, external id and base access key - never by the secrets.
+    """
+    key = cache_key(config.assume_role_arn, config.assume_role_external_id, config.aws_access_key_id or "")
+    with locked_json_cache(STS_CACHE_FILE) as cache_ds:
+        now = time.time()
+        entry = cache_ds.get(key)
+        if isinstance(entry, dict) and entry.get("expires_at", 0) - now >= REFRESH_BEFORE_SEC:
+            logging.info(
+                "Reusing credentials of role %s expiring in %d seconds",
+                config.assume_role_arn,
+                entry["expires_at"] - now,
+            )
+            return entry
+
+        session_name = f"{int(now)}_last9"
+        logging.info("Assuming role %s session=%s", config.assume_role_arn, session_name)
+        sts_client = sts_client or config.base_session().client("sts")
+        with span("assume_role"):
+            response = sts_client.assume_role(
+                RoleArn=config.assume_role_arn,
+                RoleSessionName=session_name,
+                DurationSeconds=config.assume_role_duration_sec,
+                ExternalId=config.assume_role_external_id,
+            )
+        credentials = response["Credentials"]
+        entry = {
+            "access_key_id": credentials["AccessKeyId"],
+            "secret_access_key": credentials["SecretAccessKey"],
+            "session_token": credentials["SessionToken"],
+            "expires_at": credentials["Expiration"].timestamp(),
+        }
+        for stale_key in [stale_key for stale_key, stale in cache_ds.items() if stale.get("expires_at", 0) < now]:
+            del cache_ds[stale_key]
+        cache_ds[key] = entry
+        return entry
+
+
+def check_backup_bucket(config):
+    """Whether the credentials of config can list the backup bucket"""
+    from botocore.exceptions import BotoCoreError, ClientError  # pylint: disable=import-outside-toplevel
+
+    bucket_url = config.backup_s3_bucket
+    parsed = urlparse(bucket_url if "://" in bucket_url else f"s3://{bucket_url}")
+    prefix = parsed.path.strip("/")
+    try:
+        with span("check_backup_bucket"):
+            client = config.boto3_session().client("s3", endpoint_url=os.environ.get("LAST9_S3_ENDPOINT_URL") or None)
+            client.list_objects_v2(Bucket=parsed.netloc, Prefix=f"{prefix}/" if prefix else "", MaxKeys=1)
+    except (BotoCoreError, ClientError) as ex:
+        logging.error("Failed to list LAST9_BACKUP_S3_BUCKET=%s - %s", bucket_url, ex)
+        logging.error("Please ensure that your AWS credentials have read/write access to %s", bucket_url)
+        return False
+    return True
+
+
+def write_private_file(path, text):
+    """Atomically write a file readable by the owner only - the env vars and l9iac config hold secrets"""
+    # mkstemp creates the file 0600 - it keeps that mode through the rename, never readable by others on the way
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp_fd:
+            tmp_fd.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def format_env_vars(env_vars):
+    """Env vars as shell exports"""
+    return "".join(f"export {key}={shlex.quote(value)}\n" for key, value in env_vars.items())
+
+
+def load_args():
+    """Parse cli"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--config-file",
+        help="Config file - environment variables are used if it does not exist",
+        default=DEFAULT_CONFIG_FILE,
+    )
+    parser.add_argument("--env-vars-file", help="Env vars file to write", default=DEFAULT_ENV_VARS_FILE)
+    parser.add_argument("--iac-config-file", help="l9iac config file to write", default=DEFAULT_IAC_CONFIG_FILE)
+    parser.add_argument(
+        "--skip-checks", action="store_true", help="Do not check the backup bucket and the commands the scripts need"
+    )
+    parser.add_argument("--log-level", help="Log level", default=os.environ.get("LOG_LEVEL", "INFO"))
+    return vars(parser.parse_args(sys.argv[1:]))
+
+
+def validate_args(args):
+    """Validate input args"""
+    for key in ("env_vars_file", "iac_config_file"):
+        output_dir = os.path.dirname(args[key]) or "."
+        if not os.path.isdir(output_dir):
+            logging.error("%s=%s - directory %s does not exist", key, args[key], output_dir)
+            return False
+    return True
+
+
+def setup_logging(log_level):
+    """Setup logging"""
+    log_level = getattr(logging, log_level.upper())
+    logging.basicConfig(
+        level=log_level, format="%(asctime)s.%(msecs)03d %(levelname)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    return True
+
+
+def main():
+    """Main function"""
+    args = load_args()
+
+    if not setup_logging(args["log_level"]):
+        return 1
+
+    if not validate_args(args):
+        return 1
+
+    try:
+        with span("load_config"):
+            config = load_config(args["config_file"])
+    except ConfigError as ex:
+        logging.error("%s", ex)
+        return 1
+    logging.info("Loaded config from %s", config.source)
+
+    try:
+        env_vars = config.env_vars()
+    except Exception as ex:  # pylint: disable=broad-except
+        logging.error("Failed to assume role %s - caught exception - %s", config.assume_role_arn, ex)
+        return 1
+
+    if not args["skip_checks"]:
+        if not check_backup_bucket(config):
+            return 1
+        missing = [cmd for cmd in REQUIRED_COMMANDS if shutil.which(cmd) is None]
+        if missing:
+            logging.error("Did not find commands %s - check the pre-requisites section of the README", missing)
+            return 1
+
+    write_private_file(args["iac_config_file"], json.dumps(config.iac.raw, indent=2) + "\n")
+    write_private_file(args["env_vars_file"], format_env_vars(env_vars))
+    logging.info("Wrote %s and %s", args["env_vars_file"], args["iac_config_file"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run_instrumented("last9_config", main))
@@ -0,0 +1,247 @@
+"""
+Shared HTTP client for scripts talking to the Last9 API
+
+All calls go through one keep-alive requests.Session per process with a bounded connection pool and retries with
+backoff on 429/5xx (honouring Retry-After). Per-request latency is tracked for every session created here and can be
+dumped at the end of a run with log_request_stats(). TokenBucket rate limits requests made from several threads.
+
+Access tokens are cached on disk (see last9_cache) keyed by a hash of the refresh token and API base URL, and reused
+until shortly before they expire - the same way last9_config caches assumed role credentials. Set
+LAST9_TOKEN_CACHE=0 to always exchange the refresh token. Callers getting a 401 drop the cached token with
+invalidate_access_token() and exchange the refresh token again.
+
+Sample usage
+
+    from last9_http import get_access_token, get_session, log_request_stats
+
+    session = get_session()
+    access_token = get_access_token(api_base_url, refresh_token)
+    response = session.get(url, headers=headers, timeout=60)
+    ...
+    log_request_stats()
+"""
+
+import os
+import json
+import time
+import base64
+import logging
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from last9_cache import cache_key, cache_path, locked_json_cache
+
+DEFAULT_TIMEOUT_SEC = 60
+DEFAULT_POOL_SIZE = int(os.environ.get("LAST9_HTTP_POOL_SIZE", "10"))
+DEFAULT_MAX_RETRIES = int(os.environ.get("LAST9_HTTP_MAX_RETRIES", "3"))
+DEFAULT_BACKOFF_FACTOR = float(os.environ.get("LAST9_HTTP_BACKOFF_FACTOR", "0.5"))
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+TOKEN_CACHE_ENABLED = os.environ.get("LAST9_TOKEN_CACHE", "1") not in ("0", "false", "no")
+TOKEN_CACHE_FILE = os.environ.get("LAST9_TOKEN_CACHE_FILE", cache_path("token-cache"))
+# Do not reuse tokens expiring in the next 10 mins - same margin as last9_config uses for AWS credentials
+TOKEN_REFRESH_BEFORE_SEC = int(os.environ.get("LAST9_TOKEN_REFRESH_BEFORE_SEC", "600"))
+
+_SESSION = None
+_TOKEN_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+# Per endpoint request stats across all sessions
+REQUEST_STATS = {}
+_STATS_LOCK = threading.Lock()
+
+
+class Last9Session(requests.Session):
+    """requests.Session which records per-request latency
+
+    Requests are grouped by method and URL path - pass stats_key="GET /entities/{id}" to group per entity URLs.
+    """
+
+    def request(self, method, url, *args, stats_key=None, **kwargs):  # pylint: disable=arguments-differ
+        kwargs.setdefault("timeout", DEFAULT_TIMEOUT_SEC)
+        key = stats_key or f"{method.upper()} {urlparse(url).path}"
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = super().request(method, url, *args, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            _record_request(key, status, time.perf_counter() - start)
+
+
+def _record_request(key, status, elapsed_sec):
+    with _STATS_LOCK:
+        entry = REQUEST_STATS.setdefault(key, {"count": 0, "total_sec": 0.0, "max_sec": 0.0, "statuses": {}})
+        entry["count"] += 1
+        entry["total_sec"] += elapsed_sec
+        entry["max_sec"] = max(entry["max_sec"], elapsed_sec)
+        entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+
+
+def new_session(
+    pool_size=DEFAULT_POOL_SIZE,
+    max_retries=DEFAULT_MAX_RETRIES,
+    backoff_factor=DEFAULT_BACKOFF_FACTOR,
+    allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+):
+    """Create a pooled, retrying session
+
+    Only idempotent methods are retried by default - a POST failing with a 5xx may still have created something, e.g.
+    a dashboard. Pass allowed_methods to retry others.
+    """
+    retry = Retry(
+        total=max_retries,
+        connect=max_retries,
+        read=max_retries,
+        status=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=allowed_methods,
+        respect_retry_after_header=True,
+        # Hand the last response back to the caller so existing raise_for_status() handling keeps working
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry, pool_block=True)
+
+    session = Last9Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(pool_size=DEFAULT_POOL_SIZE):
+    """Return the process wide session, creating it on first use"""
+    global _SESSION  # pylint: disable=global-statement
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = new_session(pool_size=pool_size)
+        return _SESSION
+
+
+class TokenBucket:
+    """Thread safe token bucket - at most rate acquisitions per second on average, bursts of up to burst
+
+    A rate of 0 never waits.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available - returns the seconds waited"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Reserve the token even if it is not there yet - callers queue up behind each other instead of racing
+            self._tokens -= 1
+            wait_sec = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait_sec:
+            time.sleep(wait_sec)
+        return wait_sec
+
+
+def _get_token_session():
+    """Session of the token exchange - its POST only returns a token and is safe to retry"""
+    global _TOKEN_SESSION  # pylint: disable=global-statement
+    with _SESSION_LOCK:
+        if _TOKEN_SESSION is None:
+            _TOKEN_SESSION = new_session(pool_size=1, allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"})
+        return _TOKEN_SESSION
+
+
+def log_request_stats(level=logging.INFO):
+    """Log per endpoint request count and latency"""
+    with _STATS_LOCK:
+        stats = {key: dict(entry) for key, entry in REQUEST_STATS.items()}
+    for key, entry in sorted(stats.items()):
+        logging.log(
+            level,
+            "http_request=%s count=%d avg_ms=%.1f max_ms=%.1f statuses=%s",
+            key,
+            entry["count"],
+            1000 * entry["total_sec"] / entry["count"],
+            1000 * entry["max_sec"],
+            ",".join(f"{status}:{count}" for status, count in sorted(entry["statuses"].items())),
+        )
+
+
+def _token_expiry(response_ds, access_token):
+    """Expiry epoch of an access token - from the response if present, else from the JWT exp claim"""
+    if response_ds.get("expires_at"):
+        expires_at = int(response_ds["expires_at"])
+        # Some responses carry epoch millis
+        return expires_at // 1000 if expires_at > 10**12 else expires_at
+    if response_ds.get("expires_in"):
+        return int(time.time()) + int(response_ds["expires_in"])
+    try:
+        payload = access_token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return 0
+
+
+def _exchange_refresh_token(api_base_url, refresh_token):
+    url = f"{api_base_url}/oauth/access_token"
+    headers = {"Content-Type": "application/json"}
+    data = {"refresh_token": refresh_token}
+
+    response = _get_token_session().post(url, headers=headers, json=data, timeout=DEFAULT_TIMEOUT_SEC)
+    response.raise_for_status()
+    response_ds = response.json()
+    access_token = response_ds["access_token"]
+    return access_token, _token_expiry(response_ds, access_token)
+
+
+def get_access_token(api_base_url, refresh_token):
+    """Exchange refresh token for access token, reusing a cached access token while it is fresh enough
+
+    Raises requests.exceptions.RequestException if the exchange fails.
+    """
+    if not TOKEN_CACHE_ENABLED:
+        return _exchange_refresh_token(api_base_url, refresh_token)[0]
+
+    key = cache_key(refresh_token, api_base_url)
+    # Hold the lock across the exchange so concurrent runs wait for one exchange instead of each doing their own
+    with locked_json_cache(TOKEN_CACHE_FILE, optional=True) as cache_ds:
+        now = int(time.time())
+        for cached_key in [k for k, v in cache_ds.items() if v.get("expires_at", 0) <= now]:
+            del cache_ds[cached_key]
+
+        entry = cache_ds.get(key)
+        if entry is not None:
+            seconds_to_expire = entry["expires_at"] - now
+            if seconds_to_expire >= TOKEN_REFRESH_BEFORE_SEC:
+                logging.debug("Reusing cached access token expiring in %d seconds", seconds_to_expire)
+                return entry["access_token"]
+            logging.debug("Cached access token expiring in %d seconds - refreshing", seconds_to_expire)
+
+        access_token, expires_at = _exchange_refresh_token(api_base_url, refresh_token)
+        if expires_at - now >= TOKEN_REFRESH_BEFORE_SEC:
+            cache_ds[key] = {"access_token": access_token, "expires_at": expires_at}
+        else:
+            cache_ds.pop(key, None)
+        return access_token
+
+
+def invalidate_access_token(api_base_url, refresh_token):
+    """Drop the cached access token of a refresh token - call when the API rejects it with 401
+
+    A revoked token would otherwise be reused until its recorded expiry.
+    """
+    if not TOKEN_CACHE_ENABLED:
+        return
+    with locked_json_cache(TOKEN_CACHE_FILE, optional=True) as cache_ds:
+        cache_ds.pop(cache_key(refresh_token, api_base_url), None)
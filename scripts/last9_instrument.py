@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+
+"""
+Phase timing and counters for the pipeline scripts, exported as a Prometheus text file and an optional JSON trace
+
+Scripts time their phases (config load, token exchange, fetch, YAML dump, S3 sync, each l9iac call) with span() and
+count things with inc(). run_instrumented() wraps a script's main() and, at the end of the run, writes
+
+    $LAST9_IAC_METRICS_DIR/<script>.prom        Prometheus text format - for node_exporter's textfile collector or any
+                                                agent scraping a directory of .prom files
+    $LAST9_IAC_TRACE_DIR/<script>.trace.json   Chrome trace event format - open in chrome://tracing or Perfetto
+
+Nothing is written unless the directory is set, spans and counters are always kept in memory (a few dict updates).
+Every value describes the last run of the script - the file is replaced at the end of each run:
+
+    last9_iac_phase_duration_seconds{script,phase,...}   time spent in the phase, summed over its calls
+    last9_iac_phase_max_seconds{script,phase,...}        longest single call
+    last9_iac_phase_calls{script,phase,...}              number of calls
+    last9_iac_phase_errors{script,phase,...}             calls that raised
+    last9_iac_<counter>{script,...}                      counters recorded with inc()
+    last9_iac_http_request_duration_seconds{script,endpoint}, last9_iac_http_requests{script,endpoint,status}
+                                                         Last9 API requests made through last9_http
+    last9_iac_run_duration_seconds, last9_iac_run_success, last9_iac_run_last_timestamp_seconds
+
+Sample usage
+
+    from last9_instrument import inc, run_instrumented, span
+
+    with span("token_exchange"):
+        access_token = get_access_token(...)
+    inc("alerts_saved", saved_count)
+    ...
+    sys.exit(run_instrumented("fetch_alerts", main))
+
+Shell scripts record their phases as start,end epoch pairs and write them on exit (see run-iac.sh)
+
+python scripts/last9_instrument.py --script run_iac --exit-status 0 --start 1700000000.0 \
+    --phase load_config=1700000000.1,1700000002.4
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import logging
+import threading
+import contextlib
+
+METRICS_DIR = os.environ.get("LAST9_IAC_METRICS_DIR", "")
+TRACE_DIR = os.environ.get("LAST9_IAC_TRACE_DIR", "")
+METRIC_PREFIX = "last9_iac_"
+
+# Wall clock and monotonic clock at import - trace timestamps are monotonic offsets from here
+_EPOCH = time.time()
+_EPOCH_PERF = time.perf_counter()
+
+# {(phase, labels): {"calls", "total_sec", "max_sec", "errors"}} and {(counter, labels): value}
+SPAN_STATS = {}
+COUNTERS = {}
+TRACE_EVENTS = []
+_STATS_LOCK = threading.Lock()
+
+_NAME_RE = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def record_span(name, start, end, error=False, trace_args=None, **labels):
+    """Record a phase which ran from start to end - perf_counter() values"""
+    elapsed_sec = end - start
+    with _STATS_LOCK:
+        entry = SPAN_STATS.setdefault(
+            (name, _label_key(labels)), {"calls": 0, "total_sec": 0.0, "max_sec": 0.0, "errors": 0}
+        )
+        entry["calls"] += 1
+        entry["total_sec"] += elapsed_sec
+        entry["max_sec"] = max(entry["max_sec"], elapsed_sec)
+        entry["errors"] += 1 if error else 0
+        TRACE_EVENTS.append(
+            {
+                "name": name,
+                "ph": "X",
+                "ts": round(1e6 * (start - _EPOCH_PERF)),
+                "dur": round(1e6 * elapsed_sec),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": {**labels, **(trace_args or {}), **({"error": True} if error else {})},
+            }
+        )
+
+
+@contextlib.contextmanager
+def span(name, **labels):
+    """Time the block as phase name - yields a dict whose items are added to the trace event only
+
+    Labels end up in the metrics, keep them low cardinality (command=plan, not file=...). Per call details such as
+    the file being processed go into the yielded dict.
+    """
+    trace_args = {}
+    start = time.perf_counter()
+    error = False
+    try:
+        yield trace_args
+    except BaseException:
+        error = True
+        raise
+    finally:
+        record_span(name, start, time.perf_counter(), error, trace_args, **labels)
+
+
+def inc(name, value=1, **labels):
+    """Add value to counter name"""
+    with _STATS_LOCK:
+        key = (name, _label_key(labels))
+        COUNTERS[key] = COUNTERS.get(key, 0) + value
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels):
+    return "{" + ",".join(f'{_NAME_RE.sub("_", key)}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _http_stats():
+    """Request stats of last9_http, if the script uses it"""
+    last9_http = sys.modules.get("last9_http")
+    if last9_http is None:
+        return {}
+    with last9_http._STATS_LOCK:  # pylint: disable=protected-access
+        return {key: dict(entry, statuses=dict(entry["statuses"])) for key, entry in last9_http.REQUEST_STATS.items()}
+
+
+def format_metrics(script, exit_status, duration_sec):
+    """Prometheus text format of the spans, counters and HTTP stats recorded in this run"""
+    with _STATS_LOCK:
+        spans = {key: dict(entry) for key, entry in SPAN_STATS.items()}
+        counters = dict(COUNTERS)
+    script_label = (("script", script),)
+
+    families = {}
+
+    def _add(name, help_text, labels, value):
+        family = families.setdefault(METRIC_PREFIX + _NAME_RE.sub("_", name), (help_text, []))
+        family[1].append(f"{_labels(script_label + tuple(labels))} {value}")
+
+    for (phase, labels), entry in sorted(spans.items()):
+        labels = (("phase", phase),) + labels
+        _add("phase_duration_seconds", "Seconds spent in the phase in the last run", labels, entry["total_sec"])
+        _add("phase_max_seconds", "Longest call of the phase in the last run", labels, entry["max_sec"])
+        _add("phase_calls", "Calls of the phase in the last run", labels, entry["calls"])
+        _add("phase_errors", "Calls of the phase which raised in the last run", labels, entry["errors"])
+
+    for (name, labels), value in sorted(counters.items()):
+        _add(name, f"Counter {name} of the last run", labels, value)
+
+    for key, entry in sorted(_http_stats().items()):
+        labels = (("endpoint", key),)
+        _add("http_request_duration_seconds", "Seconds spent in Last9 API requests", labels, entry["total_sec"])
+        _add("http_request_max_seconds", "Longest Last9 API request", labels, entry["max_sec"])
+        for status, count in sorted(entry["statuses"].items()):
+            _add("http_requests", "Last9 API requests by status", labels + (("status", status),), count)
+
+    _add("run_duration_seconds", "Wall time of the last run", (), duration_sec)
+    _add("run_success", "1 if the last run exited with status 0", (), 1 if exit_status == 0 else 0)
+    _add("run_last_timestamp_seconds", "End of the last run", (), time.time())
+
+    lines = []
+    for name, (help_text, samples) in families.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        lines += [name + sample for sample in samples]
+    return "\n".join(lines) + "\n"
+
+
+def format_trace(script):
+    """Chrome trace event JSON of the spans recorded in this run"""
+    with _STATS_LOCK:
+        events = list(TRACE_EVENTS)
+    return json.dumps(
+        {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"script": script, "start_time": _EPOCH},
+        }
+    )
+
+
+def write_outputs(script, exit_status, duration_sec, metrics_dir=None, trace_dir=None):
+    """Write the metrics / trace files of the run to the directories set - never raises"""
+    metrics_dir = METRICS_DIR if metrics_dir is None else metrics_dir
+    trace_dir = TRACE_DIR if trace_dir is None else trace_dir
+    if not metrics_dir and not trace_dir:
+        return
+
+    # Imported here - fetch-alerts.py only installs PyYAML (which last9_yaml needs) after its imports
+    from last9_yaml import atomic_write_text  # pylint: disable=import-outside-toplevel
+
+    outputs = []
+    if metrics_dir:
+        outputs.append(
+            (os.path.join(metrics_dir, f"{script}.prom"), lambda: format_metrics(script, exit_status, duration_sec))
+        )
+    if trace_dir:
+        outputs.append((os.path.join(trace_dir, f"{script}.trace.json"), lambda: format_trace(script)))
+    for path, render in outputs:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomic_write_text(path, render())
+            logging.debug("Wrote %s", path)
+        except Exception as ex:  # pylint: disable=broad-except
+            logging.warning("Failed to write %s - caught exception - %s", path, ex)
+
+
+def run_instrumented(script, main):
+    """Run main() and write the metrics / trace files of the run whatever its outcome - returns main()'s status"""
+    start = time.perf_counter()
+    exit_status = 1
+    try:
+        exit_status = main()
+        return exit_status
+    finally:
+        write_outputs(script, exit_status, time.perf_counter() - start)
+
+
+def load_args():
+    """Parse cli"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--script", help="Script name - names the output files", required=True)
+    parser.add_argument("--exit-status", type=int, help="Exit status of the script", default=0)
+    parser.add_argument("--start", type=float, help="Epoch start of the run (default: start of the first phase)")
+    parser.add_argument(
+        "--phase",
+        action="append",
+        help="name=start,end with start / end epoch seconds - repeat for each phase",
+        default=[],
+    )
+    parser.add_argument("--metrics-dir", help="Metrics directory", default=METRICS_DIR)
+    parser.add_argument("--trace-dir", help="Trace directory", default=TRACE_DIR)
+    parser.add_argument("--log-level", help="Log level", default=os.environ.get("LOG_LEVEL", "INFO"))
+    return vars(parser.parse_args(sys.argv[1:]))
+
+
+def validate_args(args):
+    """Validate input args - parses --phase into args['phases']"""
+    args["phases"] = []
+    for phase in args["phase"]:
+        try:
+            name, times = phase.split("=", 1)
+            start, end = (float(value) for value in times.split(","))
+        except ValueError:
+            logging.error("phase=%s is not name=start,end", phase)
+            return False
+        args["phases"].append((name, start, end))
+    return True
+
+
+def setup_logging(log_level):
+    """Setup logging"""
+    log_level = getattr(logging, log_level.upper())
+    logging.basicConfig(
+        level=log_level, format="%(asctime)s.%(msecs)03d %(levelname)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    return True
+
+
+def main():
+    """Main function"""
+    args = load_args()
+
+    if not setup_logging(args["log_level"]):
+        return 1
+
+    if not validate_args(args):
+        return 1
+
+    global _EPOCH, _EPOCH_PERF  # pylint: disable=global-statement
+    run_start = args["start"] or min((start for _, start, _ in args["phases"]), default=time.time())
+    # The phases ended before this process started - record them on the epoch clock, the trace starting at the run
+    _EPOCH = _EPOCH_PERF = run_start
+    for name, start, end in args["phases"]:
+        record_span(name, start, end)
+    write_outputs(args["script"], args["exit_status"], time.time() - run_start, args["metrics_dir"], args["trace_dir"])
+    return 0
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    sys.exit(exit_status)
@@ -0,0 +1,228 @@
+"""
+Layouts of a directory of alert manager files, and the JSON Lines archive
+
+    files    one <alert-name>.yaml per entity - what fetch-alerts.py writes by default
+    by-type  one <type>.yaml per entity type holding all the entities of that type
+    shards   a fixed number of alerts-NNN-of-MMM.yaml files - an entity always lands in the shard picked by the hash
+             of its external_ref, so refetching moves nothing between shards
+
+Every file is an `entities:` document l9iac applies as is - grouping trades thousands of small files (and as many
+l9iac invocations) for a handful of large ones. The archive (.jsonl.gz) holds one entity per line, for backups.
+
+Writers stream: entities are serialized as they are written and the files appear atomically when the writer is
+closed, so memory does not grow with the number of entities. Closing a LayoutWriter then removes the alert files an
+earlier run left in another layout or shard count (see stale_layout_files), which l9iac would apply a second time.
+
+Sample usage
+
+    from last9_layout import ArchiveWriter, LayoutWriter, iter_entities
+
+    with LayoutWriter("../acme-alerts", "shards", shards=8) as writer, ArchiveWriter("alerts.jsonl.gz") as archive:
+        for _, entity in iter_entities(["../acme-alerts-old"]):
+            writer.write(entity)
+            archive.write(entity)
+"""
+
+import os
+import re
+import glob
+import gzip
+import json
+import hashlib
+
+from last9_yaml import EntitiesWriter, atomic_replace, atomic_temp_file, load_yaml_file, write_yaml_files
+
+OUTPUT_FORMATS = ("files", "by-type", "shards")
+DEFAULT_SHARDS = 8
+ARCHIVE_SUFFIX = ".jsonl.gz"
+
+
+def entity_file_name(entity):
+    """File name of an entity in the files layout"""
+    return entity.get("name", "unnamed").lower().replace(" ", "-").replace("_", "-") + ".yaml"
+
+
+def entity_type(entity):
+    """Type of an entity as used for the by-type layout and the fetch summary"""
+    return entity.get("type", "unknown").lower().replace(" ", "-")
+
+
+def shard_index(entity, shards):
+    """Shard of an entity - stable across runs and machines"""
+    ref = entity.get("external_ref") or entity.get("name", "unnamed")
+    return int(hashlib.sha256(ref.encode("utf-8")).hexdigest()[:8], 16) % shards
+
+
+def shard_file_name(index, shards):
+    """File name of a shard"""
+    return f"alerts-{index + 1:03d}-of-{shards:03d}.yaml"
+
+
+SHARD_FILE_PATTERN = re.compile(r"alerts-\d{3,}-of-\d{3,}\.yaml")
+
+
+def layout_of_file(path):
+    """Layout an alert file was written in, judged by its name and entities - None for files no layout names so"""
+    file_name = os.path.basename(path)
+    if SHARD_FILE_PATTERN.fullmatch(file_name):
+        return "shards"
+    if not file_name.endswith(".yaml"):
+        return None
+    with open(path, encoding="utf-8") as input_fd:
+        if not any(line.startswith("entities:") for line in input_fd):
+            return None
+    entities = (load_yaml_file(path) or {}).get("entities") or []
+    if len(entities) == 1 and entity_file_name(entities[0]) == file_name:
+        return "files"
+    if entities and all(entity_type(entity) + ".yaml" == file_name for entity in entities):
+        return "by-type"
+    return None
+
+
+def stale_layout_files(output_dir, output_format, keep):
+    """Alert files of output_dir not in keep which a run writing output_format leaves behind
+
+    Only files named as a layout would name them are considered - shards, <type>.yaml holding entities of that type
+    only, <alert-name>.yaml holding that alert - other files are left alone. A files layout run keeps per entity
+    files it did not write, so the file of an alert deleted upstream stays as before.
+    """
+    keep = {os.path.abspath(path) for path in keep}
+    stale = []
+    for path in sorted(glob.glob(os.path.join(output_dir, "*.yaml"))):
+        if os.path.abspath(path) in keep:
+            continue
+        layout = layout_of_file(path)
+        if layout is not None and not (layout == "files" and output_format == "files"):
+            stale.append(path)
+    return stale
+
+
+def remove_stale_layout_files(output_dir, output_format, keep):
+    """Remove the files stale_layout_files() reports - returns their paths"""
+    stale = stale_layout_files(output_dir, output_format, keep)
+    for path in stale:
+        os.unlink(path)
+    return stale
+
+
+class LayoutWriter:
+    """Write entities to output_dir in one of OUTPUT_FORMATS
+
+    In the files layout each entity is written right away (the last of several entities mapping to the same file
+    wins). The grouped layouts keep one open EntitiesWriter per file and publish them all on close(), which then
+    removes the stale files of other layouts - their paths are kept in removed.
+    """
+
+    def __init__(self, output_dir, output_format, shards=DEFAULT_SHARDS):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format {output_format}")
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.shards = shards
+        self.counts = {}
+        self.removed = []
+        self._writers = {}
+
+    def file_name(self, entity):
+        """File of the layout entity is written to"""
+        if self.output_format == "by-type":
+            return entity_type(entity) + ".yaml"
+        if self.output_format == "shards":
+            return shard_file_name(shard_index(entity, self.shards), self.shards)
+        return entity_file_name(entity)
+
+    def write(self, entity):
+        """Write an entity - returns the path it goes to"""
+        path = os.path.join(self.output_dir, self.file_name(entity))
+        if self.output_format == "files":
+            for _, error in write_yaml_files([(path, {"entities": [entity]})]):
+                if error is not None:
+                    raise OSError(f"Failed to write {path}: {error}")
+            self.counts[path] = 1
+            return path
+        if path not in self._writers:
+            self._writers[path] = EntitiesWriter(path)
+        self._writers[path].write(entity)
+        self.counts[path] = self._writers[path].count
+        return path
+
+    def close(self):
+        """Publish the grouped files and remove stale ones - returns {path: entity count} of the files written"""
+        while self._writers:
+            _, writer = self._writers.popitem()
+            writer.close()
+        self.removed = remove_stale_layout_files(self.output_dir, self.output_format, self.counts)
+        return self.counts
+
+    def abort(self):
+        """Drop the grouped files not yet published"""
+        while self._writers:
+            _, writer = self._writers.popitem()
+            writer.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ArchiveWriter:
+    """Stream entities into a gzip compressed JSON Lines archive - the file appears atomically on close()"""
+
+    def __init__(self, path):
+        self.path = os.fspath(path)
+        self.count = 0
+        fd, self._tmp_path = atomic_temp_file(self.path)
+        self._raw_fd = os.fdopen(fd, "wb")
+        self._fd = gzip.open(self._raw_fd, "wt", encoding="utf-8")
+
+    def write(self, entity):
+        """Append an entity to the archive"""
+        self._fd.write(json.dumps(entity, separators=(",", ":"), default=str) + "\n")
+        self.count += 1
+
+    def close(self):
+        """Finish the archive and move it into place"""
+        self._fd.close()
+        self._raw_fd.close()
+        atomic_replace(self._tmp_path, self.path)
+
+    def abort(self):
+        """Drop the archive - path is left untouched"""
+        self._fd.close()
+        self._raw_fd.close()
+        os.unlink(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def iter_entities(paths):
+    """Entities of alert files, directories of alert files and archives, one file in memory at a time
+
+    Directories are read in file name order, *.yaml / *.yml directly in them. Yields (source path, entity).
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(glob.glob(os.path.join(path, "*.yaml")) + glob.glob(os.path.join(path, "*.yml")))
+        else:
+            files = [path]
+        for file_path in files:
+            if file_path.endswith(ARCHIVE_SUFFIX):
+                with gzip.open(file_path, "rt", encoding="utf-8") as input_fd:
+                    for line in input_fd:
+                        if line.strip():
+                            yield file_path, json.loads(line)
+                continue
+            for entity in (load_yaml_file(file_path) or {}).get("entities") or []:
+                yield file_path, entity
@@ -0,0 +1,382 @@
+"""
+NumPy evaluator for the anomaly macros of last9-alert-catalog/macros.txt - low_value, high_spike, changepoint and the
+like - to preview what they produce on recorded series without deploying them
+
+Series are rows of 2D float arrays, one column per step (NaN where there is no sample), so one evaluation covers
+many series at once. A macro's lets are evaluated in order, each once, then its return expression. Supported:
+
+    functions   median_over_time, avg_over_time, min_over_time, max_over_time, sum_over_time, count_over_time,
+                stddev_over_time, delta, smooth_exponential, abs, vector, alias, union and calls of other macros
+    operators   + - * / % ^, comparisons with and without bool, and / or / unless, if / ifnot / default, offset
+
+Label matching (on, ignoring, group_left, ...) is ignored - every row is evaluated on its own. Anything else, such
+as the histogram_over_time of the trend macros, raises UnsupportedError.
+
+The window functions work on whole arrays: sums and averages are differences of cumulative sums, medians sort a
+sliding window view of a block of columns at a time, and smooth_exponential solves the EWMA recurrence in closed form
+for a block of steps at once. delta is the difference to the sample one window earlier.
+
+Sample usage
+
+    from last9_macro_eval import MacroEvaluator
+
+    evaluator = MacroEvaluator(load_macros())
+    anomalies = evaluator.evaluate_macro("high_spike", [9, values])  # values: series x steps array
+    anomalies = evaluator.evaluate_call("high_spike(9, 5xx Status)", resolve={"5xx Status": values}.get)
+"""
+
+from collections import namedtuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from last9_macros import parse_call
+from last9_promql import AGGREGATIONS, duration_seconds, tokenize
+
+DEFAULT_STEP_SEC = 60
+# Elements of a sliding window view materialized at once by the median kernel
+WINDOW_BLOCK_ELEMENTS = 1 << 22
+# Smallest decay a closed form EWMA block may reach before the next block starts from its last value
+EWMA_MIN_DECAY = 1e-150
+
+# values of a range selector - q[1h] - and its window in steps
+Range = namedtuple("Range", ["values", "steps"])
+
+_PRECEDENCE = {
+    "default": 1, "if": 2, "ifnot": 2, "or": 3, "and": 4, "unless": 4,
+    "==": 5, "!=": 5, "<": 5, ">": 5, "<=": 5, ">=": 5, "+": 6, "-": 6, "*": 7, "/": 7, "%": 7, "^": 8,
+}  # fmt: skip
+_COMPARISONS = {
+    "==": np.equal, "!=": np.not_equal, "<": np.less, ">": np.greater, "<=": np.less_equal, ">=": np.greater_equal,
+}  # fmt: skip
+_ARITHMETIC = {"+": np.add, "-": np.subtract, "*": np.multiply, "/": np.divide, "%": np.fmod, "^": np.power}
+_MODIFIERS = {"on", "ignoring", "group_left", "group_right"}
+
+
+class UnsupportedError(ValueError):
+    """An expression using a function outside the supported set"""
+
+
+def as_rows(values):
+    """values as a 2D float array, one row per series"""
+    return np.atleast_2d(np.asarray(values, dtype=np.float64))
+
+
+def shift(values, steps):
+    """values moved steps columns later, NaN filled - offset"""
+    shifted = np.full_like(values, np.nan)
+    if steps <= 0:
+        return values
+    if steps < values.shape[-1]:
+        shifted[..., steps:] = values[..., :-steps]
+    return shifted
+
+
+def rolling_sums(values, steps):
+    """(sum, count, sum of squares) of the samples in the window of steps columns ending at each column"""
+    present = ~np.isnan(values)
+    filled = np.where(present, values, 0.0)
+    results = []
+    for totals in (np.cumsum(filled, axis=-1), np.cumsum(present, axis=-1), np.cumsum(filled * filled, axis=-1)):
+        window = totals.astype(np.float64)
+        window[..., steps:] -= totals[..., :-steps]
+        results.append(window)
+    return results
+
+
+def rolling_average(values, steps):
+    """avg_over_time"""
+    sums, counts, _ = rolling_sums(values, steps)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def rolling_stddev(values, steps):
+    """stddev_over_time - population standard deviation"""
+    sums, counts, squares = rolling_sums(values, steps)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = sums / counts
+        return np.where(counts > 0, np.sqrt(np.maximum(squares / counts - mean * mean, 0.0)), np.nan)
+
+
+def _windows(values, steps):
+    """Sliding window view - rows x columns x steps, NaN padded before the first column"""
+    padded = np.concatenate([np.full(values.shape[:-1] + (steps - 1,), np.nan), values], axis=-1)
+    return sliding_window_view(padded, steps, axis=-1)
+
+
+def rolling_extreme(values, steps, reduce):
+    """min_over_time / max_over_time with reduce np.fmin / np.fmax, which skip NaN"""
+    return reduce.reduce(_windows(values, steps), axis=-1)
+
+
+def rolling_median(values, steps):
+    """median_over_time
+
+    The windows of a block of columns are sorted at once - NaN goes last - and the middle of their present samples
+    picked. For windows of tens of samples a vectorized sort beats np.partition and np.nanmedian.
+    """
+    rows, columns = values.shape
+    windows = _windows(values, steps)
+    totals = np.cumsum(~np.isnan(values), axis=-1)
+    counts = totals.copy()
+    counts[..., steps:] -= totals[..., :-steps]
+    result = np.empty(values.shape)
+    block = max(1, WINDOW_BLOCK_ELEMENTS // max(1, rows * steps))
+    for start in range(0, columns, block):
+        end = min(start + block, columns)
+        ordered = np.sort(windows[:, start:end], axis=-1)
+        count = counts[:, start:end, None]
+        low = np.take_along_axis(ordered, np.maximum(count - 1, 0) // 2, axis=-1)[..., 0]
+        high = np.take_along_axis(ordered, count // 2, axis=-1)[..., 0]
+        result[:, start:end] = np.where(count[..., 0] > 0, (low + high) / 2, np.nan)
+    return result
+
+
+def smooth_exponential(values, factor):
+    """EWMA of each row - s[t] = s[t-1] + factor * (x[t] - s[t-1]), starting at the first sample
+
+    Within a block, s[t] = P[t] * (s0 + sum(factor * x[k] / P[k])) with P the cumulative product of (1 - factor)
+    over the samples so far. Blocks are sized so that P stays above EWMA_MIN_DECAY. Steps without a sample leave s
+    unchanged and are NaN in the result.
+    """
+    factor = float(factor)
+    if not 0 <= factor <= 1:
+        raise ValueError(f"smooth_exponential factor {factor} must be between 0 and 1")
+    rows, columns = values.shape
+    present = ~np.isnan(values)
+    state = values[np.arange(rows), np.argmax(present, axis=-1)] if columns else np.full(rows, np.nan)
+    if factor == 1 or not columns:
+        return values.copy()
+    if factor == 0:
+        return np.where(present, state[:, None], np.nan)
+
+    weights = np.where(present, factor, 0.0)
+    inputs = np.where(present, values, 0.0) * weights
+    result = np.empty(values.shape)
+    block = int(min(max(np.log(EWMA_MIN_DECAY) / np.log1p(-factor), 1), columns))
+    for start in range(0, columns, block):
+        end = min(start + block, columns)
+        decay = np.cumprod(1.0 - weights[:, start:end], axis=-1)
+        result[:, start:end] = decay * (state[:, None] + np.cumsum(inputs[:, start:end] / decay, axis=-1))
+        state = result[:, end - 1]
+    return np.where(present, result, np.nan)
+
+
+class _Parser:
+    """Precedence climbing evaluation of one expression's tokens"""
+
+    def __init__(self, evaluator, tokens, env):
+        self.evaluator = evaluator
+        self.tokens = tokens
+        self.env = env
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, text=None):
+        token = self.peek()
+        if token[0] is None or (text is not None and token[1] != text):
+            raise ValueError(f"expected {text or 'more'} at token {self.position}, got {token[1]}")
+        self.position += 1
+        return token
+
+    def skip_modifiers(self):
+        while self.peek()[1] in _MODIFIERS:
+            self.take()
+            if self.peek()[1] == "(":
+                while self.take()[1] != ")":
+                    pass
+
+    def expression(self, min_precedence=0):
+        left = self.unary()
+        while True:
+            kind, text = self.peek()
+            precedence = _PRECEDENCE.get(text) if kind in ("op", "ident") else None
+            if precedence is None or precedence < min_precedence:
+                return left
+            self.take()
+            is_bool = text in _COMPARISONS and self.peek() == ("ident", "bool")
+            if is_bool:
+                self.take()
+            self.skip_modifiers()
+            right = self.expression(precedence if text == "^" else precedence + 1)
+            left = self.evaluator.binary(text, left, right, is_bool)
+
+    def unary(self):
+        kind, text = self.peek()
+        if kind == "op" and text in ("-", "+"):
+            self.take()
+            value = self.expression(_PRECEDENCE["^"])
+            return self.evaluator.binary("*", -1.0, value, False) if text == "-" else value
+        return self.postfix(self.primary())
+
+    def postfix(self, value):
+        while True:
+            text = self.peek()[1]
+            if text == "[":
+                self.take()
+                window = self.take()
+                self.take("]")
+                if window[0] != "duration":
+                    raise UnsupportedError(f"range [{window[1]}...] is not supported")
+                value = Range(as_rows(value), self.evaluator.steps(window[1]))
+            elif text == "offset":
+                self.take()
+                steps = self.evaluator.steps(self.take()[1])
+                if isinstance(value, Range):
+                    value = Range(shift(value.values, steps), value.steps)
+                else:
+                    value = shift(as_rows(value), steps)
+            else:
+                return value
+
+    def primary(self):
+        kind, text = self.take()
+        if kind == "number":
+            return float(int(text, 16)) if text.lower().startswith("0x") else float(text)
+        if kind == "string":
+            return text[1:-1]
+        if text == "(":
+            value = self.expression()
+            self.take(")")
+            return value
+        if kind == "ident":
+            if self.peek()[1] == "(":
+                return self.call(text)
+            if text in self.env:
+                return self.env[text]
+            if text.lower() in ("inf", "nan"):
+                return float(text)
+            if text in AGGREGATIONS:
+                raise UnsupportedError(f"aggregation {text} is not supported")
+            raise ValueError(f"unknown name {text}")
+        raise ValueError(f"unexpected {text} at token {self.position - 1}")
+
+    def call(self, name):
+        self.take("(")
+        args = []
+        while self.peek()[1] != ")":
+            args.append(self.expression())
+            if self.peek()[1] != ",":
+                break
+            self.take(",")
+        self.take(")")
+        return self.evaluator.call(name, args)
+
+
+class MacroEvaluator:
+    """Evaluates macros of a parsed macros file over rows of series sampled every step_sec"""
+
+    def __init__(self, macros, step_sec=DEFAULT_STEP_SEC):
+        self.macros = macros
+        self.step_sec = step_sec
+        self.functions = {
+            "median_over_time": lambda window: rolling_median(window.values, window.steps),
+            "avg_over_time": lambda window: rolling_average(window.values, window.steps),
+            "sum_over_time": lambda window: self._sum_over_time(window, 0),
+            "count_over_time": lambda window: self._sum_over_time(window, 1),
+            "stddev_over_time": lambda window: rolling_stddev(window.values, window.steps),
+            "min_over_time": lambda window: rolling_extreme(window.values, window.steps, np.fmin),
+            "max_over_time": lambda window: rolling_extreme(window.values, window.steps, np.fmax),
+            "delta": lambda window: window.values - shift(window.values, window.steps),
+            "smooth_exponential": lambda values, factor: smooth_exponential(as_rows(values), factor),
+            "abs": np.abs,
+            "vector": float,
+            "alias": lambda values, name: {name: values},
+            "union": self._union,
+        }
+
+    def steps(self, duration):
+        """Steps in a duration such as 1h"""
+        return max(1, int(round(duration_seconds(duration) / self.step_sec)))
+
+    @staticmethod
+    def _sum_over_time(window, index):
+        sums, counts, _ = rolling_sums(window.values, window.steps)
+        return np.where(counts > 0, (sums, counts)[index], np.nan)
+
+    @staticmethod
+    def _union(*values):
+        outputs = {}
+        for index, value in enumerate(values):
+            outputs.update(value if isinstance(value, dict) else {f"output_{index}": value})
+        return outputs
+
+    def call(self, name, args):
+        """Value of a function or macro call with evaluated arguments"""
+        if name in self.macros and name not in self.functions:
+            return self.evaluate_macro(name, args)
+        if name not in self.functions:
+            raise UnsupportedError(f"function {name} is not supported")
+        ranges = name.endswith("_over_time") or name == "delta"
+        if ranges != bool(args and isinstance(args[0], Range)):
+            raise ValueError(f"{name} takes {'a' if ranges else 'no'} range argument")
+        with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+            return self.functions[name](*args)
+
+    def binary(self, operator, left, right, is_bool):
+        """Value of a binary operation on series rows / scalars"""
+        for value in (left, right):
+            if isinstance(value, (Range, dict, str)):
+                raise ValueError(f"operator {operator} does not apply to {type(value).__name__} values")
+        with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+            if operator in _ARITHMETIC:
+                return _ARITHMETIC[operator](left, right)
+            if operator in _COMPARISONS:
+                holds = _COMPARISONS[operator](left, right)
+                if is_bool:
+                    return np.where(np.isnan(left) | np.isnan(right), np.nan, holds.astype(np.float64))
+                # Filtering keeps the series side of a scalar comparison
+                kept = right if np.ndim(left) == 0 and np.ndim(right) > 0 else left
+                return np.where(holds, kept, np.nan)
+            if operator in ("and", "if"):
+                return np.where(np.isnan(right), np.nan, left)
+            if operator in ("unless", "ifnot"):
+                return np.where(np.isnan(right), left, np.nan)
+            # or, default
+            return np.where(np.isnan(left), right, left)
+
+    def evaluate(self, text, env=None):
+        """Value of an expression text, names bound in env"""
+        tokens = tokenize(str(text))
+        parser = _Parser(self, tokens, env or {})
+        value = parser.expression()
+        if parser.position != len(tokens):
+            raise ValueError(f"unexpected {tokens[parser.position][1]} at token {parser.position}")
+        return value
+
+    def evaluate_macro(self, name, args):
+        """Result of a macro for evaluated arguments - rows, a scalar, or {alias: rows} for union() results"""
+        macro = self.macros.get(name)
+        if macro is None:
+            raise UnsupportedError(f"unknown macro {name}")
+        if len(args) != len(macro.params):
+            raise ValueError(f"macro {name} takes {len(macro.params)} arguments, got {len(args)}")
+        env = dict(zip(macro.params, args))
+        for let_name, tokens in macro.lets:
+            env[let_name] = self._evaluate_tokens(tokens, env)
+        return self._evaluate_tokens(macro.result, env)
+
+    def _evaluate_tokens(self, tokens, env):
+        parser = _Parser(self, list(tokens), env)
+        value = parser.expression()
+        if parser.position != len(tokens):
+            raise ValueError(f"unexpected {tokens[parser.position][1]} at token {parser.position}")
+        return value
+
+    def evaluate_call(self, text, resolve):
+        """Result of a macro call such as high_spike(9, 5xx Status)
+
+        resolve maps an argument text to its series rows, or returns None to evaluate the argument as an expression.
+        """
+        call = parse_call(text)
+        if call is None or call[0] not in self.macros:
+            raise UnsupportedError(f"{text} is not a macro call")
+        name, arg_texts = call
+        args = []
+        for arg_text in arg_texts:
+            value = resolve(arg_text)
+            args.append(as_rows(value) if value is not None else self.evaluate(arg_text))
+        return self.evaluate_macro(name, args)
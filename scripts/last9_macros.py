@@ -0,0 +1,314 @@
+"""
+Parser and expander for the Levitate macros of last9-alert-catalog/macros.txt
+
+Macros are functions written in a small let / return language:
+
+    function low_value(tolerance,metric){
+        let q=metric
+        let med = median_over_time(q[1h])
+        return ((q if (q<med)) default med)
+    }
+
+MacroExpander replaces macro calls - in indicator queries or alert rule expressions - by the plain MetricsQL they
+stand for. Arguments are expanded first, so nested calls work, and an argument naming an indicator (alert rule
+expressions call macros on indicator names, e.g. increasing_trend(9, 4xx Status)) can be resolved to its query.
+Parameters and lets are substituted token-wise: composite values are parenthesized, label matcher values are spliced
+into selectors - q{metric_filter} - and durations into range windows - q[window].
+
+Every expansion is cached by the sha256 of (macro, arguments), so expanding the same call again - the same rule
+expression across many entities, or a nested call repeated inside other macros - is a dict lookup.
+
+A let used more than once is inlined at every use, the backend evaluates it each time. shared_subexpressions()
+reports these and the lets repeated across expansions, as candidates for shared recording-style indicators.
+
+Sample usage
+
+    from last9_macros import MacroExpander, load_macros
+
+    expander = MacroExpander(load_macros("last9-alert-catalog/macros.txt"))
+    query = expander.expand("high_spike(9, 5xx Status)", resolve={"5xx Status": "sum(rate(errors[1m]))"}.get)
+"""
+
+import re
+import hashlib
+import functools
+from collections import namedtuple
+
+from last9_promql import render, tokenize
+
+DEFAULT_MACROS_FILE = "last9-alert-catalog/macros.txt"
+
+Macro = namedtuple("Macro", ["name", "params", "lets", "result"])
+Expansion = namedtuple("Expansion", ["macro", "query", "lets"])
+
+_FUNCTION_RE = re.compile(r"\bfunction\s+(\w+)\s*\(([^)]*)\)\s*\{")
+_CALL_RE = re.compile(r"(?<![\w:.])([a-zA-Z_]\w*)\s*\(")
+_STRING_RE = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'')
+_MATCHER_OPS = ("=", "=~", "!=", "!~")
+
+
+def _closing(text, start, open_char, close_char):
+    """Index of the close_char matching the open_char at text[start], skipping quoted strings"""
+    depth = 0
+    index = start
+    while index < len(text):
+        char = text[index]
+        if char in "\"'":
+            match = _STRING_RE.match(text, index)
+            if match:
+                index = match.end()
+                continue
+        if char == open_char:
+            depth += 1
+        elif char == close_char:
+            depth -= 1
+            if depth == 0:
+                return index
+        index += 1
+    raise ValueError(f"unbalanced {open_char}{close_char} at offset {start}")
+
+
+def _split_args(text):
+    """Split a call's argument text on top level commas"""
+    args, depth, start = [], 0, 0
+    index = 0
+    while index < len(text):
+        char = text[index]
+        if char in "\"'":
+            match = _STRING_RE.match(text, index)
+            if match:
+                index = match.end()
+                continue
+        if char in "([{":
+            depth += 1
+        elif char in ")]}":
+            depth -= 1
+        elif char == "," and depth == 0:
+            args.append(text[start:index].strip())
+            start = index + 1
+        index += 1
+    args.append(text[start:].strip())
+    # f() has no arguments rather than one empty one
+    return [] if args == [""] else args
+
+
+def parse_call(text):
+    """(name, [argument texts]) of text if it is a single function call - f(a, b) - None otherwise"""
+    text = str(text).strip()
+    match = _CALL_RE.match(text)
+    if not match:
+        return None
+    try:
+        call_end = _closing(text, match.end() - 1, "(", ")")
+    except ValueError:
+        return None
+    if call_end != len(text) - 1:
+        return None
+    return match.group(1), _split_args(text[match.end() : call_end])
+
+
+def parse_macros(text):
+    """{name: Macro} of the functions defined in a macros file"""
+    macros = {}
+    for match in _FUNCTION_RE.finditer(text):
+        name = match.group(1)
+        params = [param.strip() for param in match.group(2).split(",") if param.strip()]
+        body_end = _closing(text, match.end() - 1, "{", "}")
+        tokens = tokenize(text[match.end() : body_end])
+
+        statements, current = [], None
+        for token in tokens:
+            if token[0] == "ident" and token[1] in ("let", "return"):
+                current = [token[1]]
+                statements.append(current)
+            elif current is not None:
+                current.append(token)
+
+        lets, result = [], None
+        for statement in statements:
+            if statement[0] == "let":
+                if len(statement) < 4 or statement[2] != ("op", "="):
+                    raise ValueError(f"macro {name}: invalid let statement {render(statement[1:])}")
+                lets.append((statement[1][1], tuple(statement[3:])))
+            else:
+                result = tuple(statement[1:])
+        if result is None:
+            raise ValueError(f"macro {name}: missing return statement")
+        macros[name] = Macro(name, tuple(params), tuple(lets), result)
+    return macros
+
+
+def load_macros(macros_file=DEFAULT_MACROS_FILE):
+    """Parse a macros file"""
+    with open(macros_file, "r", encoding="utf-8") as input_fd:
+        return parse_macros(input_fd.read())
+
+
+@functools.lru_cache(maxsize=4096)
+def _value_tokens(value):
+    return tuple(tokenize(value))
+
+
+def _is_selector(tokens):
+    """Whether tokens are a single series selector - metric or metric{...}"""
+    if len(tokens) == 1:
+        return True
+    return tokens[0][0] == "ident" and tokens[1] == ("punct", "{") and tokens[-1] == ("punct", "}")
+
+
+def _is_wrapped(tokens):
+    """Whether tokens are one parenthesized expression or function call - safe to splice without parentheses"""
+    start = 1 if tokens[:1] and tokens[0][0] == "ident" else 0
+    if tokens[start : start + 1] != (("punct", "("),):
+        return False
+    depth = 0
+    for index in range(start, len(tokens)):
+        depth += {"(": 1, ")": -1}.get(tokens[index][1], 0)
+        if depth == 0:
+            return index == len(tokens) - 1
+    return False
+
+
+def substitute(tokens, env):
+    """Render tokens with the identifiers bound in env replaced by their values"""
+    result = []
+    braces = brackets = 0
+    skip_brace = False
+    for index, token in enumerate(tokens):
+        kind, text = token
+        if text == "{":
+            braces += 1
+            if skip_brace:
+                skip_brace = False
+                continue
+        elif text == "}":
+            braces -= 1
+        elif text == "[":
+            brackets += 1
+        elif text == "]":
+            brackets -= 1
+
+        following = tokens[index + 1] if index + 1 < len(tokens) else None
+        if kind != "ident" or text not in env or (braces and following and following[1] in _MATCHER_OPS):
+            result.append(token)
+            continue
+
+        value = _value_tokens(env[text])
+        if braces:
+            # Matchers spliced into a selector - q{metric_filter}, q{le_filter} with le_filter = {le="+Inf"}
+            if value[:1] == (("punct", "{"),) and value[-1:] == (("punct", "}"),):
+                value = value[1:-1]
+            result.extend(value)
+        elif brackets or len(value) == 1:
+            result.extend(value)
+        elif following == ("punct", "{") and len(value) > 1 and _is_selector(value):
+            # metric{matchers} with metric itself a selector - merge both matcher lists into one selector
+            result.extend(value[:-1] + (("punct", ","),))
+            skip_brace = True
+        elif _is_selector(value) or _is_wrapped(value):
+            result.extend(value)
+        else:
+            result.extend((("punct", "("),) + value + (("punct", ")"),))
+
+    # Drop the comma left before } when spliced matchers were empty
+    cleaned = []
+    for token in result:
+        if token == ("punct", "}") and cleaned and cleaned[-1] == ("punct", ","):
+            cleaned.pop()
+        if token == ("punct", ",") and cleaned and cleaned[-1] == ("punct", "{"):
+            continue
+        cleaned.append(token)
+    return render(cleaned)
+
+
+def cache_key(macro_name, args):
+    """sha256 of a macro call - macro name and expanded argument texts"""
+    return hashlib.sha256("\0".join((macro_name,) + tuple(args)).encode("utf-8")).hexdigest()
+
+
+class MacroExpander:
+    """Expands macro calls into plain MetricsQL, caching every expansion by (macro, args)"""
+
+    def __init__(self, macros):
+        self.macros = macros
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def has_calls(self, text):
+        """Whether text calls any macro"""
+        return any(match.group(1) in self.macros for match in _CALL_RE.finditer(str(text)))
+
+    def expand(self, text, resolve=None, expansions=None):
+        """Text with every macro call replaced by its parenthesized expansion
+
+        resolve maps an argument text to a query (e.g. an indicator name to its query) or returns None to expand the
+        argument itself. Every Expansion made is appended to expansions when given.
+        """
+        text = str(text)
+        parts = []
+        position = 0
+        for match in _CALL_RE.finditer(text):
+            if match.start() < position or match.group(1) not in self.macros:
+                continue
+            call_end = _closing(text, match.end() - 1, "(", ")")
+            args = []
+            for arg in _split_args(text[match.end() : call_end]):
+                resolved = resolve(arg) if resolve else None
+                args.append(self.expand(resolved if resolved is not None else arg, resolve, expansions))
+            expansion = self.expand_call(match.group(1), args)
+            if expansions is not None:
+                expansions.append(expansion)
+            parts += [text[position : match.start()], f"({expansion.query})"]
+            position = call_end + 1
+        if not parts:
+            return text
+        parts.append(text[position:])
+        return "".join(parts)
+
+    def expand_call(self, macro_name, args):
+        """Expansion of one call with already expanded arguments"""
+        key = cache_key(macro_name, args)
+        expansion = self.cache.get(key)
+        if expansion is not None:
+            self.hits += 1
+            return expansion
+        self.misses += 1
+
+        macro = self.macros[macro_name]
+        if len(args) != len(macro.params):
+            raise ValueError(f"macro {macro_name} takes {len(macro.params)} arguments, got {len(args)}")
+        env = dict(zip(macro.params, args))
+        lets = []
+        for name, tokens in macro.lets:
+            env[name] = substitute(tokens, env)
+            lets.append((name, env[name]))
+        expansion = Expansion(macro_name, substitute(macro.result, env), tuple(lets))
+        self.cache[key] = expansion
+        return expansion
+
+
+def shared_subexpressions(expansions, min_count=2):
+    """Lets evaluated at least min_count times across expansions - inlined repeatedly, or repeated across calls
+
+    Returns a list of dicts with the query, its number of evaluations and the (macro, let) it comes from, most
+    evaluated first. Plain selectors and literals are left out, they are as cheap as a reference.
+    """
+    shared = {}
+    for expansion in expansions:
+        for name, value in expansion.lets:
+            if _is_selector(_value_tokens(value)):
+                continue
+            occurrences = expansion.query.count(value)
+            if occurrences == 0:
+                continue
+            entry = shared.setdefault(value, {"query": value, "evaluations": 0, "sources": set()})
+            entry["evaluations"] += occurrences
+            entry["sources"].add(f"{expansion.macro}.{name}")
+
+    results = []
+    for entry in shared.values():
+        if entry["evaluations"] >= min_count:
+            entry["sources"] = sorted(entry["sources"])
+            results.append(entry)
+    return sorted(results, key=lambda entry: (-entry["evaluations"], entry["query"]))
@@ -0,0 +1,359 @@
+"""
+Canonical form of PromQL queries, used to spot indicators evaluating the same query under different names
+
+normalize_query() tokenizes a query and re-emits it with
+
+    - one canonical spacing (whitespace, line breaks and comments do not matter)
+    - label matchers sorted - {job="a", env="b"} == {env="b", job="a"}
+    - by / without / on / ignoring / group_left / group_right label lists sorted and de-duplicated
+    - the grouping clause of aggregations moved after the argument - sum by (a) (x) == sum(x) by (a)
+    - keywords and aggregation operators lower cased
+
+It is not a full PromQL parser - anything it does not recognise (e.g. Levitate macros) is kept verbatim, so two
+queries normalizing to the same string evaluate the same, while some equivalent queries may still differ.
+
+estimate_cost() scores how expensive a query is to evaluate, from the same tokens. Each series selector costs the
+minutes of its range window (at least 1), times the steps of any enclosing subquery, times UNFILTERED_FACTOR if it has
+no label matcher narrowing it down. The sum is scaled by GROUPING_LABEL_FACTOR per label of the widest grouping, by
+HIGH_CARDINALITY_FACTOR per high cardinality grouping label and doubled per level of nested aggregation. The score is
+only meant to rank queries against each other and gate outliers.
+
+Sample usage
+
+    from last9_promql import estimate_cost, normalize_query
+
+    normalize_query('sum by (b,a) (x{j="1", i="2"})')  # 'sum(x{i="2", j="1"}) by (a, b)'
+    estimate_cost("sum(rate(x{}[5m])) by (pod)")["cost"]  # 5 * 4 * 1.25 * 2 = 50.0
+"""
+
+import re
+import math
+
+_TOKEN_RE = re.compile(
+    r"""
+    (?P<space>\s+|\#[^\n]*)
+    | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|`[^`]*`)
+    | (?P<duration>\d+(?:ms|[smhdwy])(?:\d+(?:ms|[smhdwy]))*(?![\w.]))
+    | (?P<number>(?:0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)(?![a-zA-Z_]))
+    | (?P<word>\d+[a-zA-Z_]\w*)
+    | (?P<ident>[a-zA-Z_][\w:]*)
+    | (?P<op>==|!=|>=|<=|=~|!~|[-+*/%^=<>@:])
+    | (?P<punct>[(){}\[\],])
+    | (?P<other>.)
+    """,
+    re.VERBOSE,
+)
+
+AGGREGATIONS = {
+    "sum", "avg", "min", "max", "count", "group", "stddev", "stdvar", "topk", "bottomk", "quantile", "count_values",
+}  # fmt: skip
+GROUPING_KEYWORDS = {"by", "without", "on", "ignoring", "group_left", "group_right"}
+# if / ifnot / default are MetricsQL binary operators, used by Levitate queries and macros
+KEYWORDS = GROUPING_KEYWORDS | {
+    "and", "or", "unless", "bool", "offset", "atan2", "inf", "nan", "if", "ifnot", "default",
+}  # fmt: skip
+_OPEN = {"(": ")", "{": "}", "[": "]"}
+
+UNFILTERED_FACTOR = 4
+GROUPING_LABEL_FACTOR = 0.25
+HIGH_CARDINALITY_FACTOR = 2
+DEFAULT_SUBQUERY_STEP_SECONDS = 60
+# Labels with many values per metric - grouping by them keeps (or multiplies) the series count
+HIGH_CARDINALITY_LABELS = {
+    "pod", "container", "container_id", "id", "le", "vmrange", "path", "url", "uri", "user_id", "request_id",
+    "trace_id", "span_id", "ip", "client_ip", "topic", "partition", "consumergroup",
+}  # fmt: skip
+# Matchers which do not narrow down a selector
+_MATCH_ALL_VALUES = {'".*"', "'.*'", '""', "''"}
+_DURATION_PART_RE = re.compile(r"(\d+)(ms|[smhdwy])")
+_DURATION_SECONDS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800, "y": 31536000}
+
+
+def tokenize(query):
+    """List of (kind, text) tokens of a query, whitespace and comments dropped"""
+    tokens = []
+    for match in _TOKEN_RE.finditer(query):
+        kind = match.lastgroup
+        if kind != "space":
+            tokens.append((kind, match.group()))
+    return tokens
+
+
+def _matching(tokens, start):
+    """Index of the bracket closing the one at tokens[start], len(tokens) if unbalanced"""
+    depth = 0
+    for index in range(start, len(tokens)):
+        text = tokens[index][1]
+        if text in _OPEN:
+            depth += 1
+        elif text in _OPEN.values():
+            depth -= 1
+            if depth == 0:
+                return index
+    return len(tokens)
+
+
+def _split_items(tokens):
+    """Split tokens on top level commas, dropping empty items (trailing commas)"""
+    items, current, depth = [], [], 0
+    for token in tokens:
+        if token[1] in _OPEN:
+            depth += 1
+        elif token[1] in _OPEN.values():
+            depth -= 1
+        if token[1] == "," and depth == 0:
+            if current:
+                items.append(current)
+            current = []
+        else:
+            current.append(token)
+    if current:
+        items.append(current)
+    return items
+
+
+def _join_sorted(items, unique=False):
+    """Tokens of items sorted by their text, comma separated"""
+    keyed = {}
+    for item in items:
+        keyed.setdefault(render(item), []).append(item)
+    tokens = []
+    for key in sorted(keyed):
+        for item in keyed[key][:1] if unique else keyed[key]:
+            if tokens:
+                tokens.append(("punct", ","))
+            tokens.extend(item)
+    return tokens
+
+
+def canonicalize(tokens):
+    """Canonical token list - see the module docstring"""
+    result = []
+    index = 0
+    while index < len(tokens):
+        kind, text = tokens[index]
+
+        if kind == "punct" and text == "{":
+            end = _matching(tokens, index)
+            matchers = _split_items(tokens[index + 1 : end])
+            result += [("punct", "{")] + _join_sorted(matchers) + [("punct", "}")]
+            index = end + 1
+            continue
+
+        if kind == "ident" and text.lower() in GROUPING_KEYWORDS and tokens[index + 1 : index + 2] == [("punct", "(")]:
+            end = _matching(tokens, index + 1)
+            labels = _split_items(tokens[index + 2 : end])
+            result += [("ident", text.lower()), ("punct", "(")] + _join_sorted(labels, unique=True) + [("punct", ")")]
+            index = end + 1
+            continue
+
+        if kind == "ident" and text.lower() in AGGREGATIONS:
+            name = ("ident", text.lower())
+            following = tokens[index + 1 : index + 3]
+            if (
+                following
+                and following[0][0] == "ident"
+                and following[0][1].lower() in ("by", "without")
+                and following[1:] == [("punct", "(")]
+            ):
+                # sum by (a) (x) - move the grouping after the argument
+                grouping_end = _matching(tokens, index + 2)
+                if tokens[grouping_end + 1 : grouping_end + 2] == [("punct", "(")]:
+                    argument_end = _matching(tokens, grouping_end + 1)
+                    reordered = (
+                        [name]
+                        + tokens[grouping_end + 1 : argument_end + 1]
+                        + tokens[index + 1 : grouping_end + 1]
+                        + tokens[argument_end + 1 :]
+                    )
+                    return result + canonicalize(reordered)
+            result.append(name)
+            index += 1
+            continue
+
+        if kind == "ident" and text.lower() in KEYWORDS:
+            result.append((kind, text.lower()))
+        else:
+            result.append((kind, text))
+        index += 1
+    return result
+
+
+def render(tokens):
+    """Tokens back to query text with canonical spacing"""
+    parts = []
+    previous = None
+    depth_braces = 0
+    for kind, text in tokens:
+        if previous is not None:
+            parts.append(_separator(previous, (kind, text), depth_braces))
+        parts.append(text)
+        if text == "{":
+            depth_braces += 1
+        elif text == "}":
+            depth_braces -= 1
+        previous = (kind, text) if not _is_unary(previous, (kind, text)) else ("unary", text)
+    return "".join(parts)
+
+
+def _is_unary(previous, token):
+    """Whether a +/- token is a sign rather than a binary operator"""
+    return token[1] in ("+", "-") and (previous is None or previous[0] in ("op", "unary") or previous[1] in "([{,")
+
+
+def _separator(previous, token, depth_braces):
+    """Whitespace between two adjacent tokens"""
+    prev_kind, prev_text = previous
+    kind, text = token
+    if prev_kind == "unary" or text in (")", "]", "}", ",") or prev_text in ("(", "[", "{"):
+        return ""
+    if prev_text == ",":
+        return " "
+    if depth_braces > 0 and (kind == "op" or prev_kind == "op"):
+        # label matchers - job="a"
+        return ""
+    if text == ":" or prev_text == ":":
+        # subquery step - [5m:1m]
+        return ""
+    if text == "[" or (text == "{" and prev_kind == "ident"):
+        return ""
+    if text == "(" and prev_kind == "ident" and prev_text not in KEYWORDS:
+        return ""
+    return " "
+
+
+def normalize_query(query):
+    """Canonical text of a PromQL query"""
+    return render(canonicalize(tokenize(str(query))))
+
+
+def duration_seconds(text):
+    """Seconds of a PromQL duration such as 1h30m"""
+    return sum(int(count) * _DURATION_SECONDS[unit] for count, unit in _DURATION_PART_RE.findall(text))
+
+
+def _is_filtering_matcher(tokens):
+    """Whether one label matcher narrows down the series of a selector"""
+    if len(tokens) < 3 or tokens[0][1] == "__name__":
+        return False
+    operator, value = tokens[-2][1], tokens[-1][1]
+    return not (operator in ("=~", "!=", "!~") and value in _MATCH_ALL_VALUES)
+
+
+def _selector_ranges(tokens):
+    """(start, end) token spans of the series selectors of a query"""
+    spans = []
+    index = 0
+    while index < len(tokens):
+        kind, text = tokens[index]
+        following = tokens[index + 1][1] if index + 1 < len(tokens) else None
+        if kind == "ident" and text.lower() not in KEYWORDS | AGGREGATIONS and following != "(":
+            if index > 0 and tokens[index - 1][1] in ("{", ",") or following in ("=", "=~", "!=", "!~"):
+                # Label name of a matcher or of a grouping list
+                index += 1
+                continue
+            end = _matching(tokens, index + 1) if following == "{" else index
+            spans.append((index, end))
+            index = end + 1
+            continue
+        if kind == "punct" and text == "{":
+            # Selector without a metric name - {__name__=~"..."}
+            end = _matching(tokens, index)
+            spans.append((index, end))
+            index = end + 1
+            continue
+        if kind == "ident" and text.lower() in GROUPING_KEYWORDS and following == "(":
+            index = _matching(tokens, index + 1) + 1
+            continue
+        index += 1
+    return spans
+
+
+def estimate_cost(query):
+    """Estimated evaluation cost of a query and what it is made of - see the module docstring"""
+    tokens = tokenize(str(query))
+
+    # Subqueries - (...)[range:step] multiplies the cost of everything inside by range / step
+    subqueries = []
+    for index, (_, text) in enumerate(tokens):
+        if text == "[" and index > 0 and tokens[index - 1][1] == ")":
+            end = _matching(tokens, index)
+            window = [token[1] for token in tokens[index + 1 : end]]
+            if ":" in window:
+                step_index = window.index(":")
+                range_seconds = duration_seconds("".join(window[:step_index]))
+                step_seconds = duration_seconds("".join(window[step_index + 1 :])) or DEFAULT_SUBQUERY_STEP_SECONDS
+                depth, start = 0, index - 1
+                while start >= 0:
+                    depth += {")": 1, "(": -1}.get(tokens[start][1], 0)
+                    if depth == 0:
+                        break
+                    start -= 1
+                subqueries.append((start, index - 1, max(1, math.ceil(range_seconds / step_seconds))))
+
+    selectors = []
+    for start, end in _selector_ranges(tokens):
+        name = tokens[start][1] if tokens[start][0] == "ident" else None
+        matchers = _split_items(tokens[start + (2 if name else 1) : end])
+        if name is None:
+            name = next((item[-1][1].strip("\"'") for item in matchers if item[0][1] == "__name__"), None)
+        window_seconds = 0
+        if tokens[end + 1 : end + 2] == [("punct", "[")]:
+            window_end = _matching(tokens, end + 1)
+            window_seconds = duration_seconds("".join(token[1] for token in tokens[end + 2 : window_end]))
+        steps = math.prod(factor for sub_start, sub_end, factor in subqueries if sub_start < start < sub_end)
+        unfiltered = not any(_is_filtering_matcher(matcher) for matcher in matchers)
+        cost = max(1, window_seconds / 60) * steps * (UNFILTERED_FACTOR if unfiltered else 1)
+        selectors.append(
+            {"metric": name, "window_seconds": window_seconds, "steps": steps, "unfiltered": unfiltered, "cost": cost}
+        )
+
+    # Labels of all by () clauses - without () keeps every other label so it is only flagged
+    grouping_labels, without = [], False
+    aggregation_depth, max_aggregation_depth = 0, 0
+    stack = []
+    pending_aggregation = False
+    index = 0
+    while index < len(tokens):
+        kind, text = tokens[index]
+        lowered = text.lower() if kind == "ident" else text
+        if kind == "ident" and lowered in ("by", "without") and tokens[index + 1 : index + 2] == [("punct", "(")]:
+            end = _matching(tokens, index + 1)
+            if lowered == "by":
+                labels = [render(item) for item in _split_items(tokens[index + 2 : end])]
+                grouping_labels = sorted(set(grouping_labels) | set(labels))
+            else:
+                without = True
+            index = end + 1
+            continue
+        if kind == "ident" and lowered in AGGREGATIONS:
+            pending_aggregation = True
+        elif text in _OPEN:
+            is_aggregation = pending_aggregation and text == "("
+            stack.append(is_aggregation)
+            pending_aggregation = False
+            if is_aggregation:
+                aggregation_depth += 1
+                max_aggregation_depth = max(max_aggregation_depth, aggregation_depth)
+        elif text in _OPEN.values() and stack:
+            if stack.pop():
+                aggregation_depth -= 1
+        index += 1
+
+    high_cardinality_labels = sorted(label for label in grouping_labels if label in HIGH_CARDINALITY_LABELS)
+    nesting = max(0, max_aggregation_depth - 1)
+    cost = (
+        sum(selector["cost"] for selector in selectors)
+        * (1 + GROUPING_LABEL_FACTOR * len(grouping_labels))
+        * HIGH_CARDINALITY_FACTOR ** len(high_cardinality_labels)
+        * 2**nesting
+    )
+    return {
+        "cost": round(cost, 2),
+        "selectors": selectors,
+        "grouping_labels": grouping_labels,
+        "without": without,
+        "high_cardinality_labels": high_cardinality_labels,
+        "nested_aggregations": nesting,
+        "max_window_seconds": max([selector["window_seconds"] for selector in selectors] or [0]),
+    }
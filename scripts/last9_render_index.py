@@ -0,0 +1,184 @@
+"""
+Dependency index of the rendered workspace files - which template, vars file and section produced each of them
+
+patch_template.py records every file it renders with the hashes of its inputs:
+
+    {
+        "version": 1,
+        "outputs": {
+            "workspace/alerts/vmagent-eu/health.yaml": {
+                "tmpl_file": "templates/alerts/vmagent/health.yaml",
+                "tmpl_sha256": "...",
+                "tmpl_vars_file": "workspace/config/vmagent-eu.toml",
+                "tmpl_vars_file_section": "alerts",
+                "vars_sha256": "...",       # of the section only - edits to other sections do not count
+                "vars": {},                 # manifest vars overriding the section
+                "env_vars": [],             # names of the tmpl_var* environment variables overriding the section
+                "env_vars_sha256": null,    # of their values - recorded as a hash, the index is committed
+                "output_sha256": "..."
+            }
+        }
+    }
+
+The index lives next to the rendered files (DEFAULT_INDEX_FILE, or $LAST9_RENDER_INDEX) and is committed with them,
+so a CI checkout can tell which outputs a change to a template or vars file affects without rendering anything.
+Paths are relative to the repo root, where the scripts run.
+
+stale_outputs() compares the recorded hashes with the current inputs. Given the paths changed in a git range it only
+looks at the outputs depending on them, hashing each changed template and parsing each changed vars file once.
+env_vars_match() tells whether the tmpl_var* overrides of the environment are the ones an output was rendered with -
+re-rendering it under others would change it.
+
+Sample usage
+
+    from last9_render_index import load_index, record_renders, render_record, stale_outputs
+
+    record_renders([render_record(tmpl_file, tmpl_vars_file, "alerts", section_ds, output_file)])
+    for output_file, reason in stale_outputs(load_index(), changed_paths={"templates/alerts/vmagent/health.yaml"}):
+        ...
+"""
+
+import os
+import json
+import hashlib
+import logging
+
+import toml
+
+from last9_cache import cache_key, cache_path, locked_json_cache
+
+DEFAULT_INDEX_FILE = os.environ.get("LAST9_RENDER_INDEX", os.path.join("workspace", ".last9-render-index.json"))
+INDEX_VERSION = 1
+
+
+def norm_path(path):
+    """Path as recorded in the index - normalized and relative to the repo root"""
+    return os.path.normpath(os.path.relpath(path)) if os.path.isabs(path) else os.path.normpath(path)
+
+
+def file_sha256(path):
+    """sha256 of a file, None if it does not exist"""
+    try:
+        with open(path, "rb") as input_fd:
+            return hashlib.sha256(input_fd.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def vars_sha256(section_ds):
+    """sha256 of the canonical JSON of a vars file section"""
+    canonical = json.dumps(section_ds, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def render_record(
+    tmpl_file, tmpl_vars_file, tmpl_vars_file_section, section_ds, output_file, extra_vars=None, env_vars=None
+):
+    """(output path, index entry) of a file rendered from tmpl_file and the section_ds section of tmpl_vars_file
+
+    env_vars are the tmpl_var* environment variables the render used.
+    """
+    return norm_path(output_file), {
+        "tmpl_file": norm_path(tmpl_file),
+        "tmpl_sha256": file_sha256(tmpl_file),
+        "tmpl_vars_file": norm_path(tmpl_vars_file),
+        "tmpl_vars_file_section": tmpl_vars_file_section,
+        "vars_sha256": vars_sha256(section_ds),
+        "vars": dict(extra_vars or {}),
+        "env_vars": sorted(env_vars or {}),
+        "env_vars_sha256": vars_sha256(env_vars) if env_vars else None,
+        "output_sha256": file_sha256(output_file),
+    }
+
+
+def env_vars_match(entry, env_vars):
+    """Whether the tmpl_var* environment variables env_vars are the ones the output of entry was rendered with"""
+    return entry.get("env_vars_sha256") == (vars_sha256(env_vars) if env_vars else None)
+
+
+def _lock_path(index_file):
+    # Kept out of the workspace - the index is committed, its lock must not show up in git status
+    return cache_path(f"render-index-{cache_key(os.path.abspath(index_file))[:16]}") + ".lock"
+
+
+def indexed(output_file, index_file=None):
+    """Whether output_file is covered by the index - the index covers the files below its directory"""
+    index_dir = os.path.dirname(os.path.abspath(index_file or DEFAULT_INDEX_FILE))
+    return os.path.abspath(output_file).startswith(index_dir + os.sep)
+
+
+def record_renders(records, index_file=None):
+    """Add (output path, entry) records to the index, replacing earlier entries of the same outputs
+
+    Records of outputs outside the index directory are ignored.
+    """
+    index_file = index_file or DEFAULT_INDEX_FILE
+    records = [record for record in records if indexed(record[0], index_file)]
+    if not records:
+        return
+    os.makedirs(os.path.dirname(index_file) or ".", exist_ok=True)
+    with locked_json_cache(index_file, indent=1, lock_path=_lock_path(index_file)) as index_ds:
+        if index_ds.get("version") != INDEX_VERSION:
+            index_ds.clear()
+            index_ds["version"] = INDEX_VERSION
+        outputs = index_ds.setdefault("outputs", {})
+        for output_file, entry in records:
+            outputs[output_file] = entry
+
+
+def load_index(index_file=None):
+    """{output path: entry} of the index - empty if there is none"""
+    index_file = index_file or DEFAULT_INDEX_FILE
+    try:
+        with open(index_file, "r", encoding="utf-8") as index_fd:
+            index_ds = json.load(index_fd)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as ex:
+        logging.warning("Ignoring unreadable render index %s - %s", index_file, ex)
+        return {}
+    if not isinstance(index_ds, dict) or index_ds.get("version") != INDEX_VERSION:
+        logging.warning("Ignoring render index %s of another version", index_file)
+        return {}
+    return index_ds.get("outputs") or {}
+
+
+def stale_outputs(outputs, changed_paths=None):
+    """(output path, reason) of the outputs whose template or vars section differs from the recorded one
+
+    With changed_paths only outputs depending on one of them are checked, otherwise all of them.
+    """
+    changed_paths = {norm_path(path) for path in changed_paths} if changed_paths is not None else None
+    tmpl_hashes = {}
+    vars_files = {}
+    stale = []
+    for output_file, entry in sorted(outputs.items()):
+        tmpl_file = entry.get("tmpl_file")
+        tmpl_vars_file = entry.get("tmpl_vars_file")
+        if changed_paths is not None and tmpl_file not in changed_paths and tmpl_vars_file not in changed_paths:
+            continue
+
+        if tmpl_file not in tmpl_hashes:
+            tmpl_hashes[tmpl_file] = file_sha256(tmpl_file)
+        if tmpl_hashes[tmpl_file] is None:
+            stale.append((output_file, f"template {tmpl_file} no longer exists"))
+            continue
+        if tmpl_hashes[tmpl_file] != entry.get("tmpl_sha256"):
+            stale.append((output_file, f"template {tmpl_file} changed"))
+            continue
+
+        if tmpl_vars_file not in vars_files:
+            try:
+                vars_files[tmpl_vars_file] = toml.load(tmpl_vars_file)
+            except FileNotFoundError:
+                vars_files[tmpl_vars_file] = None
+            except Exception as ex:  # pylint: disable=broad-except
+                logging.warning("Failed to parse vars file %s - %s", tmpl_vars_file, ex)
+                vars_files[tmpl_vars_file] = None
+        vars_ds = vars_files[tmpl_vars_file]
+        section = entry.get("tmpl_vars_file_section")
+        if vars_ds is None or section not in vars_ds:
+            stale.append((output_file, f"section {section} of {tmpl_vars_file} no longer exists"))
+        elif vars_sha256(vars_ds[section]) != entry.get("vars_sha256"):
+            stale.append((output_file, f"section {section} of {tmpl_vars_file} changed"))
+    return stale
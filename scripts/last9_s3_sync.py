@@ -0,0 +1,147 @@
+"""
+Batched S3 sync of IaC file backups and state lock files
+
+Replaces the per file `aws s3 cp` / `aws s3 ls` calls made around every l9iac run. The backup prefix is listed once,
+all needed .lock / .lock.bak / .iac-manifest.json files are downloaded concurrently before the run, and backups plus
+changed locks and manifests are uploaded in one batch at the end - all through one boto3 client with a connection
+pool sized to the worker count.
+
+Set LAST9_S3_ENDPOINT_URL (e.g. http://127.0.0.1:5000 for a local moto server) to run against an S3 stand-in, or pass
+an existing client to S3LockSync.
+
+Sample usage
+
+    from last9_s3_sync import S3LockSync
+
+    sync = S3LockSync("s3://bucket/prefix")
+    downloaded = sync.download_locks(["workspace/alerts/a.yaml"])
+    ...
+    errors = sync.upload_files(["workspace/alerts/a.yaml"] + sync.changed_locks("workspace/alerts/a.yaml"))
+"""
+
+import os
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import boto3
+from botocore.config import Config
+
+DEFAULT_MAX_WORKERS = 16
+
+
+def lock_file_name_for(input_file):
+    """Lock file name used for an iac file - same as `cut -f1 -d'.'` on the file name"""
+    return os.path.basename(input_file).split(".")[0] + ".lock"
+
+
+def manifest_file_name_for(input_file):
+    """Name of the manifest holding the hashes of an iac file and its lock at the last successful apply"""
+    return os.path.basename(input_file).split(".")[0] + ".iac-manifest.json"
+
+
+def state_paths_for(input_file):
+    """Local paths of the lock, lock backup and apply manifest kept next to an iac file"""
+    input_file_dir = os.path.dirname(input_file)
+    local_lock_file = os.path.join(input_file_dir, lock_file_name_for(input_file))
+    return local_lock_file, f"{local_lock_file}.bak", os.path.join(input_file_dir, manifest_file_name_for(input_file))
+
+
+def file_sha256(path):
+    """sha256 of a local file, None if it does not exist"""
+    try:
+        with open(path, "rb") as input_fd:
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: input_fd.read(1 << 20), b""):
+                digest.update(chunk)
+            return digest.hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+class S3LockSync:
+    """Sync of backups and lock files under one s3://bucket/prefix"""
+
+    def __init__(self, backup_s3_bucket, client=None, max_workers=DEFAULT_MAX_WORKERS):
+        parsed = urlparse(backup_s3_bucket if "://" in backup_s3_bucket else f"s3://{backup_s3_bucket}")
+        self.bucket = parsed.netloc
+        self.prefix = parsed.path.strip("/")
+        self.max_workers = max_workers
+        self.client = client or boto3.client(
+            "s3",
+            endpoint_url=os.environ.get("LAST9_S3_ENDPOINT_URL") or None,
+            config=Config(max_pool_connections=max_workers, retries={"max_attempts": 5, "mode": "standard"}),
+        )
+        # sha256 of each lock file as downloaded - used to only upload locks that changed
+        self.downloaded_hashes = {}
+
+    def key_for(self, local_path):
+        """Remote key mirroring a local path relative to the repo root"""
+        local_path = os.path.normpath(local_path)
+        return f"{self.prefix}/{local_path}" if self.prefix else local_path
+
+    def list_keys(self, input_files):
+        """List all keys below the deepest prefix shared by input_files in one paginated call"""
+        dirs = [os.path.dirname(os.path.normpath(input_file)) for input_file in input_files]
+        common_dir = os.path.commonpath(dirs) if dirs and all(dirs) else ""
+        list_prefix = self.key_for(common_dir) + "/" if common_dir else (f"{self.prefix}/" if self.prefix else "")
+
+        keys = set()
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=list_prefix):
+            keys.update(item["Key"] for item in page.get("Contents", []))
+        logging.debug("Listed %d keys under s3://%s/%s", len(keys), self.bucket, list_prefix)
+        return keys
+
+    def _map(self, func, items):
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="s3") as executor:
+            return list(executor.map(func, items))
+
+    def download_locks(self, input_files, remote_keys=None):
+        """Download the .lock / .lock.bak / .iac-manifest.json of every input file that has one remotely
+
+        Returns the list of local paths downloaded. Raises botocore/boto3 errors on failure.
+        """
+        if remote_keys is None:
+            remote_keys = self.list_keys(input_files)
+
+        downloads = []
+        for input_file in input_files:
+            for local_path in state_paths_for(input_file):
+                if self.key_for(local_path) in remote_keys:
+                    downloads.append(local_path)
+
+        def _download(local_path):
+            self.client.download_file(self.bucket, self.key_for(local_path), local_path)
+            self.downloaded_hashes[local_path] = file_sha256(local_path)
+            logging.debug("Downloaded s3://%s/%s to %s", self.bucket, self.key_for(local_path), local_path)
+
+        self._map(_download, downloads)
+        return downloads
+
+    def changed_locks(self, input_file):
+        """Local lock files of input_file which are new or differ from what was downloaded"""
+        changed = []
+        for local_path in state_paths_for(input_file)[:2]:
+            local_hash = file_sha256(local_path)
+            if local_hash is not None and local_hash != self.downloaded_hashes.get(local_path):
+                changed.append(local_path)
+        return changed
+
+    def upload_files(self, local_paths):
+        """Upload local files to their mirrored keys concurrently
+
+        Returns a dict of local path to error string for failed uploads.
+        """
+        errors = {}
+
+        def _upload(local_path):
+            try:
+                self.client.upload_file(local_path, self.bucket, self.key_for(local_path))
+                logging.debug("Uploaded %s to s3://%s/%s", local_path, self.bucket, self.key_for(local_path))
+            except Exception as ex:  # pylint: disable=broad-except
+                errors[local_path] = str(ex)
+
+        self._map(_upload, local_paths)
+        return errors
@@ -0,0 +1,125 @@
+"""
+YAML helpers shared by the scripts
+
+Uses the LibYAML backed CDumper / CSafeLoader when PyYAML was built with them, falling back to the pure Python
+implementations otherwise. Files are written atomically (temp file + rename) so an interrupted run never leaves a
+half-written file behind.
+
+Sample usage
+
+    from last9_yaml import dump_yaml, load_yaml, atomic_write_text
+
+    atomic_write_text("alert.yaml", dump_yaml({"entities": [entity]}))
+"""
+
+import os
+import tempfile
+
+import yaml
+
+try:
+    from yaml import CDumper as Dumper, CSafeLoader as SafeLoader
+
+    HAS_LIBYAML = True
+except ImportError:
+    from yaml import Dumper, SafeLoader
+
+    HAS_LIBYAML = False
+
+# CDumper and the pure Python Dumper break long scalars at different points - lines this long are not wrapped at all,
+# so the output is the same with or without LibYAML
+YAML_WIDTH = 4096
+
+
+def dump_yaml(data, stream=None):
+    """Serialize data in the block style used by the alert files"""
+    return yaml.dump(
+        data, stream, Dumper=Dumper, default_flow_style=False, sort_keys=False, allow_unicode=True, width=YAML_WIDTH
+    )
+
+
+def load_yaml(stream):
+    """Safely parse a YAML document"""
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def load_yaml_file(path):
+    """Safely parse a YAML file"""
+    with open(path, "r", encoding="utf-8") as input_fd:
+        return load_yaml(input_fd)
+
+
+def atomic_temp_file(path):
+    """(fd, temp path) of a new temp file next to path - publish it with atomic_replace()"""
+    path = os.fspath(path)
+    return tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+
+
+def atomic_replace(tmp_path, path):
+    """Atomically move a temp file from atomic_temp_file() to path"""
+    # mkstemp creates files 0600 - keep the permissions a plain open() would have given
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_path, 0o666 & ~umask)
+    os.replace(tmp_path, path)
+
+
+def atomic_write_text(path, text):
+    """Write text to path via a temp file in the same directory and an atomic rename"""
+    fd, tmp_path = atomic_temp_file(path)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp_fd:
+            tmp_fd.write(text)
+        atomic_replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class EntitiesWriter:
+    """Stream entities into one `entities:` document - the file appears atomically on close()
+
+    Each entity is serialized as it is written, so memory holds one entity at a time whatever the size of the file.
+    The output is the same as dump_yaml({"entities": [...]}) of all the entities.
+    """
+
+    def __init__(self, path):
+        self.path = os.fspath(path)
+        self.count = 0
+        fd, self._tmp_path = atomic_temp_file(self.path)
+        self._fd = os.fdopen(fd, "w", encoding="utf-8")
+
+    def write(self, entity):
+        """Append an entity to the document"""
+        if self.count == 0:
+            self._fd.write("entities:\n")
+        dump_yaml([entity], self._fd)
+        self.count += 1
+
+    def close(self):
+        """Finish the document and move it into place"""
+        if self.count == 0:
+            self._fd.write("entities: []\n")
+        self._fd.close()
+        atomic_replace(self._tmp_path, self.path)
+
+    def abort(self):
+        """Drop the document - path is left untouched"""
+        self._fd.close()
+        os.unlink(self._tmp_path)
+
+
+def write_yaml_files(items):
+    """Serialize and atomically write a batch of (path, data) items
+
+    Returns a list of (path, error) tuples, error being None on success. Kept at module level so it can run in a
+    process pool.
+    """
+    results = []
+    for path, data in items:
+        try:
+            atomic_write_text(path, dump_yaml(data))
+            results.append((path, None))
+        except Exception as ex:  # pylint: disable=broad-except
+            results.append((path, str(ex)))
+    return results
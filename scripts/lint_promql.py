@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+"""
+Offline cost linter for indicator queries - meant to gate CI before `l9iac plan`
+
+Every `query` found in the given YAML files (alert catalog, rendered workspace files or raw templates) is scored with
+last9_promql.estimate_cost and checked for
+
+    cost              estimated cost above --max-cost
+    window            a range window / subquery range longer than --max-window
+    grouping          more than --max-grouping-labels labels in by () clauses
+    high-cardinality  grouping by a high cardinality label (pod, le, vmrange, ...) or aggregating without ()
+    nesting           more than --max-nested-aggregations aggregations nested in each other - count(sum by (...))
+    unfiltered        a series selector without any label matcher narrowing it down
+
+All findings are reported, the run fails (exit status 1) only on the checks listed in --fail-on. Thresholds can also
+be set through LAST9_LINT_MAX_COST, LAST9_LINT_MAX_WINDOW, LAST9_LINT_MAX_GROUPING_LABELS,
+LAST9_LINT_MAX_NESTED_AGGREGATIONS and LAST9_LINT_FAIL_ON.
+
+Sample usage
+
+python scripts/lint_promql.py
+python scripts/lint_promql.py workspace templates/alerts --fail-on cost,window,unfiltered
+python scripts/lint_promql.py last9-alert-catalog --max-cost 20 --format json
+"""
+
+import os
+import sys
+import json
+import argparse
+import logging
+
+from last9_catalog import DEFAULT_CATALOG_DIR
+from last9_promql import duration_seconds, estimate_cost
+from last9_yaml import load_yaml_file
+
+CHECKS = ("cost", "window", "grouping", "high-cardinality", "nesting", "unfiltered")
+YAML_SUFFIXES = (".yaml", ".yml")
+
+
+def load_args():
+    """Parse cli"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="*", help=f"YAML files or directories to lint (default: {DEFAULT_CATALOG_DIR})")
+    parser.add_argument(
+        "--max-cost", type=float, help="Maximum estimated cost", default=os.environ.get("LAST9_LINT_MAX_COST", 100)
+    )
+    parser.add_argument(
+        "--max-window",
+        help="Longest range window / subquery range, e.g. 1h",
+        default=os.environ.get("LAST9_LINT_MAX_WINDOW", "1h"),
+    )
+    parser.add_argument(
+        "--max-grouping-labels",
+        type=int,
+        help="Maximum number of grouping labels",
+        default=os.environ.get("LAST9_LINT_MAX_GROUPING_LABELS", 4),
+    )
+    parser.add_argument(
+        "--max-nested-aggregations",
+        type=int,
+        help="Maximum aggregations nested in another one",
+        default=os.environ.get("LAST9_LINT_MAX_NESTED_AGGREGATIONS", 1),
+    )
+    parser.add_argument(
+        "--fail-on",
+        help=f"Comma separated checks failing the run - any of {','.join(CHECKS)}",
+        default=os.environ.get("LAST9_LINT_FAIL_ON", "cost,window"),
+    )
+    parser.add_argument("--format", help="Report format", choices=["table", "json"], default="table")
+    parser.add_argument("--log-level", help="Log level", default=os.environ.get("LOG_LEVEL", "INFO"))
+    return vars(parser.parse_args(sys.argv[1:]))
+
+
+def validate_args(args):
+    """Validate input args"""
+    args["paths"] = args["paths"] or [DEFAULT_CATALOG_DIR]
+    for path in args["paths"]:
+        if not os.path.exists(path):
+            logging.error("path=%s does not exist", path)
+            return False
+
+    args["fail_on"] = [check.strip() for check in args["fail_on"].split(",") if check.strip()]
+    unknown = sorted(set(args["fail_on"]) - set(CHECKS))
+    if unknown:
+        logging.error("Unknown --fail-on checks %s - valid checks are %s", unknown, ",".join(CHECKS))
+        return False
+
+    args["max_window_seconds"] = duration_seconds(args["max_window"])
+    if args["max_window_seconds"] <= 0:
+        logging.error("max_window=%s is not a valid duration", args["max_window"])
+        return False
+    return True
+
+
+def get_yaml_files(paths):
+    """YAML files of paths, directories being searched recursively"""
+    yaml_files = []
+    for path in paths:
+        if os.path.isfile(path):
+            yaml_files.append(path)
+            continue
+        for root, _, file_names in os.walk(path):
+            yaml_files.extend(
+                os.path.join(root, file_name) for file_name in file_names if file_name.endswith(YAML_SUFFIXES)
+            )
+    return sorted(yaml_files)
+
+
+def find_queries(data):
+    """(name, query) of every mapping holding a string `query`, at any depth"""
+    if isinstance(data, dict):
+        if isinstance(data.get("query"), str):
+            yield data.get("name"), data["query"]
+        for value in data.values():
+            yield from find_queries(value)
+    elif isinstance(data, list):
+        for value in data:
+            yield from find_queries(value)
+
+
+def lint_query(args, query):
+    """Cost estimate of a query and its findings as (check, message) tuples"""
+    estimate = estimate_cost(query)
+    findings = []
+    if estimate["cost"] > args["max_cost"]:
+        findings.append(("cost", f"estimated cost {estimate['cost']:g} > {args['max_cost']:g}"))
+    if estimate["max_window_seconds"] > args["max_window_seconds"]:
+        findings.append(("window", f"range window {estimate['max_window_seconds']:g}s > {args['max_window']}"))
+    if len(estimate["grouping_labels"]) > args["max_grouping_labels"]:
+        findings.append(
+            ("grouping", f"{len(estimate['grouping_labels'])} grouping labels > {args['max_grouping_labels']}")
+        )
+    if estimate["high_cardinality_labels"]:
+        findings.append(
+            ("high-cardinality", f"grouped by high cardinality labels {','.join(estimate['high_cardinality_labels'])}")
+        )
+    if estimate["without"]:
+        findings.append(("high-cardinality", "aggregates without () - keeps every other label"))
+    if estimate["nested_aggregations"] > args["max_nested_aggregations"]:
+        findings.append(
+            (
+                "nesting",
+                f"{estimate['nested_aggregations']} nested aggregations > {args['max_nested_aggregations']}",
+            )
+        )
+    unfiltered = sorted({str(selector["metric"]) for selector in estimate["selectors"] if selector["unfiltered"]})
+    if unfiltered:
+        findings.append(("unfiltered", f"no label matchers on {','.join(unfiltered)}"))
+    return estimate, findings
+
+
+def lint_files(args, yaml_files):
+    """Lint results of every query of yaml_files, and the files which failed to parse"""
+    results, failed = [], []
+    for yaml_file in yaml_files:
+        try:
+            data = load_yaml_file(yaml_file)
+        except Exception as ex:  # pylint: disable=broad-except
+            logging.warning("Skipping %s - failed to parse - %s", yaml_file, str(ex).replace("\n", " "))
+            failed.append(yaml_file)
+            continue
+        for name, query in find_queries(data):
+            estimate, findings = lint_query(args, query)
+            results.append(
+                {
+                    "file": yaml_file,
+                    "name": name,
+                    "query": query,
+                    "cost": estimate["cost"],
+                    "findings": findings,
+                    "failed": any(check in args["fail_on"] for check, _ in findings),
+                }
+            )
+    return results, failed
+
+
+def print_report(args, results):
+    """Print queries with findings, failing ones marked FAIL"""
+    if args["format"] == "json":
+        print(json.dumps(results, indent=2))
+        return
+
+    for result in sorted(results, key=lambda result: -result["cost"]):
+        if not result["findings"]:
+            continue
+        print(f"{'FAIL' if result['failed'] else 'WARN'}  {result['file']}  {result['name']}  cost={result['cost']:g}")
+        for check, message in result["findings"]:
+            print(f"        {check:16} {message}")
+
+
+def setup_logging(log_level):
+    """Setup logging"""
+    log_level = getattr(logging, log_level.upper())
+    logging.basicConfig(
+        level=log_level, format="%(asctime)s.%(msecs)03d %(levelname)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    return True
+
+
+def main():
+    """Main function"""
+    args = load_args()
+
+    if not setup_logging(args["log_level"]):
+        return 1
+
+    if not validate_args(args):
+        return 1
+
+    results, unparsed_files = lint_files(args, get_yaml_files(args["paths"]))
+    print_report(args, results)
+
+    failed = sum(1 for result in results if result["failed"])
+    warned = sum(1 for result in results if result["findings"] and not result["failed"])
+    logging.info(
+        "Linted %d queries - %d failed (%s), %d with warnings, %d files skipped",
+        len(results),
+        failed,
+        ",".join(args["fail_on"]) or "no checks",
+        warned,
+        len(unparsed_files),
+    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    sys.exit(exit_status)
@@ -4,6 +4,26 @@
 Sample usage
 
 python scripts/patch_template.py --tmpl-file templates/alerts/vmagent/health.yaml --tmpl-vars-file templates/config/vmagent.toml
+
+With --output-file the template is streamed chunk by chunk straight into the file, which keeps memory flat for large
+Grafana dashboards. Missing vars are reported with their line and column and leave any existing output file untouched.
+
+Batch mode renders every entry of a TOML manifest in one process, parsing each vars file and compiling each template
+only once, and writes the outputs directly
+
+python scripts/patch_template.py --manifest render.toml --processes 4
+
+with render.toml holding one [[render]] table per output
+
+[[render]]
+tmpl_file = "templates/alerts/vmagent/health.yaml"
+tmpl_vars_file = "workspace/config/vmagent.toml"
+tmpl_vars_file_section = "alerts"
+output_file = "workspace/alerts/vmagent-eu/health.yaml"
+# optional - overrides the vars file section for this entry only
+vars = { tmpl_var_name_suffix = "-vmagent-eu" }
+# optional - defaults to --ignore-missing-vars / --no-ignore-missing-vars
+ignore_missing_vars = false
 """
 
 import sys
@@ -11,17 +31,41 @@ import os
 import argparse
 import json
 import logging
-import traceback
+import re
+import tempfile
+from functools import lru_cache
 from string import Template
+from concurrent.futures import ProcessPoolExecutor
 import toml
 
+from last9_instrument import inc, run_instrumented, span
+from last9_render_index import DEFAULT_INDEX_FILE, record_renders, render_record
+
+MANIFEST_REQUIRED_KEYS = ("tmpl_file", "tmpl_vars_file", "tmpl_vars_file_section", "output_file")
+MANIFEST_OPTIONAL_KEYS = ("vars", "ignore_missing_vars")
+
+CHUNK_SIZE = 1 << 16
+MAX_REPORTED_ERRORS = 20
+# A "${name" left at the end of a chunk, which the next chunk may still close with "}"
+_OPEN_BRACE_RE = re.compile(r"\{(?:%s)?\Z" % Template.idpattern, Template.flags)
+
 
 def load_args():
     """Parse cli"""
     parser = argparse.ArgumentParser()
-    parser.add_argument("--tmpl-file", help="Template to patch", required=True)
-    parser.add_argument("--tmpl-vars-file", help="Template vars file", required=True)
-    parser.add_argument("--tmpl-vars-file-section", help="Template vars file section", required=True)
+    parser.add_argument("--tmpl-file", help="Template to patch")
+    parser.add_argument("--tmpl-vars-file", help="Template vars file")
+    parser.add_argument("--tmpl-vars-file-section", help="Template vars file section")
+    parser.add_argument(
+        "--output-file", help="Stream the patched template to this file instead of printing it", default=""
+    )
+    parser.add_argument("--manifest", help="TOML manifest of [[render]] entries to render in one batch")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        help="Number of processes to render manifest entries with",
+        default=int(os.environ.get("LAST9_RENDER_PROCESSES", "1")),
+    )
     parser.add_argument(
         "--ignore-missing-vars",
         action="store_true",
@@ -35,6 +79,11 @@ def load_args():
         help="Do not ignore if template vars do not have values",
     )
     parser.set_defaults(ignore_missing_vars=False)
+    parser.add_argument(
+        "--render-index",
+        help="Record rendered files below its directory in this dependency index - empty to disable",
+        default=DEFAULT_INDEX_FILE,
+    )
     parser.add_argument("--log-level", help="Log level", default=os.environ.get("LOG_LEVEL", "INFO"))
     return vars(parser.parse_args(sys.argv[1:]))
 
@@ -42,55 +91,339 @@ def load_args():
 def validate_args(args) -> bool:
     """Validate input args"""
     has_valid_args = True
-    if not os.path.exists(args["tmpl_file"]):
+    if args["manifest"]:
+        for key in ("tmpl_file", "tmpl_vars_file", "tmpl_vars_file_section", "output_file"):
+            if args[key]:
+                logging.error("Cannot provide manifest=%s and %s=%s together", args["manifest"], key, args[key])
+                has_valid_args = False
+        if args["processes"] < 1:
+            logging.error("processes=%s must be at least 1", args["processes"])
+            has_valid_args = False
+        if has_valid_args:
+            has_valid_args = load_manifest(args)
+        return has_valid_args
+
+    for key in ("tmpl_file", "tmpl_vars_file", "tmpl_vars_file_section"):
+        if not args[key]:
+            logging.error("%s not specified - provide it or --manifest", key)
+            has_valid_args = False
+    if args["tmpl_file"] and not os.path.exists(args["tmpl_file"]):
         logging.error("Template file - %s does not exist", args["tmpl_file"])
         has_valid_args = False
     return has_valid_args
 
 
-def patch_template(args):
+def load_manifest(args) -> bool:
+    """Load and validate the render manifest into args['entries']"""
+    try:
+        manifest_ds = toml.load(args["manifest"])
+    except Exception as ex:
+        logging.error("manifest=%s failed to load toml - caught exception - %s", args["manifest"], str(ex))
+        return False
+
+    entries = manifest_ds.get("render", [])
+    if not isinstance(entries, list) or not entries:
+        logging.error("manifest=%s has no [[render]] entries", args["manifest"])
+        return False
+
+    has_valid_entries = True
+    for index, entry in enumerate(entries):
+        missing_keys = [key for key in MANIFEST_REQUIRED_KEYS if key not in entry]
+        unknown_keys = [key for key in entry if key not in MANIFEST_REQUIRED_KEYS + MANIFEST_OPTIONAL_KEYS]
+        if missing_keys or unknown_keys:
+            logging.error(
+                "manifest=%s render[%d] missing_keys=%s unknown_keys=%s",
+                args["manifest"],
+                index,
+                missing_keys,
+                unknown_keys,
+            )
+            has_valid_entries = False
+            continue
+        if not os.path.exists(entry["tmpl_file"]):
+            logging.error(
+                "manifest=%s render[%d] template file - %s does not exist", args["manifest"], index, entry["tmpl_file"]
+            )
+            has_valid_entries = False
+        if not isinstance(entry.get("vars", {}), dict):
+            logging.error("manifest=%s render[%d] vars must be a table", args["manifest"], index)
+            has_valid_entries = False
+            continue
+        # Plain dicts - toml's inline table type cannot be pickled into the process pool
+        entry["vars"] = dict(entry.get("vars", {}))
+        entry.setdefault("ignore_missing_vars", args["ignore_missing_vars"])
+
+    output_files = [os.path.normpath(entry.get("output_file", "")) for entry in entries]
+    for output_file in sorted({path for path in output_files if output_files.count(path) > 1}):
+        logging.error("manifest=%s output_file=%s is rendered by more than one entry", args["manifest"], output_file)
+        has_valid_entries = False
+
+    args["entries"] = [dict(entry) for entry in entries]
+    return has_valid_entries
+
+
+@lru_cache(maxsize=None)
+def load_tmpl_vars(tmpl_vars_file):
+    """Parse a vars file once per process"""
+    return toml.load(tmpl_vars_file)
+
+
+@lru_cache(maxsize=None)
+def load_template(tmpl_file):
+    """Read a template once per process"""
+    with open(tmpl_file, "r", encoding="utf-8") as input_fd:
+        return input_fd.read()
+
+
+def read_chunks(tmpl_file, chunk_size=CHUNK_SIZE):
+    """Yield a template file chunk by chunk"""
+    with open(tmpl_file, "r", encoding="utf-8") as input_fd:
+        for chunk in iter(lambda: input_fd.read(chunk_size), ""):
+            yield chunk
+
+
+def _advance(line, col, text):
+    """Line and column after text, starting at line, col"""
+    newlines = text.count("\n")
+    if newlines == 0:
+        return line, col + len(text)
+    return line + newlines, len(text) - text.rfind("\n")
+
+
+def _may_continue(buffer, match):
+    """True if a match at the end of buffer could turn into a different placeholder once more text is read"""
+    if match.end() == len(buffer):
+        # $ / $name cut short - could still become $$ / a longer $name
+        return True
+    # ${name cut short before its closing brace matches as an invalid $
+    return match.group("invalid") is not None and _OPEN_BRACE_RE.match(buffer, match.end()) is not None
+
+
+def iter_substitute(chunks, tmpl_vars, ignore_missing_vars, errors):
+    """Substitute $name / ${name} / $$ across a stream of text chunks, yielding the output piece by piece
+
+    Same semantics as string.Template substitute() / safe_substitute(), except that missing vars and invalid
+    placeholders are appended to errors as "line L col C - ..." instead of raising on the first one. A placeholder
+    split across chunks is carried over to the next chunk, so chunk boundaries never change the output.
+    """
+    line, col = 1, 1
+    carry = ""
+    chunks = iter(chunks)
+    eof = False
+    while not eof:
+        chunk = next(chunks, None)
+        eof = chunk is None
+        buffer = carry + (chunk or "")
+        carry = ""
+        pos = 0
+        end = len(buffer)
+        for match in Template.pattern.finditer(buffer):
+            if not eof and _may_continue(buffer, match):
+                end = match.start()
+                carry = buffer[end:]
+                break
+            literal = buffer[pos : match.start()]
+            yield literal
+            line, col = _advance(line, col, literal)
+
+            name = match.group("named") or match.group("braced")
+            if name is not None:
+                if name in tmpl_vars:
+                    yield str(tmpl_vars[name])
+                else:
+                    if not ignore_missing_vars:
+                        errors.append(f"line {line} col {col} - missing template var {name}")
+                    yield match.group()
+            elif match.group("escaped") is not None:
+                yield Template.delimiter
+            else:
+                if not ignore_missing_vars:
+                    errors.append(
+                        f"line {line} col {col} - invalid placeholder {buffer[match.start() : match.start() + 2]!r}"
+                    )
+                yield match.group()
+            line, col = _advance(line, col, match.group())
+            pos = match.end()
+        literal = buffer[pos:end]
+        yield literal
+        line, col = _advance(line, col, literal)
+
+
+def log_render_errors(tmpl_file, errors):
+    """Log template errors, capped at MAX_REPORTED_ERRORS"""
+    for error in errors[:MAX_REPORTED_ERRORS]:
+        logging.error("Failed to patch template file - %s - %s", tmpl_file, error)
+    if len(errors) > MAX_REPORTED_ERRORS:
+        logging.error(
+            "Failed to patch template file - %s - %d more errors", tmpl_file, len(errors) - MAX_REPORTED_ERRORS
+        )
+
+
+def write_output(output_file, pieces, errors):
+    """Write pieces to output_file via a temp file that only replaces output_file if no errors were recorded"""
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(output_file) or ".", prefix=f".{os.path.basename(output_file)}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as output_fd:
+            output_fd.writelines(pieces)
+            # Same trailing newline print() adds when writing to stdout
+            output_fd.write("\n")
+        if errors:
+            os.unlink(tmp_path)
+            return False
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, output_file)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return True
 
-    tmpl_file = args["tmpl_file"]
-    tmpl_vars_file = args["tmpl_vars_file"]
-    tmpl_vars_file_section = args["tmpl_vars_file_section"]
-    ignore_missing_vars = args["ignore_missing_vars"]
 
-    # Overwrite with any variables present in the input file
-    tmpl_vars_file_ds = toml.load(tmpl_vars_file)
+def env_tmpl_vars():
+    """Environment variables following the template var format - they override every vars file section"""
+    return {key: value for key, value in os.environ.items() if key.startswith("tmpl_var")}
+
+
+def get_tmpl_vars(tmpl_vars_file, tmpl_vars_file_section, extra_vars=None):
+    """Template vars of a vars file section, overlaid with extra_vars and tmpl_var* env vars - False on error"""
+    with span("load_vars"):
+        tmpl_vars_file_ds = load_tmpl_vars(tmpl_vars_file)
     if tmpl_vars_file_section not in tmpl_vars_file_ds:
         logging.error(
             "Failed to find tmpl_vars_file_section=%s in tmpl_vars_file=%s", tmpl_vars_file_section, tmpl_vars_file
         )
         return False
 
+    # Copy the section - the parsed vars file is shared by every render using it
+    tmpl_vars = dict(tmpl_vars_file_ds[tmpl_vars_file_section])
+    tmpl_vars.update(extra_vars or {})
+
     # Load any environment variables following template var format
-    for key, value in os.environ.items():
-        if key.startswith("tmpl_var"):
-            tmpl_vars_file_ds[tmpl_vars_file_section][key] = value
+    tmpl_vars.update(env_tmpl_vars())
 
     logging.debug("Dumping template vars")
-    logging.debug(json.dumps(tmpl_vars_file_ds, indent=2))
+    logging.debug(json.dumps(tmpl_vars, indent=2))
+    return tmpl_vars
 
-    input_fd = open(tmpl_file, encoding="utf-8")
-    input_str = "".join(input_fd.readlines())
-    tmpl_str = Template(input_str)
 
-    try:
-        if ignore_missing_vars:
-            output_str = tmpl_str.safe_substitute(**tmpl_vars_file_ds[tmpl_vars_file_section])
-        else:
-            output_str = tmpl_str.substitute(**tmpl_vars_file_ds[tmpl_vars_file_section])
-    except Exception:
-        logging.error(
-            "Failed to patch template file - %s - Caught exception - %s",
-            tmpl_file,
-            str(traceback.format_exc()),
-        )
+def render(tmpl_file, tmpl_vars_file, tmpl_vars_file_section, ignore_missing_vars, extra_vars=None):
+    """Render a template against a vars file section - returns the output string or False"""
+    tmpl_vars = get_tmpl_vars(tmpl_vars_file, tmpl_vars_file_section, extra_vars)
+    if tmpl_vars is False:
         return False
 
+    errors = []
+    output_str = "".join(iter_substitute([load_template(tmpl_file)], tmpl_vars, ignore_missing_vars, errors))
+    if errors:
+        log_render_errors(tmpl_file, errors)
+        return False
     return output_str
 
 
+def render_file(tmpl_file, tmpl_vars_file, tmpl_vars_file_section, ignore_missing_vars, output_file):
+    """Stream a template into output_file chunk by chunk - returns True on success
+
+    Never holds more than a chunk of the template in memory, which matters for the large Grafana dashboards.
+    """
+    tmpl_vars = get_tmpl_vars(tmpl_vars_file, tmpl_vars_file_section)
+    if tmpl_vars is False:
+        return False
+
+    errors = []
+    pieces = iter_substitute(read_chunks(tmpl_file), tmpl_vars, ignore_missing_vars, errors)
+    if not write_output(output_file, pieces, errors):
+        log_render_errors(tmpl_file, errors)
+        return False
+    return True
+
+
+def patch_template(args):
+    """Render the single template given on the command line"""
+    if args["output_file"]:
+        rendered = render_file(
+            args["tmpl_file"],
+            args["tmpl_vars_file"],
+            args["tmpl_vars_file_section"],
+            args["ignore_missing_vars"],
+            args["output_file"],
+        )
+        if rendered and args["render_index"]:
+            record = output_record(
+                args["tmpl_file"], args["tmpl_vars_file"], args["tmpl_vars_file_section"], args["output_file"]
+            )
+            record_renders([record], args["render_index"])
+        return rendered
+    return render(
+        args["tmpl_file"], args["tmpl_vars_file"], args["tmpl_vars_file_section"], args["ignore_missing_vars"]
+    )
+
+
+def output_record(tmpl_file, tmpl_vars_file, tmpl_vars_file_section, output_file, extra_vars=None):
+    """Render index record of an output file just written"""
+    section_ds = load_tmpl_vars(tmpl_vars_file)[tmpl_vars_file_section]
+    return render_record(
+        tmpl_file, tmpl_vars_file, tmpl_vars_file_section, section_ds, output_file, extra_vars, env_tmpl_vars()
+    )
+
+
+def render_entry(entry):
+    """Render one manifest entry and write its output file - returns (output_file, error, render index record)
+
+    Kept at module level so it can run in a process pool.
+    """
+    output_file = entry["output_file"]
+    try:
+        output_str = render(
+            entry["tmpl_file"],
+            entry["tmpl_vars_file"],
+            entry["tmpl_vars_file_section"],
+            entry["ignore_missing_vars"],
+            entry["vars"],
+        )
+        if output_str is False:
+            return output_file, f"failed to render tmpl_file={entry['tmpl_file']}", None
+        write_output(output_file, [output_str], [])
+        record = output_record(
+            entry["tmpl_file"], entry["tmpl_vars_file"], entry["tmpl_vars_file_section"], output_file, entry["vars"]
+        )
+    except Exception as ex:  # pylint: disable=broad-except
+        return output_file, f"caught exception - {str(ex)}", None
+    return output_file, None, record
+
+
+def render_manifest(args) -> bool:
+    """Render all manifest entries, across a process pool if asked to"""
+    # Entries sharing a template / vars file sit next to each other so each process reuses its parsed copies
+    entries = sorted(args["entries"], key=lambda entry: (entry["tmpl_vars_file"], entry["tmpl_file"]))
+
+    if args["processes"] == 1:
+        results = [render_entry(entry) for entry in entries]
+    else:
+        chunksize = max(1, len(entries) // (args["processes"] * 4))
+        with ProcessPoolExecutor(max_workers=args["processes"]) as executor:
+            results = list(executor.map(render_entry, entries, chunksize=chunksize))
+
+    errors = 0
+    for output_file, error, _ in results:
+        if error is None:
+            logging.debug("Rendered output_file=%s", output_file)
+        else:
+            logging.error("Failed to render output_file=%s - %s", output_file, error)
+            errors += 1
+    if args["render_index"]:
+        record_renders([record for _, error, record in results if error is None], args["render_index"])
+
+    inc("files_rendered", len(results) - errors)
+    inc("render_errors", errors)
+    logging.info("Rendered %d of %d manifest entries", len(results) - errors, len(results))
+    return errors == 0
+
+
 def setup_logging(log_level):
     log_level = getattr(logging, log_level.upper())
     logging.basicConfig(
@@ -105,21 +438,29 @@ def main():
     """Patch template"""
 
     args = load_args()
-    if not validate_args(args):
+    if not setup_logging(args["log_level"]):
         return 1
 
-    if not setup_logging(args["log_level"]):
+    if not validate_args(args):
         return 1
 
+    if args["manifest"]:
+        # Entries rendered in the process pool are timed as a whole - spans of the worker processes are not collected
+        with span("render", mode="manifest"):
+            rendered = render_manifest(args)
+        return 0 if rendered else 1
+
     # output_str = patch_template(args['tmpl_file'], args['tmpl_vars_file'], args['tmpl_vars_file_section'])
-    output_str = patch_template(args)
+    with span("render", mode="stream" if args["output_file"] else "stdout"):
+        output_str = patch_template(args)
     if output_str is False:
         return 1
 
-    print(output_str)
+    if not args["output_file"]:
+        print(output_str)
     return 0
 
 
 if __name__ == "__main__":
-    exit_status = main()
+    exit_status = run_instrumented("patch_template", main)
     sys.exit(exit_status)
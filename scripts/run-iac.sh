@@ -6,7 +6,7 @@ SCRIPT_DIR=$(cd -- "$(dirname -- "${BASH_SOURCE[0]}")" &>/dev/null && pwd)
 
 # Check for pre-requisite commands
 # shellcheck disable=SC2043
-for cmd in l9iac jq; do
+for cmd in l9iac; do
   if ! command -v $cmd >/dev/null 2>&1; then
     echo >&2 "ERROR: Did not find command - $cmd"
     exit 1
@@ -24,6 +24,10 @@ function usage() {
   >&2 echo "  --run-input-file      run action for input file"
   >&2 echo "  --run-all-files       run action for all iac files"
   >&2 echo "  --run-git-diff-files  run action for git diff files"
+  >&2 echo "  --render-stale        with --run-git-diff-files, first re-render the files whose template or vars changed"
+  >&2 echo "  --workers N           run N files in parallel (default \$LAST9_IAC_WORKERS or 4)"
+  >&2 echo "  --continue-on-error   run all files even if some fail (default: stop after the first failure)"
+  >&2 echo "  --force               run files even if unchanged since their last successful apply"
   # TODO - to fix - when running iac in while loop, cannot prompt user when -y/--yes not supplied - hence assuming apply == apply -y
   # >&2 echo "  -y, --yes           add yes for apply"
   echo >&2 ""
@@ -44,6 +48,10 @@ while [[ "$#" -gt 0 ]]; do
   --run-input-file) run_input_file="$2"; shift; shift;;
   --run-all-files) run_all_files="1"; shift;;
   --run-git-diff-files) run_git_diff_files="1"; shift;;
+  --render-stale) render_stale="1"; shift;;
+  --workers) workers="$2"; shift; shift;;
+  --continue-on-error) continue_on_error="1"; shift;;
+  --force) force="1"; shift;;
   *)
     usage "Unknown parameter passed: $1"
     exit 1
@@ -62,10 +70,40 @@ if [[ "$action" != "plan" ]] && [[ "$action" != "apply" ]]; then
 fi
 
 run_git_diff_files=${run_git_diff_files:-"0"}
+render_stale=${render_stale:-"0"}
 run_all_files=${run_all_files:-"0"}
 run_input_file=${run_input_file:-""}
+workers=${workers:-${LAST9_IAC_WORKERS:-4}}
+continue_on_error=${continue_on_error:-"0"}
+force=${force:-"0"}
 iac_target_files_list="/tmp/iac_target_files.txt"
 
+# Phase timings - written to $LAST9_IAC_METRICS_DIR / $LAST9_IAC_TRACE_DIR on exit by last9_instrument.py
+function now() {
+  local ts
+  ts=$(date +%s.%N)
+  # BSD date has no %N
+  [[ "$ts" == *N ]] && ts=$(date +%s)
+  echo "$ts"
+}
+iac_phases=()
+run_start=$(now)
+phase_start=$run_start
+function end_phase() {
+  local phase_end
+  phase_end=$(now)
+  iac_phases+=("--phase" "$1=$phase_start,$phase_end")
+  phase_start=$phase_end
+}
+function write_run_metrics() {
+  local exit_status=$?
+  if [[ "${LAST9_IAC_METRICS_DIR:-}${LAST9_IAC_TRACE_DIR:-}" != "" ]]; then
+    python3 "$SCRIPT_DIR/last9_instrument.py" --script run_iac --exit-status "$exit_status" --start "$run_start" \
+      ${iac_phases[@]+"${iac_phases[@]}"} || true
+  fi
+}
+trap write_run_metrics EXIT
+
 if [[ $run_input_file != "" ]]; then
   if ! [[ -f "$run_input_file" ]]; then
     >&2 echo "ERROR: input_file=$run_input_file does not exist."
@@ -79,8 +117,15 @@ if [[ $run_all_files == "1" ]]; then
 fi
 
 if [[ $run_git_diff_files == "1" ]]; then
-  "scripts/find-iac-files.sh" --git-diff > $iac_target_files_list
+  # Rendered files whose template or vars changed are reported - re-rendering them in place is opt-in, as the files
+  # then run with content which is not committed
+  find_opts=(--git-diff)
+  if [[ "$render_stale" == "1" ]]; then
+    find_opts+=(--render-stale)
+  fi
+  "scripts/find-iac-files.sh" "${find_opts[@]}" > $iac_target_files_list
 fi
+end_phase find_files
 
 set +e
 if ! \grep -q '.yaml' $iac_target_files_list; then
@@ -145,135 +190,38 @@ set -e
 
 config_file='.last9.config.json'
 env_vars_file="/tmp/.last9.config.sh"
+iac_config_file="/tmp/.last9-iac.config.json"
 
 >&2 echo "------------------------"
-if [[ -f $config_file ]]; then
-  if ! "$SCRIPT_DIR/load-config.sh" --config-file "$config_file" --output-file "$env_vars_file" --cache-config; then
-    >&2 echo "ERROR: Failed to load config file $config_file"
-    exit 1
-  fi
-else
-  if ! "$SCRIPT_DIR/load-config.sh" --output-file "$env_vars_file"; then
-    >&2 echo "ERROR: Failed to load config from env vars"
-    exit 1
-  fi
-fi
-
-# shellcheck disable=1090
-source $env_vars_file
-
->&2 echo "------------------------"
-# Validate loaded config
-if ! "$SCRIPT_DIR/validate-config.sh" --env-vars-file "$env_vars_file"; then
-  >&2 echo "ERROR: Failed to validate env vars file $env_vars_file"
+# Load and validate the config from $config_file or env vars in one go - assumed role credentials are cached until
+# shortly before they expire, so back to back runs do not assume the role again
+if ! python3 "$SCRIPT_DIR/last9_config.py" --config-file "$config_file" --env-vars-file "$env_vars_file" \
+  --iac-config-file "$iac_config_file"; then
+  >&2 echo "ERROR: Failed to load config"
   exit 1
 fi
 
 # shellcheck disable=1090
-# To load assume role vars if any
 source $env_vars_file
+end_phase load_config
 
-iac_config_file="/tmp/.last9-iac.config.json"
-
-# Backup iac config file as we will update "state_lock_file_path" in it later
-cp "$iac_config_file" "${iac_config_file}.orig"
-
-while read -r input_file; do
-
-  echo >&2 "------------------------"
-  echo >&2 "STATUS: file=$input_file action=$action"
-
-  input_file_dir=$(dirname "$input_file")
-  input_file_name=$(basename "$input_file")
-  backup_s3_bucket_dir_path="$LAST9_BACKUP_S3_BUCKET/$input_file_dir"
-
-  if ! aws s3 cp "$input_file" "$backup_s3_bucket_dir_path/" >/dev/null; then
-    echo >&2 "ERROR: Failed to copy $input_file to $LAST9_BACKUP_S3_BUCKET/$input_file_dir"
-    exit 1
-  fi
-
-  lock_file_name="$(echo "$input_file_name" | cut -f1 -d'.').lock"
-  remote_lock_file="$backup_s3_bucket_dir_path/$lock_file_name"
-  remote_lock_bak_file="$backup_s3_bucket_dir_path/${lock_file_name}.bak"
-
-  echo >&2 "STATUS: Updating iac config file to use lock_file=$lock_file_name"
-  cp "${iac_config_file}.orig" "$iac_config_file"
-  cat <<<"$(jq '.state_lock_file_path |= sub("alerting-iac-state.lock"; "'"$lock_file_name"'")' <$iac_config_file)" >"$iac_config_file"
-
-  if aws s3 ls "$remote_lock_file" >/dev/null; then
-    echo >&2 "STATUS: Found remote_lock_file=$remote_lock_file"
-    echo >&2 "STATUS: Copying remote_lock_file=$remote_lock_file to input_file_dir=$input_file_dir"
-    if ! aws s3 cp "$remote_lock_file" "$input_file_dir" >/dev/null; then
-      echo >&2 "ERROR: Failed to copy remote_lock_file=$remote_lock_file to input_file_dir=$input_file_dir"
-      exit 1
-    fi
-  else
-    echo >&2 "STATUS: Did not find remote_lock_file=$remote_lock_file"
-  fi
-
-  if aws s3 ls "$remote_lock_bak_file" >/dev/null; then
-    echo >&2 "STATUS: Found remote_lock_bak_file=$remote_lock_bak_file"
-    echo >&2 "STATUS: Copying remote_lock_bak_file=$remote_lock_bak_file to input_file_dir=$input_file_dir"
-    if ! aws s3 cp "$remote_lock_bak_file" "$input_file_dir" >/dev/null; then
-      echo >&2 "ERROR: Failed to copy remote_lock_bak_file=$remote_lock_bak_file to input_file_dir=$input_file_dir"
-      exit 1
-    fi
-  else
-    echo >&2 "STATUS: Did not find remote_lock_bak_file=$remote_lock_bak_file"
-  fi
-
-  cd "$input_file_dir"
-
-  if [[ $action == "plan" ]]; then
-    set -x
-    set +e
-    if ! l9iac -mf "$input_file_name" -c "$iac_config_file" plan; then
-      echo >&2 "STATUS: file=$input_file action=$action status=failed"
-      exit 1
-    fi
-    set -e
-    set +x
-  else
-    set -x
-    set +e
-    if ! l9iac -mf "$input_file_name" -c "$iac_config_file" apply -y; then
-      echo >&2 "STATUS: file=$input_file action=$action status=failed"
-      exit 1
-    fi
-    set -e
-    set +x
-
-    echo >&2 "STATUS file=$input_file action=copy_lock_file"
-    if ! aws s3 cp "$lock_file_name" "$remote_lock_file" >/dev/null; then
-      echo >&2 "STATUS file=$input_file action=copy_lock_file status=failed"
-      exit 1
-    fi
-    echo >&2 "STATUS file=$input_file action=copy_lock_file status=success"
-    echo >&2 "STATUS file=$input_file action=copy_lock_file source=$lock_file_name dest=$remote_lock_file status=success"
-
-    if [[ -f "${lock_file_name}.bak" ]]; then
-      echo >&2 "STATUS file=$input_file action=copy_lock_bak_file"
-      if ! aws s3 cp "${lock_file_name}.bak" "$remote_lock_bak_file" >/dev/null; then
-        echo >&2 "STATUS file=$input_file action=copy_lock_bak_file status=failed"
-        exit 1
-      fi
-    fi
-    echo >&2 "STATUS file=$input_file action=copy_lock_bak_file source=${lock_file_name}.bak dest=$remote_lock_bak_file status=success"
-
-  fi
-
-  echo >&2 "STATUS: file=$input_file action=$action status=success"
-
-  if [[ -f $lock_file_name ]]; then
-    echo >&2 "STATUS: file=$input_file lock_file=$lock_file_name status=removing_local_lock_file"
-    rm -f "$lock_file_name"
-  fi
-
-  if [[ -f "${lock_file_name}.bak" ]]; then
-    echo >&2 "STATUS: file=$input_file lock_file_bak=${lock_file_name}.bak status=removing_local_lock_bak_file"
-    rm -f "${lock_file_name}.bak"
-  fi
-  echo >&2 "------------------------"
+runner_opts=(--fail-fast)
+if [[ "$continue_on_error" == "1" ]]; then
+  runner_opts=(--continue-on-error)
+fi
+if [[ "$force" == "1" ]]; then
+  runner_opts+=(--force)
+fi
 
-  cd - >/dev/null
-done <"$iac_target_files_list"
+# Runs l9iac for every target file with a bounded worker pool - each file gets its own copy of the iac config with
+# state_lock_file_path pointing at the file's lock, so files no longer share (and rewrite) $iac_config_file
+run_status=0
+if ! python3 "$SCRIPT_DIR/run_iac_files.py" --action "$action" --input-files-list "$iac_target_files_list" \
+  --iac-config-file "$iac_config_file" --workers "$workers" "${runner_opts[@]}"; then
+  run_status=1
+fi
+end_phase run_iac_files
+if [[ $run_status != 0 ]]; then
+  >&2 echo "STATUS: action=$action status=failed"
+  exit 1
+fi
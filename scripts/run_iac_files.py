@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+
+"""
+Run l9iac plan/apply for a list of IaC files with a bounded worker pool
+
+Called by run-iac.sh once config has been loaded and validated. The run has three stages:
+  1. one S3 listing of the backup prefix, then all remote .lock / .lock.bak files of the target files are downloaded
+     next to them concurrently (see last9_s3_sync)
+  2. l9iac is run per file with a private copy of the iac config whose state_lock_file_path points at the file's lock
+  3. backups of the files plus, on apply, the locks that changed and the apply manifests are uploaded in one batch and
+     local locks removed
+
+A successful apply records the sha256 of the file and of its lock in {file}.iac-manifest.json next to the lock in the
+backup bucket. Files whose content and lock still match their manifest are neither planned nor applied again (status
+unchanged) unless --force is given.
+
+Files sharing a lock file are run one after the other, everything else runs in parallel. Output of each file is
+prefixed with its path and a per file timing summary is printed at the end.
+
+Sample usage
+
+python scripts/run_iac_files.py --action plan --input-files-list /tmp/iac_target_files.txt --workers 4
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import datetime
+import logging
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from last9_config import ConfigError, parse_iac_config
+from last9_instrument import inc, run_instrumented, span
+from last9_s3_sync import S3LockSync, file_sha256, lock_file_name_for, state_paths_for
+
+DEFAULT_LOCK_FILE_NAME = "alerting-iac-state.lock"
+
+_OUTPUT_LOCK = threading.Lock()
+
+
+def load_args():
+    """Parse cli"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--action", help="l9iac action", choices=["plan", "apply"], required=True)
+    parser.add_argument(
+        "--input-files-list", help="File listing the iac files to run", default="/tmp/iac_target_files.txt"
+    )
+    parser.add_argument("--iac-config-file", help="l9iac config file", default="/tmp/.last9-iac.config.json")
+    parser.add_argument(
+        "--backup-s3-bucket",
+        help="S3 bucket (and prefix) holding file backups and lock files",
+        default=os.environ.get("LAST9_BACKUP_S3_BUCKET", ""),
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of files to run in parallel",
+        default=int(os.environ.get("LAST9_IAC_WORKERS", "4")),
+    )
+    parser.add_argument(
+        "--fail-fast", action="store_true", dest="fail_fast", help="Stop starting new files after the first failure"
+    )
+    parser.add_argument(
+        "--continue-on-error", action="store_false", dest="fail_fast", help="Run all files even if some fail"
+    )
+    parser.set_defaults(fail_fast=True)
+    parser.add_argument(
+        "--force", action="store_true", help="Run files even if unchanged since their last successful apply"
+    )
+    parser.add_argument("--log-level", help="Log level", default=os.environ.get("LOG_LEVEL", "INFO"))
+    return vars(parser.parse_args(sys.argv[1:]))
+
+
+def validate_args(args):
+    """Validate input args"""
+    has_valid_args = True
+    if not os.path.exists(args["input_files_list"]):
+        logging.error("input_files_list=%s does not exist", args["input_files_list"])
+        has_valid_args = False
+    if not os.path.exists(args["iac_config_file"]):
+        logging.error("iac_config_file=%s does not exist", args["iac_config_file"])
+        has_valid_args = False
+    if args["backup_s3_bucket"] == "":
+        logging.error("backup_s3_bucket empty - set LAST9_BACKUP_S3_BUCKET")
+        has_valid_args = False
+    if args["workers"] < 1:
+        logging.error("workers=%s must be at least 1", args["workers"])
+        has_valid_args = False
+    if not has_valid_args:
+        return False
+
+    try:
+        with open(args["iac_config_file"], "r", encoding="utf-8") as config_fd:
+            args["iac_config_ds"] = parse_iac_config(config_fd.read(), args["iac_config_file"]).raw
+    except ConfigError as ex:
+        logging.error("%s", ex)
+        return False
+    args["backup_s3_bucket"] = args["backup_s3_bucket"].rstrip("/")
+
+    with open(args["input_files_list"], "r", encoding="utf-8") as list_fd:
+        args["input_files"] = [line.strip() for line in list_fd if ".yaml" in line]
+    return True
+
+
+def emit(input_file, message):
+    """Print a status line prefixed with the file it belongs to"""
+    with _OUTPUT_LOCK:
+        sys.stderr.write(f"[{input_file}] {message}\n")
+        sys.stderr.flush()
+
+
+def iac_config_for(args, input_file):
+    """iac config with state_lock_file_path pointing at the file's lock"""
+    iac_config_ds = dict(args["iac_config_ds"])
+    state_lock_file_path = iac_config_ds.get("state_lock_file_path", "")
+    iac_config_ds["state_lock_file_path"] = re.sub(
+        re.escape(DEFAULT_LOCK_FILE_NAME), lock_file_name_for(input_file), state_lock_file_path, count=1
+    )
+    return iac_config_ds
+
+
+def _run(input_file, cmd, cwd=None):
+    """Run a command streaming its output prefixed with input_file - returns True on success"""
+    emit(input_file, "+ " + " ".join(cmd))
+    with subprocess.Popen(
+        cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors="replace"
+    ) as proc:
+        for line in proc.stdout:
+            emit(input_file, line.rstrip("\n"))
+    return proc.returncode == 0
+
+
+def is_unchanged(input_file):
+    """True if the file and its lock match the manifest written by the last successful apply"""
+    local_lock_file, _, manifest_file = state_paths_for(input_file)
+    try:
+        with open(manifest_file, "r", encoding="utf-8") as manifest_fd:
+            manifest_ds = json.load(manifest_fd)
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError) as ex:
+        emit(input_file, f"WARNING: Ignoring unreadable manifest {manifest_file} - {str(ex)}")
+        return False
+    if not isinstance(manifest_ds, dict):
+        return False
+    file_matches = manifest_ds.get("file_sha256") == file_sha256(input_file)
+    return file_matches and manifest_ds.get("lock_sha256") == file_sha256(local_lock_file)
+
+
+def write_manifest(input_file):
+    """Record the hashes of the file and its lock after a successful apply"""
+    local_lock_file, _, manifest_file = state_paths_for(input_file)
+    manifest_ds = {
+        "file": input_file,
+        "file_sha256": file_sha256(input_file),
+        "lock_sha256": file_sha256(local_lock_file),
+        "applied_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+    }
+    with open(manifest_file, "w", encoding="utf-8") as manifest_fd:
+        json.dump(manifest_ds, manifest_fd, indent=2)
+
+
+def run_file(args, input_file):
+    """Run l9iac for a single iac file - returns (success, message)"""
+    action = args["action"]
+    input_file_dir = os.path.dirname(input_file) or "."
+
+    emit(input_file, f"STATUS: action={action}")
+
+    # Each file gets a private config so parallel runs do not overwrite each other's state_lock_file_path
+    config_fd, config_file = tempfile.mkstemp(prefix=".last9-iac.config.", suffix=".json")
+    try:
+        with os.fdopen(config_fd, "w", encoding="utf-8") as config_out_fd:
+            json.dump(iac_config_for(args, input_file), config_out_fd)
+
+        emit(input_file, f"STATUS: Using iac config with lock_file={lock_file_name_for(input_file)}")
+        cmd = ["l9iac", "-mf", os.path.basename(input_file), "-c", config_file, action]
+        if action == "apply":
+            cmd.append("-y")
+        with span("l9iac", command=action) as trace_args:
+            trace_args["file"] = input_file
+            success = _run(input_file, cmd, cwd=input_file_dir)
+        if not success:
+            inc("l9iac_failures", command=action)
+            return False, "l9iac failed"
+    finally:
+        os.unlink(config_file)
+
+    if action == "apply":
+        write_manifest(input_file)
+    return True, ""
+
+
+def sync_down(args, sync):
+    """Download the remote locks of all target files - returns True on success"""
+    try:
+        with span("s3_sync", direction="down"):
+            downloaded = sync.download_locks(args["input_files"])
+    except Exception as ex:  # pylint: disable=broad-except
+        logging.error("Failed to download lock files from %s - caught exception - %s", args["backup_s3_bucket"], ex)
+        return False
+    logging.info("Downloaded %d lock and manifest files from %s", len(downloaded), args["backup_s3_bucket"])
+    return True
+
+
+def sync_up(args, sync, results):
+    """Upload backups of attempted files plus changed locks and manifests of applied files, then remove local locks"""
+    uploads = []
+    for result in results:
+        if result["status"] in ("skipped", "unchanged"):
+            continue
+        uploads.append(result["file"])
+        if args["action"] == "apply" and result["status"] == "success":
+            uploads.extend(sync.changed_locks(result["file"]))
+            uploads.append(state_paths_for(result["file"])[2])
+
+    with span("s3_sync", direction="up"):
+        errors = sync.upload_files(uploads)
+    logging.info("Uploaded %d files to %s", len(uploads) - len(errors), args["backup_s3_bucket"])
+
+    for result in results:
+        input_file = result["file"]
+        state_paths = state_paths_for(input_file)
+        failed_uploads = [path for path in (input_file,) + state_paths if path in errors]
+        for path in failed_uploads:
+            emit(input_file, f"ERROR: Failed to upload {path} to {sync.key_for(path)} - {errors[path]}")
+        if failed_uploads and result["status"] == "success":
+            result["status"] = "failed"
+            result["message"] = "upload failed"
+        if result["status"] not in ("success", "unchanged"):
+            # Keep local locks of failed files around for inspection, same as a failed run-iac.sh always did
+            continue
+        for local_file in state_paths:
+            if os.path.exists(local_file):
+                os.remove(local_file)
+
+    return not errors
+
+
+def group_files(args):
+    """Group files that share a lock file - a group is run serially, groups run in parallel"""
+    groups = {}
+    for input_file in args["input_files"]:
+        input_file_dir = os.path.dirname(input_file) or "."
+        lock_keys = [os.path.normpath(os.path.join(input_file_dir, lock_file_name_for(input_file)))]
+        state_lock_file_path = iac_config_for(args, input_file).get("state_lock_file_path", "")
+        if state_lock_file_path:
+            lock_keys.append(os.path.normpath(os.path.join(input_file_dir, state_lock_file_path)))
+
+        group = [input_file]
+        for key in lock_keys:
+            # Merge with any group already using one of this file's locks, keeping input order
+            if key in groups and groups[key] is not group:
+                other = groups[key]
+                group = sorted(other + group, key=args["input_files"].index)
+                for other_key, other_group in groups.items():
+                    if other_group is other:
+                        groups[other_key] = group
+            groups[key] = group
+
+    return list({id(group): group for group in groups.values()}.values())
+
+
+def run_files(args):
+    """Run all files - returns list of result dicts in input order"""
+    stop_event = threading.Event()
+    results = {}
+
+    def _run_group(group):
+        for input_file in group:
+            if stop_event.is_set():
+                results[input_file] = {"file": input_file, "status": "skipped", "duration_sec": 0.0, "message": ""}
+                continue
+            if not args["force"] and is_unchanged(input_file):
+                results[input_file] = {"file": input_file, "status": "unchanged", "duration_sec": 0.0, "message": ""}
+                emit(input_file, f"STATUS: action={args['action']} status=unchanged - file and lock match last apply")
+                continue
+            start = time.perf_counter()
+            try:
+                success, message = run_file(args, input_file)
+            except Exception as ex:  # pylint: disable=broad-except
+                success, message = False, f"caught exception - {str(ex)}"
+            duration_sec = time.perf_counter() - start
+            status = "success" if success else "failed"
+            results[input_file] = {
+                "file": input_file,
+                "status": status,
+                "duration_sec": duration_sec,
+                "message": message,
+            }
+            emit(
+                input_file,
+                f"STATUS: action={args['action']} status={status} duration_sec={duration_sec:.1f}"
+                + (f" error={message}" if message else ""),
+            )
+            if not success and args["fail_fast"]:
+                stop_event.set()
+
+    with ThreadPoolExecutor(max_workers=args["workers"]) as executor:
+        for future in [executor.submit(_run_group, group) for group in group_files(args)]:
+            future.result()
+
+    return [results[input_file] for input_file in args["input_files"]]
+
+
+def print_summary(args, results, wall_sec):
+    """Print per file timings"""
+    width = max(len(result["file"]) for result in results)
+    lines = ["------------------------", f"SUMMARY: action={args['action']} workers={args['workers']}"]
+    for result in sorted(results, key=lambda result: result["duration_sec"], reverse=True):
+        lines.append(f"  {result['file']:<{width}}  {result['status']:<9} {result['duration_sec']:8.1f}s")
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    lines.append(
+        f"SUMMARY: files={len(results)} "
+        + " ".join(f"{status}={count}" for status, count in sorted(counts.items()))
+        + f" wall_sec={wall_sec:.1f} total_sec={sum(result['duration_sec'] for result in results):.1f}"
+    )
+    lines.append("------------------------")
+    with _OUTPUT_LOCK:
+        sys.stderr.write("\n".join(lines) + "\n")
+
+
+def setup_logging(log_level):
+    """Setup logging"""
+    log_level = getattr(logging, log_level.upper())
+    logging.basicConfig(
+        level=log_level, format="%(asctime)s.%(msecs)03d %(levelname)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    return True
+
+
+def main():
+    """Main function"""
+    args = load_args()
+
+    if not setup_logging(args["log_level"]):
+        return 1
+
+    with span("load_config"):
+        valid_args = validate_args(args)
+    if not valid_args:
+        return 1
+
+    if not args["input_files"]:
+        logging.info("No iac files to process")
+        return 0
+
+    start = time.perf_counter()
+    sync = S3LockSync(args["backup_s3_bucket"])
+    if not sync_down(args, sync):
+        return 1
+
+    results = run_files(args)
+    sync_up(args, sync, results)
+    for result in results:
+        inc("files", action=args["action"], status=result["status"])
+    print_summary(args, results, time.perf_counter() - start)
+
+    if any(result["status"] not in ("success", "unchanged") for result in results):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    exit_status = run_instrumented("run_iac_files", main)
+    sys.exit(exit_status)